@@ -3,183 +3,660 @@
 #
 # ardour2fxp.py
 #
-"""Convert one or more Ardour VST presets XML file to VST2 FXP preset files."""
+"""Convert one or more Ardour VST presets XML file to VST2 FXP preset files.
 
-import argparse
+Optionally, all presets for a plugin can be written to a single FXB bank file.
+
+"""
+
+import io
 import os
 import sys
 
-from base64 import b64decode
-from collections import namedtuple
-from os.path import exists, isdir, join
-from struct import calcsize, pack
-from xml.etree import ElementTree as ET
+from collections import deque
+from itertools import chain
+from os.path import abspath, exists, isdir, join, relpath
+from struct import pack
+from time import perf_counter
+
+from vstpreset.archive import ArchiveWriter, is_archive
+from vstpreset.ardour import iter_ardourpresets, preset_xml
+from vstpreset.core import FX_MAGIC_CHUNK, Preset, preset_digest
+from vstpreset.fxp import pack_fxb, pack_fxp, parse_buffer, program_digest
+from vstpreset.client import call_server
+from vstpreset.util import (PIPELINE_DATA_QUEUE_SIZE, ConversionError,
+                            DedupIndex, FilenameAllocator, OutputDir,
+                            PresetFilter, Stats, find_files, iter_threaded,
+                            parse_plugin_id, profile, sanitize_filename)
+
+
+PRESETFILE_PATTERNS = ('vst-*',)
+
+
+def plugin_id2fn(plugin_id):
+    """Return file name for plugin ID.
+
+    This is the plugin ID as four characters, if they are all suitable for a
+    file name, otherwise as eight hexadecimal digits.
+
+    """
+    name = pack('>I', plugin_id).decode('latin1')
+
+    if name.isascii() and name.isprintable() and (
+            sanitize_filename(name) == name):
+        return name
+
+    return '{:08X}'.format(plugin_id)
+
+
+def verify_fxpdata(preset, data):
+    """Check that FXP program data converts back to the preset unchanged.
+
+    The FXP data is parsed and converted to Ardour preset XML in memory, like
+    ``fxp2ardour`` does, and the preset read back from the XML is compared to
+    the source preset. Parameter values and chunk data are compared as a
+    whole by their digest, together with the preset type and plugin ID.
+
+    Returns None if the presets match, otherwise a description of the
+    difference.
+
+    """
+    presets = parse_buffer(data)
+
+    if len(presets) != 1:
+        return "FXP data contains {:d} presets".format(len(presets))
 
+    # use the plugin ID read back from the FXP data, like fxp2ardour does
+    xml = b''.join((b'<VSTPresets>',
+                    preset_xml(presets[0], presets[0].plugin_id, 0),
+                    b'</VSTPresets>'))
+    result = list(iter_ardourpresets(io.BytesIO(xml)))
 
-FXP_HEADER_FMT = '>4si4s4i28s'
-FXP_PREAMBEL_SIZE = calcsize('>4si')
-FXP_HEADER_SIZE = calcsize(FXP_HEADER_FMT)
-FXP_FORMAT_VERSION = 1
-CHUNK_MAGIC = b'CcnK'
-FX_MAGIC_PARAMS = b'FxCk'
-FX_MAGIC_CHUNK = b'FPCh'
-FX_DEFAULT_VERSION = 1
-PRESET_BASE_FIELDS = (
-    'plugin_id',
-    'plugin_version',
-    'hash',
-    'label',
-    'num_params',
-)
+    if len(result) != 1:
+        return "Ardour preset XML contains {:d} presets".format(len(result))
 
-ChunkPreset = namedtuple('ChunkPreset', PRESET_BASE_FIELDS + ('chunk',))
-Preset = namedtuple('Preset', PRESET_BASE_FIELDS + ('params',))
+    result = result[0]
 
+    if result.plugin_id != preset.plugin_id:
+        return "plugin ID changed to {:d}".format(result.plugin_id)
+    elif preset_digest(result) != preset_digest(preset):
+        return "{} payload differs".format(
+            "parameter values" if isinstance(preset, Preset) else "chunk data")
+    elif result.label != preset.label:
+        return "label changed to {!r}".format(result.label)
 
-def label2fn(label):
-    """Replace characters in label unsuitable for filenames with underscore."""
-    return label.strip().replace(' ', '_')
 
+def iter_fxpdata(infile, fx_version=None, stats=None, verify=False,
+                 select=None):
+    """Convert presets in Ardour VST presets XML file to FXP program data.
 
-def parse_ardourpresets(root):
-    """Parse ardour VST presets XML document.
+    Yields ``(plugin_id, label, data, mismatch)`` tuples, one per preset,
+    where ``data`` is the binary content of the FXP file for the preset. If
+    ``verify`` is true, each preset is checked with ``verify_fxpdata`` and
+    ``mismatch`` is the description of the difference found, otherwise it is
+    always None.
 
-    Returns list of Preset or ChunkPreset instances.
+    Only presets selected by ``select`` are converted, see
+    ``vstpreset.ardour.PresetParser``.
 
     """
-    if root.tag != 'VSTPresets':
-        raise ValueError("Root node must be 'VSTPresets'.")
+    for preset in iter_ardourpresets(infile, stats, select):
+        start = perf_counter()
+        data = pack_fxp(preset, fx_version)
+
+        if stats is not None:
+            stats.add('pack fxp', perf_counter() - start, bytes=len(data),
+                      presets=1)
+
+        mismatch = None
+
+        if verify:
+            start = perf_counter()
+            mismatch = verify_fxpdata(preset, data)
+
+            if stats is not None:
+                stats.add('verify', perf_counter() - start, bytes=len(data),
+                          presets=1)
+
+        yield preset.plugin_id, preset.label, data, mismatch
+
+
+def convert_file(infile, fx_version=None, verify=False, select=None):
+    """Return list of FXP program data for all presets in given file.
+
+    See ``iter_fxpdata`` for the format of list items.
+
+    """
+    return list(iter_fxpdata(infile, fx_version, verify=verify,
+                             select=select))
+
+
+def _flatten_results(results):
+    for infile, fxpdata in results:
+        for item in fxpdata:
+            yield infile, item
+
+        # mark end of file
+        yield infile, None
+
+
+def _convert_file_stats(infile, fx_version=None, verify=False, select=None):
+    stats = Stats()
+    return (list(iter_fxpdata(infile, fx_version, stats, verify, select)),
+            stats.stages)
 
-    presets = []
-    for preset in root:
-        if preset.tag not in ('Preset', 'ChunkPreset'):
-            print("Invalid preset type: {}".format(preset.tag))
-            continue
+
+def _future_result(future, stats=None):
+    result = future.result()
+
+    if stats is not None:
+        result, stages = result
+        stats.update(stages)
+
+    yield from result
+
+
+def _read_errors(infile, items):
+    try:
+        yield from items
+    except Exception as exc:
+        raise ConversionError("Error reading Ardour preset file '{}': {}"
+                              .format(infile, exc)) from exc
+
+
+def convert_files(infiles, fx_version=None, jobs=1, stats=None, verify=False,
+                  select=None):
+    """Convert Ardour VST presets XML files to FXP program data.
+
+    ``infiles`` can be any iterable of file names, which is consumed
+    lazily. Yields ``(infile, fxpdata)`` tuples in the order of ``infiles``,
+    where ``fxpdata`` is an iterable as returned by ``iter_fxpdata``.
+
+    If ``jobs`` is greater than one, input files are converted in parallel by
+    a pool of that many worker processes. Results are still returned in input
+    order, so output file names and collision handling stay deterministic.
+
+    Errors reading an input file are raised as ``ConversionError`` when
+    iterating over the ``fxpdata`` of that file.
+
+    If a ``Stats`` instance is passed as ``stats``, conversion statistics,
+    including those from worker processes, are recorded in it. If ``verify``
+    is true, each converted preset is verified as described for
+    ``iter_fxpdata``, in the worker processes, if any. Only presets selected
+    by ``select`` are converted, it must be picklable if ``jobs`` is greater
+    than one.
+
+    """
+    if jobs > 1:
+        from concurrent.futures import ProcessPoolExecutor
+
+        func = convert_file if stats is None else _convert_file_stats
+
+        with ProcessPoolExecutor(jobs) as pool:
+            pending = deque()
+
+            for infile in infiles:
+                pending.append((infile, pool.submit(func, infile, fx_version,
+                                                    verify, select)))
+
+                # only submit up to two files per worker in advance
+                if len(pending) > jobs * 2:
+                    infile, future = pending.popleft()
+                    yield infile, _read_errors(
+                        infile, _future_result(future, stats))
+
+            while pending:
+                infile, future = pending.popleft()
+                yield infile, _read_errors(infile,
+                                           _future_result(future, stats))
+    else:
+        for infile in infiles:
+            yield infile, _read_errors(
+                infile, iter_fxpdata(infile, fx_version, stats, verify,
+                                     select))
+
+
+class ConversionCache:
+    """Cache of the content hashes of files written to an output directory.
+
+    The cache maps the path of each output file (relative to the output
+    directory) to the SHA1 hash of the data written to it, together with the
+    size and modification time of the file after writing. Since the FXP data
+    is fully determined by the parsed preset and the effective plugin version,
+    the hash identifies the converted preset content.
+
+    The cache is stored as JSON in a hidden file in the output directory.
+
+    """
+
+    filename = '.ardour2fxp-cache.json'
+    version = 1
+
+    def __init__(self, output_dir):
+        import json
+
+        self.output_dir = output_dir
+        self.path = join(output_dir, self.filename)
+        self.entries = {}
 
         try:
-            type, plugin_id, hash = preset.attrib['uri'].split(':', 2)
-            plugin_id = int(plugin_id)
-            version = preset.attrib.get('version')
-            num_params = preset.attrib.get('numParams')
-            label = preset.attrib['label']
+            with open(self.path, encoding='utf-8') as fp:
+                data = json.load(fp)
 
-            if version is not None:
-                version = int(version)
+            if data.get('version') == self.version:
+                self.entries = data['entries']
+        except (OSError, ValueError, KeyError, AttributeError):
+            pass
 
-            if num_params is not None:
-                num_params = int(num_params)
+    def is_current(self, fn, digest):
+        """Return True if file exists and was last written with given data."""
+        entry = self.entries.get(relpath(fn, self.output_dir))
 
-            if type != "VST":
-                raise ValueError
-        except (KeyError, ValueError):
-            print("Invalid preset format: {}".format(preset.attrib))
-            continue
+        if entry is None or entry[0] != digest:
+            return False
 
-        if preset.tag == 'Preset':
-            params = {int(param.attrib['index']): param.attrib['value']
-                      for param in preset}
-            params = [float(value) for _, value in sorted(params.items())]
-            presets.append(Preset(plugin_id, version, hash, label, num_params,
-                                  params))
-        elif preset.tag == 'ChunkPreset':
-            presets.append(ChunkPreset(plugin_id, version, hash, label,
-                                       num_params, b64decode(preset.text)))
+        try:
+            st = os.stat(fn)
+        except OSError:
+            return False
 
-    return presets
+        return [st.st_size, st.st_mtime_ns] == entry[1:]
 
+    def digest(self, fn):
+        """Return hash recorded for file or None."""
+        entry = self.entries.get(relpath(fn, self.output_dir))
+        return None if entry is None else entry[0]
+
+    def add(self, fn, digest, st=None):
+        """Record hash of data written to given file.
+
+        ``st`` is the ``os.stat_result`` of the file, if already known.
+
+        """
+        if st is None:
+            st = os.stat(fn)
+
+        self.entries[relpath(fn, self.output_dir)] = [
+            digest, st.st_size, st.st_mtime_ns]
+
+    def save(self):
+        """Write cache to disk, replacing the previous cache file atomically."""
+        import json
+
+        tmp_path = self.path + '.tmp'
+
+        with open(tmp_path, 'w', encoding='utf-8') as fp:
+            json.dump({'version': self.version, 'entries': self.entries}, fp)
+
+        os.replace(tmp_path, self.path)
+
+
+def _write_output(output, fn, data, force=False, cache=None, kind='FXP',
+                  stats=None, link=None):
+    """Write data to output file, unless it exists or is unchanged.
+
+    ``output`` is the ``OutputDir`` or ``ArchiveWriter`` instance used to
+    write the file. If ``link`` is given, it is the name of an output file
+    with the same data written before and the output file is created as a
+    hard link to it.
+
+    Returns True if the file was written.
+
+    """
+    start = perf_counter()
+
+    if cache is not None:
+        if link is not None:
+            # a hard link holds the data of the file it links to
+            digest = cache.digest(link)
+        else:
+            import hashlib
+
+            digest = hashlib.sha1(data).hexdigest()
+
+        if cache.is_current(fn, digest):
+            return False
+    elif not force and output.exists(fn):
+        print("{} output file '{}' already exists. Skipping".format(kind, fn))
+        return False
+
+    if link is not None:
+        st = output.link(link, fn)
+    else:
+        st = output.write(fn, data)
+
+    if cache is not None:
+        cache.add(fn, digest, st)
+
+    if stats is not None:
+        stats.add('write files', perf_counter() - start, bytes=len(data),
+                  presets=1 if kind == 'FXP' else 0)
+
+    return True
+
+
+def run(args, cache=None, filenames=None):
+    """Run conversion with parsed command line arguments.
+
+    If ``args.update`` is set, a ``ConversionCache`` for the output directory
+    can be passed as ``cache``, otherwise it is loaded from disk.
+
+    A ``FilenameAllocator`` used by a previous run can be passed as
+    ``filenames``, so presets converted again keep their output file names
+    and do not take the names of presets from other input files.
+
+    If the output directory has the file name extension of a zip or tar
+    archive, the output files are written into an archive at that path
+    instead.
+
+    Returns None on success or an error message or exit status.
+
+    """
+    output_dir = args.output_dir or os.getcwd()
+    jobs = args.jobs or os.cpu_count() or 1
+
+    if is_archive(output_dir):
+        if exists(output_dir) and not args.force:
+            return "Output archive '{}' already exists.".format(output_dir)
+
+        output = ArchiveWriter(output_dir, sync=args.sync)
+    else:
+        if cache is None and args.update:
+            cache = ConversionCache(output_dir)
+
+        output = OutputDir(output_dir, sync=args.sync)
+
+    stats = Stats() if args.stats else None
+    dedup = DedupIndex() if args.dedup else None
+    preset_filter = PresetFilter.from_args(args)
+    if filenames is None:
+        filenames = FilenameAllocator()
+
+    # (input file, plugin ID, label) -> number of presets seen
+    occurrences = {}
+    # payload digest -> name of output file, for --dedup=link
+    links = {}
+    banks = {}
+
+    # Discovery of input files, conversion and writing of output files run
+    # concurrently as a pipeline, connected by bounded queues.
+    infiles = chain(
+        args.infiles,
+        *(find_files(path, PRESETFILE_PATTERNS) for path in args.recursive))
+
+    if preset_filter is not None:
+        # skip Ardour preset files for other plugins without reading them
+        infiles = filter(preset_filter.accepts_file, infiles)
+
+    # each item holds the data of a whole FXP file
+    results = iter_threaded(_flatten_results(
+        convert_files(iter_threaded(infiles), args.fx_version, jobs, stats,
+                      args.verify, preset_filter)), PIPELINE_DATA_QUEUE_SIZE)
+
+    # output is only finished, if the conversion ran through
+    completed = False
+
+    try:
+        num_presets = 0
+        num_selected = 0
+        num_mismatches = 0
+        num_chunk_presets = 0
+
+        for infile, item in results:
+            if item is None:
+                # with a filter, files without matching presets are expected
+                if not num_presets and preset_filter is None:
+                    return "No valid presets found in input file(s)."
+
+                num_presets = 0
+                continue
+
+            plugin_id, label, data, mismatch = item
+            num_presets += 1
+            num_selected += 1
+
+            if mismatch is not None:
+                print("Verification failed for preset '{}' in '{}': {}"
+                      .format(label, infile, mismatch))
+                num_mismatches += 1
+
+            if dedup is not None:
+                start = perf_counter()
+                digest = program_digest(data)
+                first = dedup.add(digest, infile, label)
+
+                if stats is not None:
+                    stats.add('dedup', perf_counter() - start,
+                              bytes=len(data), presets=1)
+
+                if first is not None and args.dedup == 'skip':
+                    continue
+
+            if args.bank:
+                # program type from the FXP header
+                if bytes(data[8:12]) == FX_MAGIC_CHUNK:
+                    print("Chunk preset '{}' in '{}' can not be stored in an "
+                          "FXB bank. Skipping.".format(label, infile))
+                    num_chunk_presets += 1
+                else:
+                    banks.setdefault(plugin_id, []).append(data)
+
+                continue
+
+            key = (abspath(infile), plugin_id, label)
+            num = occurrences[key] = occurrences.get(key, 0) + 1
+            fxp_fn = filenames.allocate(
+                join(output_dir, plugin_id2fn(plugin_id)), label, '.fxp',
+                key + (num,))
+
+            link = links.get(digest) if args.dedup == 'link' else None
+
+            written = _write_output(output, fxp_fn, data, args.force, cache,
+                                    stats=stats, link=link)
+
+            if link is None and args.dedup == 'link' and (
+                    written or cache is not None):
+                links[digest] = fxp_fn
+
+        for plugin_id, programs in banks.items():
+            fxb_fn = filenames.allocate(output_dir, plugin_id2fn(plugin_id),
+                                        '.fxb', plugin_id)
+            start = perf_counter()
+            data = pack_fxb(plugin_id, programs, args.fx_version)
+
+            if stats is not None:
+                stats.add('pack fxb', perf_counter() - start, bytes=len(data),
+                          presets=len(programs))
+
+            _write_output(output, fxb_fn, data, args.force, cache, kind='FXB',
+                          stats=stats)
+
+        if dedup is not None:
+            print("Found {:d} duplicate preset(s).".format(
+                dedup.num_duplicates))
+
+        if preset_filter is not None and not num_selected:
+            return "No presets matching the filter(s) found in input file(s)."
+
+        completed = True
+
+        if num_mismatches:
+            return ("Round trip verification failed for {:d} preset(s)."
+                    .format(num_mismatches))
+
+        if num_chunk_presets:
+            return ("Skipped {:d} chunk preset(s), which can not be stored in "
+                    "FXB banks.".format(num_chunk_presets))
+    except ConversionError as exc:
+        return str(exc)
+    finally:
+        results.close()
+
+        start = perf_counter()
+
+        if completed:
+            output.close()
+        else:
+            output.abort()
+
+        if stats is not None and args.sync:
+            stats.add('sync files', perf_counter() - start)
+
+        if cache is not None and isdir(output_dir):
+            cache.save()
+
+        if stats is not None:
+            print(stats.report(args.stats), file=sys.stderr)
+
+
+def watch(args):
+    """Convert input files and convert them again whenever they change.
+
+    Implies ``args.update``, so only output files of presets, which actually
+    changed, are written again. Only changed input files are converted again.
+    Changes in quick succession are converted together after they stopped for
+    ``WATCH_DEBOUNCE`` seconds. Output file names are kept across runs, so a
+    preset converted again does not take the name of a preset with the same
+    label from another input file. Runs until interrupted.
+
+    """
+    import copy
+    from vstpreset.watch import iter_changes, make_watcher
+
+    args.update = True
+    cache = ConversionCache(args.output_dir or os.getcwd())
+    filenames = FilenameAllocator()
+    # start watching before the first conversion, so no change is missed
+    watcher = make_watcher(args.infiles, args.recursive, PRESETFILE_PATTERNS)
+
+    try:
+        ret = run(args, cache, filenames)
+        if ret is not None:
+            print(ret)
+
+        print("Watching for changes in input files. Press Ctrl-C to stop.")
+
+        for infiles in iter_changes(watcher):
+            changed_args = copy.copy(args)
+            changed_args.infiles = infiles
+            changed_args.recursive = []
+            print("Converting changed file(s): {}".format(", ".join(infiles)))
+            ret = run(changed_args, cache, filenames)
+            if ret is not None:
+                print(ret)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+
+
+def make_argparser():
+    """Return command line argument parser."""
+    import argparse
 
-def main(args=None):
     argparser = argparse.ArgumentParser()
     argparser.add_argument('-v', '--fx-version', type=int,
                            help="VST plugin version number")
+    argparser.add_argument('-b', '--bank', action="store_true",
+                           help="Write all presets for a plugin into a "
+                                "single FXB bank file")
+    argparser.add_argument('-d', '--dedup', choices=('report', 'skip', 'link'),
+                           help="Report presets with the same parameters or "
+                                "chunk data as a preceding preset for the same "
+                                "plugin and optionally skip them or create "
+                                "their output files as hard links to the file "
+                                "of the first preset")
     argparser.add_argument('-f', '--force', action="store_true",
                            help="Overwrite existing destination file(s)")
+    argparser.add_argument('-j', '--jobs', type=int, default=1, metavar='N',
+                           help="Convert input files in N parallel processes "
+                                "(0 = number of CPUs, default: %(default)s)")
+    argparser.add_argument('-l', '--label', metavar='PATTERN',
+                           help="Only convert presets whose label matches the "
+                                "shell-style PATTERN (case-insensitive)")
     argparser.add_argument('-o', '--output-dir',
-                           help="Ardour presets output directory")
+                           help="FXP/FXB files output directory or zip/tar "
+                                "archive (*.zip, *.tar, *.tar.gz, *.tar.bz2, "
+                                "*.tar.xz)")
+    argparser.add_argument('-p', '--plugin-id', action='append',
+                           type=parse_plugin_id, metavar='ID',
+                           help="Only convert presets for the plugin with the "
+                                "given ID (four characters or integer, may be "
+                                "given more than once)")
+    argparser.add_argument('-r', '--recursive', action='append', default=[],
+                           metavar='DIR',
+                           help="Convert all Ardour VST presets files found "
+                                "in DIR and its sub-directories (may be given "
+                                "more than once)")
+    argparser.add_argument('-t', '--type', choices=('Preset', 'ChunkPreset'),
+                           help="Only convert presets of the given type")
+    argparser.add_argument('-u', '--update', action="store_true",
+                           help="Only (over)write output files whose content "
+                                "changed since the last run with this option")
+    argparser.add_argument('-s', '--sync', action="store_true",
+                           help="Flush all written files to disk before "
+                                "exiting")
+    argparser.add_argument('-w', '--watch', action="store_true",
+                           help="Keep running and convert input files again "
+                                "when they change (implies --update)")
+    argparser.add_argument('--label-regex', metavar='REGEX',
+                           help="Only convert presets whose label contains a "
+                                "match for the regular expression REGEX")
+    argparser.add_argument('--profile', metavar='FILE',
+                           help="Profile the conversion with cProfile and "
+                                "write profile data to FILE")
+    argparser.add_argument('--stats', nargs='?', const='text',
+                           choices=('text', 'json'),
+                           help="Print timing and throughput statistics per "
+                                "conversion stage to stderr as text "
+                                "(default) or JSON")
+    argparser.add_argument('--verify', action="store_true",
+                           help="Check that each converted preset converts "
+                                "back to Ardour XML unchanged and report "
+                                "presets which do not")
     argparser.add_argument('infiles', nargs='*', metavar='XML',
                            help="Ardour VST presets XML (input) file(s)")
 
-    args = argparser.parse_args(args)
-    output_dir = args.output_dir or os.getcwd()
+    return argparser
 
-    if not args.infiles:
+
+def run_command(argparser, args):
+    """Run conversion with arguments parsed by ``argparser``.
+
+    Returns None on success or an error message or exit status.
+
+    """
+    if not args.infiles and not args.recursive:
         argparser.print_help()
         return 2
 
-    for infile in args.infiles:
-        try:
-            root_node = ET.parse(infile).getroot()
-            presets = parse_ardourpresets(root_node)
-        except Exception as exc:
-            return "Error reading Ardour preset file '{}': {}".format(
-                infile, exc)
-
-        if not presets:
-            return "No valid presets found in input file(s)."
-
-        for preset in presets:
-            plugin_id = pack('>I', preset.plugin_id).decode('ascii')
-            dstdir = join(output_dir, plugin_id)
-            if not isdir(dstdir):
-                os.makedirs(dstdir)
-
-            fxp_fn = join(dstdir, label2fn(preset.label)) + '.fxp'
-            if exists(fxp_fn) and not args.force:
-                print("FXP output file '{}' already exists. Skipping".format(
-                      fxp_fn))
-                continue
+    if (args.update or args.watch) and is_archive(args.output_dir or ''):
+        return ("Options --update and --watch can not be used with archive "
+                "output.")
 
-            with open(fxp_fn, 'wb') as fp:
-                if args.fx_version is not None:
-                    fx_version = args.fx_version
-                elif preset.plugin_version is not None:
-                    fx_version = preset.plugin_version
-                else:
-                    fx_version = FX_DEFAULT_VERSION
-
-                if isinstance(preset, Preset):
-                    if preset.num_params is None:
-                        num_params = len(preset.params)
-                    else:
-                        num_params = preset.num_params
-
-                    params_fmt = '>{:d}f'.format(num_params)
-                    size = (FXP_HEADER_SIZE - FXP_PREAMBEL_SIZE +
-                            calcsize(params_fmt))
-                    fx_magic = FX_MAGIC_PARAMS
-                elif isinstance(preset, ChunkPreset):
-                    if preset.num_params is None:
-                        num_params = int(len(preset.chunk) / 4)
-                    else:
-                        num_params = preset.num_params
-
-                    chunk_len = len(preset.chunk)
-                    chunk_size = pack('>i', chunk_len)
-                    size = (FXP_HEADER_SIZE - FXP_PREAMBEL_SIZE +
-                            len(chunk_size) + chunk_len)
-                    fx_magic = FX_MAGIC_CHUNK
-                else:
-                    raise TypeError("Wrong preset type: {!r}".format(preset))
-
-                header = pack(
-                    FXP_HEADER_FMT,
-                    CHUNK_MAGIC,
-                    size,
-                    fx_magic,
-                    FXP_FORMAT_VERSION,
-                    preset.plugin_id,
-                    fx_version,
-                    num_params,
-                    preset.label.encode('latin1', errors='replace')
-                )
-                fp.write(header)
-
-                if isinstance(preset, Preset):
-                    data = pack(params_fmt, *preset.params)
-                    fp.write(data)
-                elif isinstance(preset, ChunkPreset):
-                    fp.write(chunk_size)
-                    fp.write(preset.chunk)
+    if args.dedup == 'link' and (args.bank or
+                                 is_archive(args.output_dir or '')):
+        return ("Option --dedup=link can not be used with bank or archive "
+                "output.")
+
+    if args.watch:
+        return watch(args)
+    elif args.profile:
+        return profile(run, args, filename=args.profile)
+    else:
+        return run(args)
+
+
+def main(args=None):
+    # watch mode runs until interrupted, so never run it in the server
+    if args is None and not {'-w', '--watch'}.intersection(sys.argv[1:]):
+        # forward command line to the conversion server, if it is running
+        status = call_server('ardour2fxp', sys.argv[1:])
+        if status is not None:
+            return status or None
+
+    argparser = make_argparser()
+    return run_command(argparser, argparser.parse_args(args))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,350 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# bench.py
+#
+"""Benchmark suite for the ardour2fxp and fxp2ardour converters.
+
+Generates synthetic preset datasets in a temporary directory, times the
+parsing functions and both command line entry points on them and reports
+throughput in presets/s and MB/s and the peak resident set size (RSS) of each
+benchmark.
+
+The ``*.startup`` benchmarks run each script once per input file in a new
+interpreter, like a file manager hook would, so they are dominated by the
+cold start time of the interpreter and the imports of the scripts.
+
+Each benchmark runs in a freshly spawned process, so peak RSS figures are not
+influenced by earlier benchmarks.
+
+Results can be saved as JSON with ``--json`` and compared against such a
+baseline with ``--compare``. The comparison fails (exit status 1) if the
+throughput of any benchmark dropped by more than the given tolerance.
+
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from base64 import b64encode
+from os.path import abspath, dirname, getsize, join
+from xml.etree import ElementTree as ET
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+import ardour2fxp  # noqa: E402
+import fxp2ardour  # noqa: E402
+from vstpreset.ardour import (iter_ardourpresets,  # noqa: E402
+                              parse_ardourpresets)
+from vstpreset.fxp import parse_fxp, parse_presetfile  # noqa: E402
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+# name: (number of files, presets per file, params per preset, chunk size)
+# A chunk size of zero means parameter presets, otherwise chunk presets.
+DATASETS = {
+    'small-params': (50, 40, 64, 0),
+    'huge-chunks': (2, 2, 128, 8 * 1024 * 1024),
+    'mixed': (40, 20, 256, 16 * 1024),
+}
+PLUGIN_IDS = (0x4F58464D, 0x4D44416A, 0x576E5031, 0x41424344)
+# maximum number of input files for the startup benchmarks
+STARTUP_FILES = 20
+
+
+def generate_dataset(path, name, scale=1.0, seed=0):
+    """Generate Ardour preset files and FXP files for dataset in path.
+
+    Returns ``(xml_files, fxp_files)`` tuple of lists of file names.
+
+    """
+    num_files, num_presets, num_params, chunk_size = DATASETS[name]
+    num_files = max(1, int(num_files * scale))
+    chunk_size = int(chunk_size * scale)
+    rnd = random.Random(seed)
+    xml_dir = join(path, name, 'ardour')
+    fxp_dir = join(path, name, 'fxp')
+    os.makedirs(xml_dir)
+    xml_files = []
+
+    for i in range(num_files):
+        # keep all four bytes of the plugin ID printable ASCII characters
+        plugin_id = ((PLUGIN_IDS[i % len(PLUGIN_IDS)] & 0xFFFF0000) |
+                     (0x41 + i // 26 % 26) << 8 | (0x41 + i % 26))
+        root = ET.Element('VSTPresets')
+
+        for j in range(num_presets):
+            # mixed dataset alternates between parameter and chunk presets
+            chunk = chunk_size and (name != 'mixed' or j % 2)
+            node = ET.SubElement(root, 'ChunkPreset' if chunk else 'Preset')
+            node.set('uri', 'VST:{:010d}:x{:040x}'.format(plugin_id, j))
+            node.set('label', 'Preset {:d}'.format(j))
+            node.set('version', '1')
+            node.set('numParams', str(num_params))
+
+            if chunk:
+                node.text = b64encode(rnd.getrandbits(chunk_size * 8).to_bytes(
+                    chunk_size, 'little')).decode('ascii')
+            else:
+                for k in range(num_params):
+                    ET.SubElement(node, 'Parameter', index=str(k),
+                                  value=str(rnd.random()))
+
+        xml_fn = join(xml_dir, 'vst-{:010d}'.format(plugin_id))
+        ET.ElementTree(root).write(xml_fn, encoding='UTF-8',
+                                   xml_declaration=True)
+        xml_files.append(xml_fn)
+
+    ardour2fxp.main(['-o', fxp_dir] + xml_files)
+    fxp_files = [join(root, fn) for root, _, files in os.walk(fxp_dir)
+                 for fn in sorted(files)]
+    return xml_files, fxp_files
+
+
+def count_presets(infiles):
+    return sum(len(parse_presetfile(fn)) if fn.endswith(('.fxp', '.fxb'))
+               else sum(1 for _ in iter_ardourpresets(fn)) for fn in infiles)
+
+
+def bench_parse_ardourpresets(xml_files, fxp_files, tmpdir):
+    for fn in xml_files:
+        parse_ardourpresets(ET.parse(fn).getroot())
+    return xml_files
+
+
+def bench_iter_ardourpresets(xml_files, fxp_files, tmpdir):
+    for fn in xml_files:
+        for _ in iter_ardourpresets(fn):
+            pass
+    return xml_files
+
+
+def bench_parse_fxp(xml_files, fxp_files, tmpdir):
+    for fn in fxp_files:
+        parse_fxp(fn)
+    return fxp_files
+
+
+def bench_ardour2fxp_main(xml_files, fxp_files, tmpdir):
+    ret = ardour2fxp.main(['-f', '-o', join(tmpdir, 'out-fxp')] + xml_files)
+    assert ret is None, ret
+    return xml_files
+
+
+def bench_fxp2ardour_main(xml_files, fxp_files, tmpdir):
+    ret = fxp2ardour.main(['-f', '-o', join(tmpdir, 'out-ardour')] +
+                          fxp_files)
+    assert ret is None, ret
+    return fxp_files
+
+
+def _run_script(module, infiles, outdir):
+    for fn in infiles:
+        subprocess.run([sys.executable, module.__file__, '-f', '-o', outdir,
+                        fn], stdout=subprocess.DEVNULL, check=True)
+    return infiles
+
+
+def bench_ardour2fxp_startup(xml_files, fxp_files, tmpdir):
+    return _run_script(ardour2fxp, xml_files[:STARTUP_FILES],
+                       join(tmpdir, 'startup-fxp'))
+
+
+def bench_fxp2ardour_startup(xml_files, fxp_files, tmpdir):
+    return _run_script(fxp2ardour, fxp_files[:STARTUP_FILES],
+                       join(tmpdir, 'startup-ardour'))
+
+
+BENCHMARKS = {
+    'parse_ardourpresets': bench_parse_ardourpresets,
+    'iter_ardourpresets': bench_iter_ardourpresets,
+    'parse_fxp': bench_parse_fxp,
+    'ardour2fxp.main': bench_ardour2fxp_main,
+    'fxp2ardour.main': bench_fxp2ardour_main,
+    'ardour2fxp.startup': bench_ardour2fxp_startup,
+    'fxp2ardour.startup': bench_fxp2ardour_startup,
+}
+
+
+def peak_rss():
+    """Return peak resident set size of this process in bytes or None."""
+    # On Linux, ru_maxrss is inherited across exec, so prefer VmHWM, which
+    # only reflects the memory usage of the current process image.
+    try:
+        with open('/proc/self/status') as fp:
+            for line in fp:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+
+    if resource is None:
+        return None
+
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS, in kilobytes elsewhere
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+def _run_benchmark(conn, name, xml_files, fxp_files, tmpdir, repeat):
+    func = BENCHMARKS[name]
+    times = []
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        infiles = func(xml_files, fxp_files, tmpdir)
+        times.append(time.perf_counter() - start)
+
+    conn.send((min(times), infiles, peak_rss()))
+    conn.close()
+
+
+def run_benchmark(name, xml_files, fxp_files, tmpdir, repeat=3):
+    """Run benchmark in a new process.
+
+    Returns tuple of best time in seconds, list of input files and peak RSS
+    (of the benchmark process only, not of any processes started by it).
+
+    """
+    ctx = multiprocessing.get_context('spawn')
+    recv_conn, send_conn = ctx.Pipe(duplex=False)
+    proc = ctx.Process(target=_run_benchmark,
+                       args=(send_conn, name, xml_files, fxp_files, tmpdir,
+                             repeat))
+    proc.start()
+    send_conn.close()
+    result = recv_conn.recv()
+    proc.join()
+    return result
+
+
+def run(datasets, benchmarks, scale=1.0, repeat=3):
+    """Run benchmarks on datasets and return list of result dicts."""
+    results = []
+    tmpdir = tempfile.mkdtemp(prefix='ardour2fxp-bench-')
+
+    try:
+        for dataset in datasets:
+            xml_files, fxp_files = generate_dataset(tmpdir, dataset, scale)
+
+            for name in benchmarks:
+                seconds, infiles, rss = run_benchmark(
+                    name, xml_files, fxp_files, join(tmpdir, dataset),
+                    repeat)
+                num_presets = count_presets(infiles)
+                size = sum(getsize(fn) for fn in infiles)
+                results.append({
+                    'dataset': dataset,
+                    'benchmark': name,
+                    'presets': num_presets,
+                    'bytes': size,
+                    'seconds': seconds,
+                    'presets_per_sec': num_presets / seconds,
+                    'mb_per_sec': size / seconds / 1e6,
+                    'peak_rss': rss,
+                })
+                print_result(results[-1])
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    return results
+
+
+def print_result(result):
+    rss = result['peak_rss']
+    print("{dataset:<14} {benchmark:<21} {presets:>6d} presets "
+          "{seconds:8.3f} s {presets_per_sec:10.1f} presets/s "
+          "{mb_per_sec:8.2f} MB/s  peak RSS {rss}".format(
+              rss='{:.1f} MB'.format(rss / 1e6) if rss else 'n/a', **result))
+
+
+def compare(results, baseline, tolerance):
+    """Compare results against baseline results.
+
+    Returns list of messages about benchmarks whose throughput dropped by
+    more than ``tolerance`` (a fraction) compared to the baseline.
+
+    """
+    base = {(r['dataset'], r['benchmark']): r for r in baseline['results']}
+    regressions = []
+
+    for result in results:
+        ref = base.get((result['dataset'], result['benchmark']))
+        if ref is None:
+            continue
+
+        ratio = result['presets_per_sec'] / ref['presets_per_sec']
+        if ratio < 1.0 - tolerance:
+            regressions.append(
+                "{dataset} / {benchmark}: {0:.1f} presets/s, baseline "
+                "{1:.1f} presets/s ({2:+.1%})".format(
+                    result['presets_per_sec'], ref['presets_per_sec'],
+                    ratio - 1.0, **result))
+
+    return regressions
+
+
+def main(args=None):
+    argparser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    argparser.add_argument('-b', '--benchmark', action='append',
+                           choices=sorted(BENCHMARKS),
+                           help="Run only given benchmark (may be given more "
+                                "than once)")
+    argparser.add_argument('-c', '--compare', metavar='JSON',
+                           help="Compare results against baseline JSON file")
+    argparser.add_argument('-d', '--dataset', action='append',
+                           choices=sorted(DATASETS),
+                           help="Use only given dataset (may be given more "
+                                "than once)")
+    argparser.add_argument('-j', '--json', metavar='FILE',
+                           help="Write results as JSON to FILE")
+    argparser.add_argument('-n', '--repeat', type=int, default=3,
+                           help="Number of runs per benchmark, the best time "
+                                "is reported (default: %(default)s)")
+    argparser.add_argument('-s', '--scale', type=float, default=1.0,
+                           help="Scale factor for dataset sizes "
+                                "(default: %(default)s)")
+    argparser.add_argument('-t', '--tolerance', type=float, default=0.2,
+                           help="Allowed throughput drop as fraction when "
+                                "comparing against baseline "
+                                "(default: %(default)s)")
+
+    args = argparser.parse_args(args)
+    results = run(args.dataset or list(DATASETS),
+                  args.benchmark or list(BENCHMARKS),
+                  args.scale, args.repeat)
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as fp:
+            json.dump({'python': sys.version, 'platform': sys.platform,
+                       'scale': args.scale, 'results': results}, fp, indent=2)
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as fp:
+            baseline = json.load(fp)
+
+        if baseline.get('scale') != args.scale:
+            return "Baseline was recorded with a different dataset scale."
+
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print("\nPerformance regressions:")
+            for msg in regressions:
+                print("  " + msg)
+            return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main() or 0)
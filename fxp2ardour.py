@@ -3,85 +3,255 @@
 #
 # fxp2ardour.py
 #
-"""Convert one or more VST2 FXP preset files to Ardour VST presets XML files.
+"""Convert one or more VST2 FXP preset or FXB bank files to Ardour VST presets
+XML files.
 """
 
-import argparse
-import hashlib
 import os
 import sys
 
-from base64 import b64encode
-from collections import namedtuple
-from os.path import exists, isdir, join
-from struct import calcsize, unpack
-from xml.etree import ElementTree as ET
+from collections import deque
+from functools import partial
+from itertools import chain
+from os.path import exists, getsize, isdir, join
+from time import perf_counter
 
+from vstpreset.archive import ArchiveMember, is_archive, iter_archive
+from vstpreset.ardour import PresetFileError, write_presetfile
+from vstpreset.core import FX_DEFAULT_VERSION, preset_digest
+from vstpreset.fxp import (FXP_PEEK_SIZE, FXPParseException, parse_presetfile,
+                           peek_presetinfo, read_fxp)
+from vstpreset.client import call_server
+from vstpreset.util import (PIPELINE_DATA_QUEUE_SIZE, ConversionError,
+                            DedupIndex, PresetFilter, Stats, find_files,
+                            iter_threaded, parse_plugin_id, profile)
 
-FXP_HEADER_FMT = '>4si4s4i28s'
-FXP_PREAMBEL_SIZE = calcsize('>4si')
-FXP_HEADER_SIZE = calcsize(FXP_HEADER_FMT)
-FXP_FORMAT_VERSION = 1
-CHUNK_MAGIC = b'CcnK'
-FX_MAGIC_PARAMS = b'FxCk'
-FX_MAGIC_CHUNK = b'FPCh'
-FX_DEFAULT_VERSION = 1
-PRESET_BASE_FIELDS = (
-    'type',
-    'plugin_id',
-    'plugin_version',
-    'hash',
-    'label',
-    'num_params',
-)
 
-ChunkPreset = namedtuple('ChunkPreset', PRESET_BASE_FIELDS + ('chunk',))
-Preset = namedtuple('Preset', PRESET_BASE_FIELDS + ('params',))
-FXPHeader = namedtuple(
-    'FXPHeader',
-    ('magic', 'size', 'type', 'version', 'plugin_id', 'plugin_version',
-     'num_params', 'label')
-)
+PRESETFILE_PATTERNS = ('*.fxp', '*.fxb')
 
 
-class FXPParseException(Exception):
-    """Raised when there is an error parsing FXP file data."""
+def _select_member(preset_filter, name, head):
+    try:
+        info = peek_presetinfo(head)
+    except FXPParseException:
+        # let the parser report the error
+        return True
 
+    # banks may contain presets for any plugin
+    return info is None or preset_filter(info.type, info.plugin_id,
+                                         info.label)
 
-def parse_fxp(fn):
-    """Parse VST2 FXP preset file.
 
-    Returns list of Preset or ChunkPreset instances.
+def iter_inputs(infiles, preset_filter=None):
+    """Yield file names in ``infiles`` and preset files in archives.
+
+    Archives in ``infiles`` (recognized by their file name extension) are
+    replaced by an ``ArchiveMember`` for each FXP and FXB file in them.
+
+    If a ``PresetFilter`` is given as ``preset_filter``, FXP files in
+    archives, whose header does not match it, are skipped without reading
+    the rest of their data.
 
     """
-    with open(fn, 'rb') as fp:
-        fxp = FXPHeader(*unpack(FXP_HEADER_FMT, fp.read(FXP_HEADER_SIZE)))
-        if fxp.magic != CHUNK_MAGIC:
-            raise FXPParseException("Invalid magic header bytes for FXP file.")
-        label = fxp.label.rstrip(b'\0').decode('latin1')
-
-        if fxp.type == FX_MAGIC_PARAMS:
-            params_fmt = '>{:d}f'.format(fxp.num_params)
-            params = unpack(params_fmt, fp.read(calcsize(params_fmt)))
-            preset = Preset('VST', fxp.plugin_id, fxp.plugin_version,
-                            None, label, fxp.num_params, params)
-        elif fxp.type == FX_MAGIC_CHUNK:
-            chunk_size = unpack('>i', fp.read(calcsize('>i')))[0]
-            chunk = fp.read(chunk_size)
-            if len(chunk) != chunk_size:
-                raise FXPParseException(
-                    "Program chunk data truncated, expected {:d} bytes, "
-                    "read {:d}.".format(chunk_size, len(chunk)))
-            preset = ChunkPreset('VST', fxp.plugin_id, fxp.plugin_version,
-                                 None, label, fxp.num_params, chunk)
+    select = None
+
+    if preset_filter is not None:
+        select = partial(_select_member, preset_filter)
+
+    for infile in infiles:
+        if is_archive(infile):
+            try:
+                yield from iter_archive(infile, PRESETFILE_PATTERNS, select,
+                                        FXP_PEEK_SIZE)
+            except Exception as exc:
+                raise ConversionError("Error reading archive '{}': {}"
+                                      .format(infile, exc)) from exc
         else:
-            raise FXPParseException("Invalid program type magic bytes. Type "
-                                    "'{}' not supported.".format(fxp.type))
+            yield infile
 
-    return preset
 
+def parse_input(infile, select=None):
+    """Parse FXP/FXB file given by name or as ``ArchiveMember``.
+
+    Returns list of presets as returned by ``parse_presetfile``. See
+    ``vstpreset.fxp.parse_buffer`` for the meaning of ``select``.
+
+    """
+    if isinstance(infile, ArchiveMember):
+        return read_fxp(infile.data, select)
+
+    return parse_presetfile(infile, select)
+
+
+def _parse_input_stats(infile, select=None):
+    start = perf_counter()
+    presets = parse_input(infile, select)
+    size = (len(infile.data) if isinstance(infile, ArchiveMember)
+            else getsize(infile))
+    return presets, perf_counter() - start, size
+
+
+def parse_files(infiles, pool=None, jobs=1, stats=None, select=None):
+    """Parse VST2 FXP preset or FXB bank files.
+
+    ``infiles`` can be any iterable of file names or ``ArchiveMember``
+    instances, which is consumed lazily. Yields ``(name, presets)`` tuples in
+    the order of ``infiles``, where ``presets`` is a list as returned by
+    ``parse_presetfile``.
+
+    If a ``ProcessPoolExecutor`` is given as ``pool``, files are parsed in the
+    pool's worker processes, with up to two files per each of ``jobs``
+    workers submitted in advance.
+
+    Errors reading an input file are raised as ``ConversionError``.
+
+    If a ``Stats`` instance is passed as ``stats``, the time spent on reading
+    files is recorded in it.
+
+    Only presets selected by ``select`` are returned, see
+    ``vstpreset.fxp.parse_buffer``. It must be picklable, if ``pool`` is
+    given.
+
+    """
+    parse = parse_input if stats is None else _parse_input_stats
+
+    def result(infile, func, *args):
+        if isinstance(infile, ArchiveMember):
+            infile = infile.name
+
+        try:
+            presets = func(*args)
+        except Exception as exc:
+            raise ConversionError("Error reading FXP preset file '{}': {}"
+                                  .format(infile, exc)) from exc
+
+        if stats is not None:
+            presets, seconds, size = presets
+            stats.add('read fxp', seconds, bytes=size, presets=len(presets))
+
+        return infile, presets
+
+    if pool is None:
+        for infile in infiles:
+            yield result(infile, parse, infile, select)
+        return
+
+    pending = deque()
+    for infile in infiles:
+        pending.append((infile, pool.submit(parse, infile, select)))
+
+        if len(pending) > jobs * 2:
+            infile, future = pending.popleft()
+            yield result(infile, future.result)
+
+    while pending:
+        infile, future = pending.popleft()
+        yield result(infile, future.result)
+
+
+def _write_presetfile_stats(*args):
+    stats = Stats()
+    write_presetfile(*args, stats=stats)
+    return stats.stages
+
+
+def run(args):
+    """Run conversion with parsed command line arguments.
+
+    Returns None on success or an error message or exit status.
+
+    """
+    output_dir = args.output_dir or os.getcwd()
+    jobs = args.jobs or os.cpu_count() or 1
+    pool = None
+    stats = Stats() if args.stats else None
+    dedup = DedupIndex() if args.dedup else None
+    preset_filter = PresetFilter.from_args(args)
+
+    if jobs > 1:
+        from concurrent.futures import ProcessPoolExecutor
+
+        pool = ProcessPoolExecutor(jobs)
+
+    # Discovery and parsing of input files run concurrently as a pipeline,
+    # connected by bounded queues. Archive members and parsed files carry
+    # their data, so only a few of them are queued.
+    infiles = iter_threaded(iter_inputs(chain(
+        args.infiles,
+        *(find_files(path, PRESETFILE_PATTERNS) for path in args.recursive)),
+        preset_filter), PIPELINE_DATA_QUEUE_SIZE)
+    results = iter_threaded(parse_files(infiles, pool, jobs, stats,
+                                        preset_filter),
+                            PIPELINE_DATA_QUEUE_SIZE)
+
+    try:
+        # Reduce parsed presets in input order, so the order of presets per
+        # plugin does not depend on which worker finished first.
+        presets = {}
+        for infile, file_presets in results:
+            for preset in file_presets:
+                if dedup is not None:
+                    start = perf_counter()
+                    first = dedup.add(preset_digest(preset), infile,
+                                      preset.label)
+
+                    if stats is not None:
+                        stats.add('dedup', perf_counter() - start, presets=1)
+
+                    if first is not None and args.dedup == 'skip':
+                        continue
+
+                presets.setdefault(preset.plugin_id, []).append(preset)
+
+        if dedup is not None:
+            print("Found {:d} duplicate preset(s).".format(
+                dedup.num_duplicates))
+
+        if preset_filter is not None and not presets:
+            return "No presets matching the filter(s) found in input file(s)."
+
+        if presets and not isdir(output_dir):
+            os.makedirs(output_dir)
+
+        tasks = []
+        for plugin in presets:
+            xml_fn = join(output_dir, 'vst-{:010d}'.format(plugin))
+            if exists(xml_fn) and not any((args.append, args.force,
+                                           args.merge)):
+                print("Ardour VST preset file '{}' already exists. "
+                      "Skipping output.".format(xml_fn))
+                continue
+
+            task_args = (xml_fn, plugin, presets[plugin], args.append,
+                         args.merge)
+            if pool and stats is not None:
+                tasks.append(pool.submit(_write_presetfile_stats, *task_args))
+            elif pool:
+                tasks.append(pool.submit(write_presetfile, *task_args))
+            else:
+                write_presetfile(*task_args, stats=stats)
+
+        for task in tasks:
+            stages = task.result()
+
+            if stats is not None:
+                stats.update(stages)
+    except (ConversionError, PresetFileError) as exc:
+        return str(exc)
+    finally:
+        results.close()
+
+        if pool:
+            pool.shutdown()
+
+        if stats is not None:
+            print(stats.report(args.stats), file=sys.stderr)
+
+
+def make_argparser():
+    """Return command line argument parser."""
+    import argparse
 
-def main(args=None):
     argparser = argparse.ArgumentParser()
     argparser.add_argument('-v', '--fx-version', type=int,
                            default=FX_DEFAULT_VERSION,
@@ -89,8 +259,18 @@ def main(args=None):
     argparser.add_argument('-a', '--append', action="store_true",
                            help="Append presets to existing Ardour preset "
                                 "file(s), if applicable")
+    argparser.add_argument('-d', '--dedup', choices=('report', 'skip'),
+                           help="Report presets with the same parameters or "
+                                "chunk data as a preceding preset for the same "
+                                "plugin and optionally skip them")
     argparser.add_argument('-f', '--force', action="store_true",
                            help="Overwrite existing destination file(s)")
+    argparser.add_argument('-j', '--jobs', type=int, default=1, metavar='N',
+                           help="Convert input files in N parallel processes "
+                                "(0 = number of CPUs, default: %(default)s)")
+    argparser.add_argument('-l', '--label', metavar='PATTERN',
+                           help="Only convert presets whose label matches the "
+                                "shell-style PATTERN (case-insensitive)")
     argparser.add_argument('-m', '--merge', action="store_true",
                            help="Merge presets into existing Ardour preset "
                                 "file(s), if applicable. Existing presets with "
@@ -98,88 +278,61 @@ def main(args=None):
                                 "overwritten. USE WITH CARE!")
     argparser.add_argument('-o', '--output-dir',
                            help="Ardour presets output directory")
+    argparser.add_argument('-p', '--plugin-id', action='append',
+                           type=parse_plugin_id, metavar='ID',
+                           help="Only convert presets for the plugin with the "
+                                "given ID (four characters or integer, may be "
+                                "given more than once)")
+    argparser.add_argument('-r', '--recursive', action='append', default=[],
+                           metavar='DIR',
+                           help="Convert all FXP and FXB files found in DIR "
+                                "and its sub-directories (may be given more "
+                                "than once)")
+    argparser.add_argument('-t', '--type', choices=('Preset', 'ChunkPreset'),
+                           help="Only convert presets of the given type")
+    argparser.add_argument('--label-regex', metavar='REGEX',
+                           help="Only convert presets whose label contains a "
+                                "match for the regular expression REGEX")
+    argparser.add_argument('--profile', metavar='FILE',
+                           help="Profile the conversion with cProfile and "
+                                "write profile data to FILE")
+    argparser.add_argument('--stats', nargs='?', const='text',
+                           choices=('text', 'json'),
+                           help="Print timing and throughput statistics per "
+                                "conversion stage to stderr as text "
+                                "(default) or JSON")
     argparser.add_argument('infiles', nargs='*', metavar='FXP',
-                           help="FXP preset (input) file(s)")
+                           help="FXP preset or FXB bank (input) file(s) or "
+                                "zip/tar archive(s) containing them")
 
-    args = argparser.parse_args(args)
-    output_dir = args.output_dir or os.getcwd()
+    return argparser
 
-    if not args.infiles:
+
+def run_command(argparser, args):
+    """Run conversion with arguments parsed by ``argparser``.
+
+    Returns None on success or an error message or exit status.
+
+    """
+    if not args.infiles and not args.recursive:
         argparser.print_help()
         return 2
 
-    presets = {}
-    for infile in args.infiles:
-        try:
-            preset = parse_fxp(infile)
-        except Exception as exc:
-            return "Error reading FXP preset file '{}': {}".format(
-                    infile, exc)
-        else:
-            presets.setdefault(preset.plugin_id, []).append(preset)
+    if args.profile:
+        return profile(run, args, filename=args.profile)
+    else:
+        return run(args)
 
-    for plugin in presets:
-        if not isdir(output_dir):
-            os.makedirs(output_dir)
 
-        xml_fn = join(output_dir, 'vst-{:010d}'.format(plugin))
-        if exists(xml_fn) and not any((args.append, args.force, args.merge)):
-            print("Ardour VST preset file '{}' already exists. "
-                  "Skipping output.".format(xml_fn))
-            continue
-        elif args.append or args.merge:
-            try:
-                tree = ET.parse(xml_fn)
-                root = tree.getroot()
-                preset_nodes = {}
-                if root.tag != 'VSTPresets':
-                    raise ValueError("Root XML element must be 'VSTPresets'.")
-            except Exception as exc:
-                return ("Output file '{}' already exists, but does not seem to be an "
-                        "Ardour VST preset file. Cannot merge.\n{}".format(xml_fn, exc))
+def main(args=None):
+    if args is None:
+        # forward command line to the conversion server, if it is running
+        status = call_server('fxp2ardour', sys.argv[1:])
+        if status is not None:
+            return status or None
 
-            for node in root:
-                if node.tag in ('Preset', 'ChunkPreset'):
-                    preset_nodes.setdefault(node.get('label'), []).append(node)
-        else:
-            root = ET.Element('VSTPresets')
-            preset_nodes = {}
-
-        for i, preset in enumerate(presets[plugin]):
-            sha1 = hashlib.sha1()
-            sha1.update(bytes(preset.label, 'latin1'))
-            sha1.update(bytes(str(i), 'ascii'))
-            uri = '{}:{:010d}:x{}'.format('VST', plugin, sha1.hexdigest())
-            tag = 'Preset' if isinstance(preset, Preset) else 'ChunkPreset'
-
-            if args.merge and preset.label in preset_nodes:
-                # replace next existing preset with same label
-                pnode = preset_nodes[preset.label].pop(0)
-
-                # if no more presets with this label exist, remove the key
-                if not preset_nodes[preset.label]:
-                    del preset_nodes[preset.label]
-
-                pnode.clear()
-                pnode.tag = tag
-            else:
-                pnode = ET.SubElement(root, tag)
-
-            pnode.set('uri', uri)
-            pnode.set('label', preset.label)
-            pnode.set('version', str(preset.plugin_version))
-            pnode.set('numParams', str(preset.num_params))
-
-            if isinstance(preset, Preset):
-                for j, param in enumerate(preset.params):
-                    ET.SubElement(pnode, 'Parameter', index=str(j),
-                                  value=str(param))
-            elif isinstance(preset, ChunkPreset):
-                pnode.text = b64encode(preset.chunk).decode('ascii')
-
-        with open(xml_fn, 'wb') as fp:
-            doc = ET.ElementTree(root)
-            doc.write(fp, encoding='UTF-8', xml_declaration=True)
+    argparser = make_argparser()
+    return run_command(argparser, argparser.parse_args(args))
 
 
 if __name__ == '__main__':
@@ -24,7 +24,6 @@ Operating System :: Microsoft :: Windows
 Operating System :: POSIX :: Linux
 Programming Language :: Python
 Programming Language :: Python :: 3
-Programming Language :: Python :: 3.6
 Programming Language :: Python :: 3.7
 Programming Language :: Python :: 3.8
 Programming Language :: Python :: 3.9
@@ -41,12 +40,19 @@ setup(
     author="Christopher Arndt",
     author_email="info@chrisarndt.de",
     url="https://github.com/SpotlightKid/ardour2fxp",
+    packages=["vstpreset"],
     py_modules=["ardour2fxp", "fxp2ardour"],
+    python_requires=">=3.7",
     install_requires=[],
+    extras_require={
+        "numpy": ["numpy"],
+    },
     entry_points={
         "console_scripts": [
             "ardour2fxp = ardour2fxp:main",
-            "fxp2ardour = fxp2ardour:main"
+            "fxp2ardour = fxp2ardour:main",
+            "vstpreset-inventory = vstpreset.inventory:main",
+            "vstpreset-server = vstpreset.server:main"
         ]
     },
     classifiers=[c.strip() for c in classifiers.splitlines()
@@ -2,12 +2,25 @@
 """Tests for 'ardour2fxp' script."""
 
 import hashlib
+import json
 import os
+import pickle
+import shutil
+import tarfile
+import zipfile
 
 from os.path import dirname, join, exists
+from struct import unpack_from
 import pytest
 
-from ardour2fxp import main
+from xml.etree import ElementTree as ET
+
+from ardour2fxp import (ConversionCache, main, make_argparser, run,
+                        verify_fxpdata)
+from vstpreset.ardour import iter_ardourpresets, parse_ardourpresets
+from vstpreset.core import FXB_HEADER_FMT, FXB_HEADER_SIZE
+from vstpreset.fxp import pack_fxb, pack_fxp
+from vstpreset.util import FilenameAllocator
 
 TESTDATA_DIR = join(dirname(__file__), 'testdata')
 TESTOUTPUT_DIR = join(dirname(__file__), 'testoutput')
@@ -99,6 +112,410 @@ def test_parampreset_single(infn, plugin_id, label, sha1sum):
     assert sha1_digest(outfile) == sha1sum
 
 
+@pytest.mark.parametrize("infn", [
+    'vst-1331185229',
+    'vst-1331185229-single',
+    'vst-1466847281',
+])
+def test_iter_ardourpresets(infn):
+    """Incremental parsing yields the same presets as parsing the full
+       document."""
+    infile = join(TESTDATA_DIR, infn)
+    presets = parse_ardourpresets(ET.parse(infile).getroot())
+    result = list(iter_ardourpresets(infile))
+    assert result == presets
+    # presets are hashable
+    assert [hash(preset) for preset in result] == [
+        hash(preset) for preset in presets]
+
+
+@pytest.mark.parametrize("infn,sha1sum", [
+    ('vst-1331185229-single', 'de90b1b924d74877d85248c0d5f5339741277372'),
+    ('vst-1466847281', '1af7a14d82eb2d87be608126ea4716cd722b86d8'),
+])
+def test_pack_fxp(infn, sha1sum):
+    """Packing a preset in memory produces the same data as the FXP file
+       written by the script."""
+    preset = next(iter_ardourpresets(join(TESTDATA_DIR, infn)))
+    assert hashlib.sha1(pack_fxp(preset)).hexdigest() == sha1sum
+
+
+def test_preset_params():
+    """Parameters are stored in index order in an array and presets compare,
+       hash and pickle by value."""
+    root = ET.fromstring(
+        '<VSTPresets><Preset uri="VST:1331185229:x" label="Test" '
+        'version="1" numParams="3"><Parameter index="2" value="0.25"/>'
+        '<Parameter index="0" value="1"/><Parameter index="1" value="0.5"/>'
+        '</Preset></VSTPresets>')
+    preset = parse_ardourpresets(root)[0]
+    assert preset.params.typecode == 'f'
+    assert list(preset.params) == [1.0, 0.5, 0.25]
+
+    copy = pickle.loads(pickle.dumps(preset))
+    assert copy == preset
+    assert hash(copy) == hash(preset)
+    assert pack_fxp(copy) == pack_fxp(preset)
+    assert preset._replace(label='Other') != preset
+
+    with pytest.raises(ValueError):
+        pack_fxp(preset._replace(num_params=4))
+
+
+def test_parallel_jobs():
+    """Converting several files in parallel produces the same output as
+       converting them one after another."""
+    infiles = [join(TESTDATA_DIR, fn)
+               for fn in ('vst-1331185229', 'vst-1466847281')]
+    outdirs = [join(TESTOUTPUT_DIR, 'fxp-jobs', str(jobs)) for jobs in (1, 2)]
+
+    for jobs, outdir in zip((1, 2), outdirs):
+        shutil.rmtree(outdir, ignore_errors=True)
+        os.makedirs(outdir)
+        ret = main(["-j", str(jobs), "-o", outdir] + infiles)
+        assert ret is None
+
+    for plugin_id, label in (('OXFM', 'Kick'), ('OXFM', 'Snare'),
+                             ('OXFM', 'INIT'), ('WnP1', 'Drum_Reverb')):
+        outfiles = [join(outdir, plugin_id, label + '.fxp')
+                    for outdir in outdirs]
+        assert sha1_digest(outfiles[0]) == sha1_digest(outfiles[1])
+
+
+@pytest.mark.parametrize("infn,plugin_id,names", [
+    ('vst-1466847281', 'WnP1', ('Drum_Reverb',)),
+])
+def test_bank(infn, plugin_id, names):
+    """Converting an ardour presets file in bank mode produces an FXB file
+       containing the FXP programs for all presets."""
+    infile = join(TESTDATA_DIR, infn)
+    outdir = join(TESTOUTPUT_DIR, 'fxb')
+    outfile = join(outdir, plugin_id + '.fxb')
+    shutil.rmtree(outdir, ignore_errors=True)
+
+    ret = main(["-b", "-o", outdir, infile])
+    assert ret is None
+    assert exists(outfile)
+
+    ret = main(["-o", outdir, infile])
+    assert ret is None
+
+    with open(outfile, 'rb') as fp:
+        data = fp.read()
+
+    header = unpack_from(FXB_HEADER_FMT, data)
+    assert header[:3] == (b'CcnK', len(data) - 8, b'FxBk')
+    assert header[6] == len(names)
+
+    programs = b''
+    for name in names:
+        with open(join(outdir, plugin_id, name + '.fxp'), 'rb') as fp:
+            programs += fp.read()
+
+    assert data[FXB_HEADER_SIZE:] == programs
+
+
+def test_bank_chunk_presets(capsys):
+    """Chunk presets can not be stored in regular FXB banks and are skipped
+       in bank mode."""
+    outdir = join(TESTOUTPUT_DIR, 'fxb-chunk')
+    shutil.rmtree(outdir, ignore_errors=True)
+
+    ret = main(["-b", "-o", outdir, join(TESTDATA_DIR, 'vst-1331185229'),
+                join(TESTDATA_DIR, 'vst-1466847281')])
+    assert ret == ("Skipped 3 chunk preset(s), which can not be stored in FXB "
+                   "banks.")
+    assert "Chunk preset 'Kick'" in capsys.readouterr().out
+    assert os.listdir(outdir) == ['WnP1.fxb']
+
+    preset, = iter_ardourpresets(join(TESTDATA_DIR, 'vst-1331185229-single'))
+    with pytest.raises(ValueError):
+        pack_fxb(preset.plugin_id, [pack_fxp(preset)])
+
+
+def test_update():
+    """In update mode, only output files with changed content are written."""
+    infile = join(TESTDATA_DIR, 'vst-1331185229')
+    outdir = join(TESTOUTPUT_DIR, 'fxp-update')
+    outfiles = [join(outdir, 'OXFM', label + '.fxp')
+                for label in ('Kick', 'Snare', 'INIT')]
+    shutil.rmtree(outdir, ignore_errors=True)
+
+    assert main(["-u", "-o", outdir, infile]) is None
+    mtimes = [os.stat(fn).st_mtime_ns for fn in outfiles]
+
+    # unchanged presets are not rewritten
+    assert main(["-u", "-o", outdir, infile]) is None
+    assert [os.stat(fn).st_mtime_ns for fn in outfiles] == mtimes
+
+    # files changed since the last run are rewritten
+    with open(outfiles[1], 'ab') as fp:
+        fp.write(b'junk')
+
+    assert main(["-u", "-o", outdir, infile]) is None
+    assert sha1_digest(outfiles[1]) == '942ed7564580f3cc2b40d0a02abe74aa4e6b177f'
+
+    # a different plugin version changes the content of all files
+    assert main(["-u", "-v", "2", "-o", outdir, infile]) is None
+    assert all(sha1_digest(fn) != sha1sum for fn, sha1sum in zip(
+        outfiles, ('b9c493fb4bd05e6b2167a852fd230204d438748a',
+                   '942ed7564580f3cc2b40d0a02abe74aa4e6b177f',
+                   '045ca4bd1e9ca874e2f187ce15dbb7b856942eec')))
+
+
+def test_recursive():
+    """All Ardour preset files in a directory tree are converted."""
+    indir = join(TESTOUTPUT_DIR, 'ardour-tree')
+    outdir = join(TESTOUTPUT_DIR, 'fxp-tree')
+    shutil.rmtree(indir, ignore_errors=True)
+    shutil.rmtree(outdir, ignore_errors=True)
+    os.makedirs(join(indir, 'sub'))
+    shutil.copy(join(TESTDATA_DIR, 'vst-1331185229'), indir)
+    shutil.copy(join(TESTDATA_DIR, 'vst-1466847281'), join(indir, 'sub'))
+    shutil.copy(join(TESTDATA_DIR, 'MDAx_Harp_FxCk.fxp'), join(indir, 'sub'))
+    # symbolic links to directories are not followed
+    os.symlink(indir, join(indir, 'sub', 'loop'))
+
+    ret = main(["-r", indir, "-o", outdir])
+    assert ret is None
+
+    for plugin_id, label in (('OXFM', 'Kick'), ('OXFM', 'Snare'),
+                             ('OXFM', 'INIT'), ('WnP1', 'Drum_Reverb')):
+        assert exists(join(outdir, plugin_id, label + '.fxp'))
+
+
+@pytest.mark.parametrize("archive", ['presets.zip', 'presets.tar.gz'])
+def test_archive_output(archive):
+    """FXP files are written into a zip or tar archive."""
+    infile = join(TESTDATA_DIR, 'vst-1331185229-single')
+    outfile = join(TESTOUTPUT_DIR, archive)
+    if exists(outfile):
+        os.remove(outfile)
+
+    assert main(["-o", outfile, infile]) is None
+
+    if archive.endswith('.zip'):
+        with zipfile.ZipFile(outfile) as zf:
+            members = {name: zf.read(name) for name in zf.namelist()}
+    else:
+        with tarfile.open(outfile) as tf:
+            members = {info.name: tf.extractfile(info).read() for info in tf}
+
+    assert list(members) == ['OXFM/Nerf_Pluck.fxp']
+    assert (hashlib.sha1(members['OXFM/Nerf_Pluck.fxp']).hexdigest() ==
+            'de90b1b924d74877d85248c0d5f5339741277372')
+    assert "already exists" in main(["-o", outfile, infile])
+
+    # a failed conversion leaves an existing archive untouched
+    badfile = join(TESTOUTPUT_DIR, 'ardour-bad', 'vst-1331185229')
+    os.makedirs(dirname(badfile), exist_ok=True)
+    with open(badfile, 'w') as fp:
+        fp.write('<VSTPresets><ChunkPreset')
+
+    with open(outfile, 'rb') as fp:
+        data = fp.read()
+
+    inode = os.stat(outfile).st_ino
+    ret = main(["-f", "-o", outfile, infile, badfile])
+    assert ret.startswith("Error reading Ardour preset file")
+    assert os.stat(outfile).st_ino == inode
+
+    with open(outfile, 'rb') as fp:
+        assert fp.read() == data
+
+    assert not exists(join(TESTOUTPUT_DIR, '.{}.tmp'.format(archive)))
+
+
+@pytest.mark.parametrize("mode", ['report', 'skip', 'link'])
+def test_dedup(mode, capsys):
+    """Presets with the same chunk data as a preceding preset are reported
+       and optionally skipped or hard-linked."""
+    indir = join(TESTOUTPUT_DIR, 'ardour-dedup')
+    outdir = join(TESTOUTPUT_DIR, 'fxp-dedup-' + mode)
+    shutil.rmtree(outdir, ignore_errors=True)
+    os.makedirs(indir, exist_ok=True)
+    infile = join(indir, 'vst-1331185229')
+    tree = ET.parse(join(TESTDATA_DIR, 'vst-1331185229'))
+    copy = ET.fromstring(ET.tostring(tree.getroot()[0]))
+    copy.set('label', 'Kick Copy')
+    tree.getroot().append(copy)
+    tree.write(infile)
+
+    assert main(["-d", mode, "-o", outdir, infile]) is None
+    out = capsys.readouterr().out
+    assert "Preset 'Kick Copy' in '{}' is a duplicate of preset 'Kick'".format(
+        infile) in out
+    assert "Found 1 duplicate preset(s)." in out
+
+    kick, kick_copy = (join(outdir, 'OXFM', label + '.fxp')
+                       for label in ('Kick', 'Kick_Copy'))
+    assert exists(kick)
+    assert exists(kick_copy) == (mode != 'skip')
+
+    if mode == 'link':
+        assert os.stat(kick).st_ino == os.stat(kick_copy).st_ino
+    elif mode == 'report':
+        assert os.stat(kick).st_ino != os.stat(kick_copy).st_ino
+
+
+def test_dedup_link_update():
+    """Hard-linked duplicates are rewritten by an update without linking."""
+    indir = join(TESTOUTPUT_DIR, 'ardour-dedup')
+    outdir = join(TESTOUTPUT_DIR, 'fxp-dedup-update')
+    shutil.rmtree(outdir, ignore_errors=True)
+    os.makedirs(indir, exist_ok=True)
+    infile = join(indir, 'vst-1331185229')
+    tree = ET.parse(join(TESTDATA_DIR, 'vst-1331185229'))
+    copy = ET.fromstring(ET.tostring(tree.getroot()[0]))
+    copy.set('label', 'Kick Copy')
+    tree.getroot().append(copy)
+    tree.write(infile)
+
+    kick, kick_copy = (join(outdir, 'OXFM', label + '.fxp')
+                       for label in ('Kick', 'Kick_Copy'))
+
+    for _ in range(2):
+        assert main(["-d", "link", "-u", "-o", outdir, infile]) is None
+        assert os.stat(kick).st_ino == os.stat(kick_copy).st_ino
+
+    assert main(["-u", "-o", outdir, infile]) is None
+    assert os.stat(kick).st_ino != os.stat(kick_copy).st_ino
+    with open(kick_copy, 'rb') as fp:
+        assert fp.read()[28:56].rstrip(b'\0') == b'Kick Copy'
+
+
+def test_output_filenames():
+    """Labels are turned into unique, safe file names and plugin IDs which
+       are not valid file names into hexadecimal digits."""
+    infile = join(TESTOUTPUT_DIR, 'ardour-labels', 'vst-1331185229')
+    outdir = join(TESTOUTPUT_DIR, 'fxp-labels')
+    shutil.rmtree(outdir, ignore_errors=True)
+    os.makedirs(dirname(infile), exist_ok=True)
+    tree = ET.parse(join(TESTDATA_DIR, 'vst-1331185229'))
+    root = tree.getroot()
+
+    for node, label in zip(root, ('Pad/Lead', 'Kick', 'Kick')):
+        node.set('label', label)
+
+    node = ET.fromstring(ET.tostring(root[0]))
+    node.set('uri', node.get('uri').replace('1331185229', '1094861571'))
+    root.append(node)
+    tree.write(infile)
+
+    assert main(["-o", outdir, infile]) is None
+    assert sorted(os.listdir(join(outdir, 'OXFM'))) == [
+        'Kick.fxp', 'Kick_2.fxp', 'Pad_Lead.fxp']
+    assert os.listdir(join(outdir, '41424303')) == ['Pad_Lead.fxp']
+
+
+def test_watch_filenames():
+    """Presets converted again in watch mode keep their output file names,
+       when labels collide across input files."""
+    indirs = [join(TESTOUTPUT_DIR, 'ardour-watch', name) for name in 'ab']
+    outdir = join(TESTOUTPUT_DIR, 'fxp-watch')
+    shutil.rmtree(outdir, ignore_errors=True)
+
+    for indir in indirs:
+        os.makedirs(indir, exist_ok=True)
+        shutil.copy(join(TESTDATA_DIR, 'vst-1331185229'), indir)
+
+    kick, kick_2 = (join(outdir, 'OXFM', fn)
+                    for fn in ('Kick.fxp', 'Kick_2.fxp'))
+    args = make_argparser().parse_args(["-u", "-o", outdir] + indirs)
+    args.recursive, args.infiles = args.infiles, []
+    cache = ConversionCache(outdir)
+    filenames = FilenameAllocator()
+    assert run(args, cache, filenames) is None
+    data = sha1_digest(kick)
+
+    # change the second file and convert only it again, as watch() does
+    infile = join(indirs[1], 'vst-1331185229')
+    tree = ET.parse(infile)
+    tree.getroot()[0].text = 'Q2hhbmdlZA=='
+    tree.write(infile)
+    args.infiles, args.recursive = [infile], []
+    assert run(args, cache, filenames) is None
+
+    assert sha1_digest(kick) == data
+    assert sha1_digest(kick_2) != data
+    assert not exists(join(outdir, 'OXFM', 'Kick_3.fxp'))
+
+
+def test_stats(capsys):
+    """Statistics per conversion stage are printed as JSON."""
+    infile = join(TESTDATA_DIR, 'vst-1331185229')
+    outdir = join(TESTOUTPUT_DIR, 'fxp-stats')
+    shutil.rmtree(outdir, ignore_errors=True)
+
+    ret = main(["--stats", "json", "-o", outdir, infile])
+    assert ret is None
+
+    stats = json.loads(capsys.readouterr().err)
+    assert stats['stages']['decode base64']['presets'] == 3
+    assert stats['stages']['write files']['presets'] == 3
+    assert stats['stages']['parse xml']['bytes'] == os.path.getsize(infile)
+
+
+@pytest.mark.parametrize("jobs", ["1", "2"])
+def test_verify(jobs, capsys):
+    """Presets which do not survive the round trip to FXP and back are
+       reported."""
+    infile = join(TESTOUTPUT_DIR, 'ardour-verify', 'vst-1466847281')
+    outdir = join(TESTOUTPUT_DIR, 'fxp-verify')
+    shutil.rmtree(outdir, ignore_errors=True)
+    os.makedirs(dirname(infile), exist_ok=True)
+
+    assert main(["--verify", "-j", jobs, "-o", outdir,
+                 join(TESTDATA_DIR, 'vst-1331185229'),
+                 join(TESTDATA_DIR, 'vst-1466847281')]) is None
+    assert 'Verification failed' not in capsys.readouterr().out
+
+    # FXP files can only store labels of up to 28 characters
+    tree = ET.parse(join(TESTDATA_DIR, 'vst-1466847281'))
+    tree.getroot()[0].set('label', 'A very long preset label, truncated')
+    tree.write(infile)
+
+    ret = main(["--verify", "-j", jobs, "-f", "-o", outdir, infile])
+    assert ret == "Round trip verification failed for 1 preset(s)."
+    assert "label changed to 'A very long preset label, tr'" in (
+        capsys.readouterr().out)
+
+
+@pytest.mark.parametrize("jobs", ["1", "2"])
+def test_filter(jobs):
+    """Only presets matching all filter options are converted."""
+    outdir = join(TESTOUTPUT_DIR, 'fxp-filter')
+    shutil.rmtree(outdir, ignore_errors=True)
+    infiles = [join(TESTDATA_DIR, 'vst-1331185229'),
+               join(TESTDATA_DIR, 'vst-1466847281')]
+
+    ret = main(["-j", jobs, "-p", "OXFM", "-l", "s*", "-o", outdir] + infiles)
+    assert ret is None
+    assert os.listdir(outdir) == ['OXFM']
+    assert os.listdir(join(outdir, 'OXFM')) == ['Snare.fxp']
+
+    ret = main(["-j", jobs, "-t", "Preset", "--label-regex", "Reverb$",
+                "-o", outdir] + infiles)
+    assert ret is None
+    assert exists(join(outdir, 'WnP1', 'Drum_Reverb.fxp'))
+
+    ret = main(["-j", jobs, "-p", "WnP1", "-t", "ChunkPreset", "-o", outdir]
+               + infiles)
+    assert ret == "No presets matching the filter(s) found in input file(s)."
+
+
+def test_verify_plugin_id():
+    """A wrong plugin ID in the FXP header is detected."""
+    preset, = iter_ardourpresets(join(TESTDATA_DIR, 'vst-1331185229-single'))
+    data = pack_fxp(preset)
+    assert verify_fxpdata(preset, data) is None
+
+    # plugin ID in the FXP header
+    data[16:20] = b'XXXX'
+    assert verify_fxpdata(preset, data) == "plugin ID changed to {:d}".format(
+        unpack_from('>i', b'XXXX')[0])
+
+
 # TODO: find or create real-life example files for this test
 @pytest.mark.skip()
 @pytest.mark.parametrize("infn,plugin_id,labels,sha1sums", [
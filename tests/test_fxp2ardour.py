@@ -1,15 +1,23 @@
 # -*- coding: utf-8 -*-
 """Tests for 'fxp2ardour' script."""
 
+import base64
 import hashlib
+import io
+import json
 import os
 import shutil
+import zipfile
 
 from os.path import dirname, join, exists
 from xml.dom import minidom
+from xml.etree import ElementTree as ET
 import pytest
 
 from fxp2ardour import main
+from vstpreset.ardour import PresetIndex, write_ardour_presets
+from vstpreset.core import ChunkPreset
+from vstpreset.fxp import FXPFile, parse_fxp, parse_presetfile
 
 TESTDATA_DIR = join(dirname(__file__), 'testdata')
 TESTOUTPUT_DIR = join(dirname(__file__), 'testoutput')
@@ -126,3 +134,242 @@ def test_fxp_append(infn, outfn, sha1sum):
     assert ret is None
     assert exists(outfile)
     assert check_output(outfile) == sha1sum
+
+
+@pytest.mark.parametrize("infns,outfn,num_presets", [
+    (('OXFM_Kick_FPCh.fxp', 'OXFM_GlassyEPiano_FPCh.fxp'), 'vst-1331185229',
+     4),
+])
+def test_fxp_merge_index(infns, outfn, num_presets):
+    """Merging keeps the sidecar preset index up-to-date."""
+    outdir = join(TESTOUTPUT_DIR, 'ardour-index')
+    outfile = join(outdir, outfn)
+    shutil.rmtree(outdir, ignore_errors=True)
+    os.makedirs(outdir)
+    shutil.copyfile(join(TESTDATA_DIR, outfn), outfile)
+
+    for infn in infns:
+        ret = main(["-o", outdir, "-m", join(TESTDATA_DIR, infn)])
+        assert ret is None
+        assert exists(PresetIndex.sidecar_name(outfile))
+
+    index = PresetIndex.load(outfile)
+    rebuilt = PresetIndex.build(outfile)
+    assert len(index.entries) == num_presets
+    assert index.entries == rebuilt.entries
+    assert index.end == rebuilt.end
+    assert len(ET.parse(outfile).getroot()) == num_presets
+
+
+@pytest.mark.parametrize("infn,outfn,num_presets", [
+    ('MDAx.fxb', 'vst-1296318826', 64),
+])
+def test_fxb_fxbk(infn, outfn, num_presets):
+    """Converting an FXB file of type FxBk produces one preset per program."""
+    infile = join(TESTDATA_DIR, infn)
+    outdir = join(TESTOUTPUT_DIR, 'ardour')
+    outfile = join(outdir, outfn)
+
+    try:
+        os.remove(outfile)
+    except OSError:
+        pass
+
+    os.makedirs(outdir, exist_ok=True)
+    ret = main(["-o", outdir, infile])
+
+    assert ret is None
+    assert exists(outfile)
+    root = ET.parse(outfile).getroot()
+    assert len(root.findall('Preset')) == num_presets
+
+
+def test_dedup(capsys):
+    """Presets with the same chunk data as a preceding preset are skipped."""
+    infile = join(TESTDATA_DIR, 'OXFM_Kick_FPCh.fxp')
+    outdir = join(TESTOUTPUT_DIR, 'ardour-dedup-out')
+    shutil.rmtree(outdir, ignore_errors=True)
+
+    ret = main(["-d", "skip", "-o", outdir, infile, infile])
+    assert ret is None
+    assert "Found 1 duplicate preset(s)." in capsys.readouterr().out
+    root = ET.parse(join(outdir, 'vst-1331185229')).getroot()
+    assert len(root.findall('ChunkPreset')) == 1
+
+
+def test_fxb_fbch():
+    """Converting an FXB file of type FBCh is reported as unsupported."""
+    outdir = join(TESTOUTPUT_DIR, 'ardour')
+    ret = main(["-o", outdir, join(TESTDATA_DIR, 'OXFM.fxb')])
+    assert "not supported" in ret
+
+
+@pytest.mark.parametrize("infns,outfn", [
+    (('OXFM_GlassyEPiano_FPCh.fxp', 'OXFM_Kick_FPCh.fxp'), 'vst-1331185229'),
+])
+def test_parallel_jobs(infns, outfn):
+    """Converting FXP files in parallel produces the same output as converting
+       them one after another."""
+    infiles = [join(TESTDATA_DIR, infn) for infn in infns]
+    digests = []
+
+    for jobs in (1, 2):
+        outdir = join(TESTOUTPUT_DIR, 'ardour-jobs', str(jobs))
+        shutil.rmtree(outdir, ignore_errors=True)
+        os.makedirs(outdir)
+        ret = main(["-j", str(jobs), "-o", outdir] + infiles)
+        assert ret is None
+        digests.append(sha1_digest(join(outdir, outfn)))
+
+    assert digests[0] == digests[1]
+
+
+@pytest.mark.parametrize("infn,num_params,chunk_size", [
+    ('MDAx_Harp_FxCk.fxp', 16, None),
+    ('OXFM_GlassyEPiano_FPCh.fxp', 128, 708),
+])
+def test_fxpfile(infn, num_params, chunk_size):
+    """Memory-mapped FXP files return chunk data as views and the same
+       presets as parse_fxp."""
+    infile = join(TESTDATA_DIR, infn)
+    preset = parse_fxp(infile)
+
+    with FXPFile(infile) as fxp:
+        assert len(fxp.presets) == 1
+        mapped = fxp.presets[0]
+        assert mapped.num_params == num_params
+
+        if chunk_size is None:
+            assert list(mapped.params) == list(preset.params)
+        else:
+            assert isinstance(mapped.chunk, memoryview)
+            assert len(mapped.chunk) == chunk_size
+            assert mapped.chunk == preset.chunk
+            del mapped
+
+
+def test_recursive():
+    """All FXP and FXB files in a directory tree are converted."""
+    indir = join(TESTOUTPUT_DIR, 'fxp-tree')
+    outdir = join(TESTOUTPUT_DIR, 'ardour-tree')
+    shutil.rmtree(indir, ignore_errors=True)
+    shutil.rmtree(outdir, ignore_errors=True)
+    os.makedirs(join(indir, 'sub'))
+    shutil.copy(join(TESTDATA_DIR, 'MDAx_Harp_FxCk.fxp'), indir)
+    shutil.copy(join(TESTDATA_DIR, 'MDAx.fxb'), join(indir, 'sub'))
+    shutil.copy(join(TESTDATA_DIR, 'vst-1331185229'), join(indir, 'sub'))
+
+    ret = main(["-r", indir, "-o", outdir])
+    assert ret is None
+    assert sorted(os.listdir(outdir)) == ['vst-1296318826', 'vst-1296318840']
+
+
+def test_archive_input():
+    """FXP and FXB files are read from a zip archive."""
+    infile = join(TESTOUTPUT_DIR, 'fxp-archive.zip')
+    outdir = join(TESTOUTPUT_DIR, 'ardour-archive')
+    shutil.rmtree(outdir, ignore_errors=True)
+    os.makedirs(TESTOUTPUT_DIR, exist_ok=True)
+
+    with zipfile.ZipFile(infile, 'w') as zf:
+        zf.write(join(TESTDATA_DIR, 'MDAx_Harp_FxCk.fxp'), 'MDAx_Harp_FxCk.fxp')
+        zf.write(join(TESTDATA_DIR, 'MDAx.fxb'), 'sub/MDAx.FXB')
+        zf.write(join(TESTDATA_DIR, 'vst-1331185229'), 'sub/vst-1331185229')
+
+    ret = main(["-o", outdir, infile])
+    assert ret is None
+    assert sorted(os.listdir(outdir)) == ['vst-1296318826', 'vst-1296318840']
+
+    # same output as when reading the file directly
+    outfile = join(outdir, 'vst-1296318840')
+    sha1sum = sha1_digest(outfile)
+    os.remove(outfile)
+    ret = main(["-o", outdir, join(TESTDATA_DIR, 'MDAx_Harp_FxCk.fxp')])
+    assert ret is None
+    assert sha1_digest(outfile) == sha1sum
+
+
+def test_filter():
+    """Only presets matching all filter options are converted, also from
+       archives."""
+    infile = join(TESTOUTPUT_DIR, 'fxp-filter.zip')
+    outdir = join(TESTOUTPUT_DIR, 'ardour-filter')
+    shutil.rmtree(outdir, ignore_errors=True)
+    os.makedirs(TESTOUTPUT_DIR, exist_ok=True)
+
+    with zipfile.ZipFile(infile, 'w') as zf:
+        for fn in ('MDAx_Harp_FxCk.fxp', 'MDAx.fxb', 'OXFM_Kick_FPCh.fxp',
+                   'OXFM_GlassyEPiano_FPCh.fxp'):
+            zf.write(join(TESTDATA_DIR, fn), fn)
+
+    ret = main(["-p", "OXFM", "--label-regex", "^Kick$", "-o", outdir,
+                infile])
+    assert ret is None
+    assert os.listdir(outdir) == ['vst-1331185229']
+    root = ET.parse(join(outdir, 'vst-1331185229')).getroot()
+    assert [preset.get('label') for preset in root] == ['Kick']
+
+    ret = main(["-t", "Preset", "-l", "*PAD*", "-o", outdir, infile,
+                join(TESTDATA_DIR, 'OXFM_GlassyEPiano_FPCh.fxp')])
+    assert ret is None
+    root = ET.parse(join(outdir, 'vst-1296318826')).getroot()
+    assert root and all('pad' in preset.get('label').lower()
+                        for preset in root)
+
+    ret = main(["-p", "XXXX", "-o", outdir, infile])
+    assert ret == "No presets matching the filter(s) found in input file(s)."
+
+
+def test_stats(capsys):
+    """Statistics per conversion stage are printed as JSON."""
+    infile = join(TESTDATA_DIR, 'MDAx.fxb')
+    outdir = join(TESTOUTPUT_DIR, 'ardour-stats')
+    shutil.rmtree(outdir, ignore_errors=True)
+
+    ret = main(["--stats", "json", "-o", outdir, infile])
+    assert ret is None
+
+    stats = json.loads(capsys.readouterr().err)
+    assert stats['stages']['read fxp']['presets'] == 64
+    assert stats['stages']['read fxp']['bytes'] == os.path.getsize(infile)
+    assert stats['stages']['write xml']['presets'] == 64
+
+
+def etree_presetxml(plugin, presets):
+    """Serialize presets with ElementTree like earlier versions did."""
+    root = ET.Element('VSTPresets')
+
+    for i, preset in enumerate(presets):
+        sha1 = hashlib.sha1()
+        sha1.update(bytes(preset.label, 'latin1'))
+        sha1.update(bytes(str(i), 'ascii'))
+        pnode = ET.SubElement(root, type(preset).__name__)
+        pnode.set('uri', 'VST:{:010d}:x{}'.format(plugin, sha1.hexdigest()))
+        pnode.set('label', preset.label)
+        pnode.set('version', str(preset.plugin_version))
+        pnode.set('numParams', str(preset.num_params))
+
+        if isinstance(preset, ChunkPreset):
+            pnode.text = base64.b64encode(preset.chunk).decode('ascii')
+        else:
+            for j, param in enumerate(preset.params):
+                ET.SubElement(pnode, 'Parameter', index=str(j),
+                              value=str(param))
+
+    fp = io.BytesIO()
+    ET.ElementTree(root).write(fp, encoding='UTF-8', xml_declaration=True)
+    return fp.getvalue()
+
+
+@pytest.mark.parametrize("infns", [
+    ('MDAx.fxb',),
+    ('OXFM_GlassyEPiano_FPCh.fxp', 'OXFM_Kick_FPCh.fxp'),
+])
+def test_write_ardour_presets(infns):
+    """The streaming XML writer produces the same output as ElementTree."""
+    presets = [preset for infn in infns
+               for preset in parse_presetfile(join(TESTDATA_DIR, infn))]
+    presets[0] = presets[0]._replace(label='<"Special" & \'chars\'>')
+    fp = io.BytesIO()
+    write_ardour_presets(fp, presets[0].plugin_id, presets)
+    assert fp.getvalue() == etree_presetxml(presets[0].plugin_id, presets)
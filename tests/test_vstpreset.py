@@ -0,0 +1,600 @@
+# -*- coding: utf-8 -*-
+"""Tests for 'vstpreset' package."""
+
+import asyncio
+import base64
+import hashlib
+import io
+import os
+import subprocess
+import sys
+import threading
+import time
+import xml.etree.ElementTree as ET
+
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from os.path import dirname, join
+import pytest
+
+from vstpreset import (ChunkPreset, Preset, aio, read_ardour_presets, read_fxp,
+                       write_ardour_presets, write_fxp)
+from vstpreset.ardour import (B64_BLOCK_SIZE, XML_DECLARATION, Base64Decoder,
+                              scan_ardourpresets)
+from vstpreset.client import call_server, convert
+from vstpreset.fxp import (FXPParseException, pack_fxp, parse_presetfile,
+                           scan_presetfile)
+from vstpreset.inventory import Inventory, format_plugin_id
+from vstpreset import params
+from vstpreset.params import (decode_params, encode_params, index_strings,
+                              params_xml)
+from vstpreset.server import ConversionServer
+from vstpreset.util import (PIPELINE_DATA_QUEUE_SIZE, FilenameAllocator,
+                            OutputDir, PresetFilter, iter_threaded,
+                            parse_plugin_id, sanitize_filename)
+from vstpreset.watch import (InotifyWatcher, PollingWatcher, iter_changes,
+                             make_watcher)
+
+TESTDATA_DIR = join(dirname(__file__), 'testdata')
+TOP_DIR = dirname(dirname(__file__))
+
+
+@pytest.mark.parametrize("infn", [
+    'vst-1331185229',
+    'vst-1466847281',
+])
+def test_roundtrip(infn):
+    """Presets survive conversion to FXP and back to Ardour XML unchanged."""
+    presets = read_ardour_presets(join(TESTDATA_DIR, infn))
+    fxp_presets = []
+
+    for preset in presets:
+        fp = io.BytesIO()
+        write_fxp(fp, preset)
+        fxp_presets.extend(read_fxp(fp.getvalue()))
+
+    fp = io.BytesIO()
+    write_ardour_presets(fp, presets[0].plugin_id, fxp_presets)
+    fp.seek(0)
+
+    results = read_ardour_presets(fp)
+    assert len(results) == len(presets)
+
+    for preset, result in zip(presets, results):
+        assert type(result) is type(preset)
+        assert (result.plugin_id, result.label) == (preset.plugin_id,
+                                                    preset.label)
+
+        if isinstance(preset, Preset):
+            assert result.params == preset.params
+        else:
+            assert result.chunk == preset.chunk
+
+
+@pytest.mark.parametrize("piece_size", [1, 7, 4096, 1000003])
+def test_base64_decoder(piece_size):
+    """Text decoded in blocks gives the same data as decoding it at once."""
+    data = os.urandom(3 * B64_BLOCK_SIZE + 5)
+    text = base64.encodebytes(data).decode('ascii')
+    decoder = Base64Decoder()
+
+    for offset in range(0, len(text), piece_size):
+        decoder.feed(text[offset:offset + piece_size])
+
+    assert decoder.close() == data
+
+
+def test_huge_chunk():
+    """Chunks larger than a base64 block are parsed and written unchanged."""
+    preset = ChunkPreset('VST', 1331185229, 1, None, 'Huge', 16,
+                         os.urandom(2 * B64_BLOCK_SIZE + 1))
+    fp = io.BytesIO()
+    write_ardour_presets(fp, preset.plugin_id, [preset])
+    fp.seek(0)
+
+    result, = read_ardour_presets(fp)
+    assert result.chunk == preset.chunk
+
+    fp = io.BytesIO()
+    write_fxp(fp, result)
+    assert fp.getvalue() == pack_fxp(result)
+    assert read_fxp(fp.getvalue())[0].chunk == preset.chunk
+
+
+PARAM_VALUES = ['0.5', '0', '1.0', '0.30000001192092896', '1e-05', '-2.5e+20',
+                '1e40', 'nan', '-inf', '3.4028234663852886e+38']
+
+
+def test_params_codec():
+    """Parameter values are converted exactly like float() and repr()."""
+    params = decode_params(PARAM_VALUES, use_numpy=False)
+    assert params.tobytes() == array('f', map(float, PARAM_VALUES)).tobytes()
+    assert encode_params(params) == [repr(value) for value in params]
+
+    node = ET.Element('Preset')
+    for j, value in enumerate(params):
+        ET.SubElement(node, 'Parameter', index=str(j), value=str(value))
+
+    assert '<Preset>{}</Preset>'.format(params_xml(params)) == (
+        ET.tostring(node, encoding='unicode'))
+
+    with pytest.raises(ValueError):
+        decode_params(['0.5', 'x'])
+
+
+def test_params_xml_threads():
+    """Parameter XML is correct when built in several threads at once."""
+    sizes = [4000 + 500 * i for i in range(8)]
+    expected = {}
+
+    for num in sizes:
+        node = ET.Element('Preset')
+        for j in range(num):
+            ET.SubElement(node, 'Parameter', index=str(j), value='0.5')
+        expected[num] = ET.tostring(node, encoding='unicode')
+
+    def build(num):
+        barrier.wait()
+        return ('<Preset>{}</Preset>'.format(
+                    params_xml(array('f', [0.5] * num))),
+                index_strings(num))
+
+    barrier = threading.Barrier(len(sizes))
+    # switch threads often, to make races likely
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+
+    try:
+        with ThreadPoolExecutor(len(sizes)) as pool:
+            for _ in range(10):
+                # start with empty caches, so all threads grow them
+                params._index_strings.clear()
+                params._param_prefixes.clear()
+
+                for num, (xml, indices) in zip(sizes, pool.map(build, sizes)):
+                    assert xml == expected[num]
+                    assert indices == [str(j) for j in range(num)]
+    finally:
+        sys.setswitchinterval(interval)
+
+
+def test_params_codec_numpy():
+    """NumPy and the standard library give identical parameter values."""
+    pytest.importorskip('numpy')
+    values = PARAM_VALUES * 100
+    assert (decode_params(values, use_numpy=True).tobytes() ==
+            decode_params(values, use_numpy=False).tobytes())
+
+    with pytest.raises(ValueError):
+        decode_params(values + ['x'], use_numpy=True)
+
+
+@pytest.mark.parametrize("module", ['ardour2fxp', 'fxp2ardour', 'vstpreset'])
+def test_lazy_imports(module):
+    """Importing the scripts or the package does not import modules, which
+       are slow to import and only needed for some operations."""
+    code = ("import sys, {}; print(' '.join(sorted(sys.modules)))"
+            .format(module))
+    modules = subprocess.check_output(
+        [sys.executable, '-c', code], cwd=TOP_DIR or None,
+        universal_newlines=True).split()
+
+    for name in ('argparse', 'concurrent.futures', 'json',
+                 'xml.etree.ElementTree'):
+        assert name not in modules
+
+
+@pytest.fixture
+def server(tmp_path):
+    """Run conversion server in a background thread."""
+    loop = asyncio.new_event_loop()
+    server = ConversionServer(str(tmp_path / 'server.sock'))
+    loop.run_until_complete(server.start())
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+
+    try:
+        yield server
+    finally:
+        asyncio.run_coroutine_threadsafe(server.close(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+
+
+def test_server_run(server, tmp_path, capsys):
+    """Scripts run in the conversion server write the same files and the
+       script output is sent to the client."""
+    infile = join(TESTDATA_DIR, 'vst-1331185229-single')
+    ret = call_server('ardour2fxp', ['-o', 'out', infile], server.path,
+                      cwd=str(tmp_path))
+
+    assert ret == 0
+    outfile = tmp_path / 'out' / 'OXFM' / 'Nerf_Pluck.fxp'
+    assert (hashlib.sha1(outfile.read_bytes()).hexdigest() ==
+            'de90b1b924d74877d85248c0d5f5339741277372')
+
+    ret = call_server('ardour2fxp', ['-o', 'out', infile], server.path,
+                      cwd=str(tmp_path))
+    assert ret == 0
+    assert "already exists" in capsys.readouterr().out
+
+    ret = call_server('fxp2ardour', ['nonexistent.fxp'], server.path,
+                      cwd=str(tmp_path))
+    assert ret == 1
+    assert "nonexistent.fxp" in capsys.readouterr().err
+
+
+def test_server_socket_owner(server, tmp_path, monkeypatch):
+    """The command line is only sent to a socket owned by the current
+       user."""
+    args = ['-o', 'out', join(TESTDATA_DIR, 'vst-1331185229-single')]
+    fake = tmp_path / 'fake.sock'
+    fake.write_bytes(b'')
+    assert call_server('ardour2fxp', args, str(fake), cwd=str(tmp_path)) is (
+        None)
+
+    uid = os.stat(server.path).st_uid
+    monkeypatch.setattr(os, 'getuid', lambda: uid + 1, raising=False)
+    assert call_server('ardour2fxp', args, server.path,
+                       cwd=str(tmp_path)) is None
+    assert not (tmp_path / 'out').exists()
+
+
+def test_server_convert(server):
+    """Preset data sent to the conversion server is converted concurrently
+       for several clients."""
+    with open(join(TESTDATA_DIR, 'vst-1331185229'), 'rb') as fp:
+        data = fp.read()
+
+    with ThreadPoolExecutor(4) as pool:
+        results = list(pool.map(
+            lambda _: convert(data, 'ardour', path=server.path), range(8)))
+
+    presets = read_ardour_presets(join(TESTDATA_DIR, 'vst-1331185229'))
+    labels = [preset.label for preset in presets]
+    for result in results:
+        assert [item['label'] for item in result] == labels
+        assert read_fxp(result[0]['data'])[0].chunk == presets[0].chunk
+
+    xml = convert(result[0]['data'], 'fxp', path=server.path)
+    assert xml[0]['plugin_id'] == presets[0].plugin_id
+    assert read_ardour_presets(io.BytesIO(xml[0]['data']))[0].label == (
+        presets[0].label)
+
+    with pytest.raises(ValueError):
+        convert(b'garbage', 'fxp', path=server.path)
+
+
+def test_output_dir(tmp_path):
+    """Output files are created together with their directories and, with
+       sync enabled, only appear when the output is closed."""
+    fn = str(tmp_path / 'out' / 'ABCD' / 'preset.fxp')
+    existing = tmp_path / 'out' / 'ABCD' / 'existing.fxp'
+
+    with OutputDir(str(tmp_path / 'out'), sync=True) as output:
+        assert not output.exists(fn)
+        st = output.write(fn, b'data')
+        assert st.st_size == 4
+        assert output.exists(fn)
+        assert not os.path.exists(fn)
+
+    assert os.listdir(os.path.dirname(fn)) == ['preset.fxp']
+    existing.write_bytes(b'')
+
+    output = OutputDir(str(tmp_path / 'out'))
+    assert output.exists(str(existing))
+    output.write(fn, b'new data')
+    assert open(fn, 'rb').read() == b'new data'
+
+
+@pytest.mark.parametrize("name,filename", [
+    (' Pad Lead ', 'Pad_Lead'),
+    ('Pad/Lead', 'Pad_Lead'),
+    ('a<b>c:d"e\\f|g?h*i\tj', 'a_b_c_d_e_f_g_h_i_j'),
+    ('.hidden', '_hidden'),
+    ('Init...', 'Init'),
+    ('...', 'Untitled'),
+    ('', 'Untitled'),
+    ('con', 'con_'),
+    ('LPT1.bak', 'LPT1_.bak'),
+    ('Ärger', 'Ärger'),
+    ('\u00e4' * 150, '\u00e4' * 100),
+])
+def test_sanitize_filename(name, filename):
+    """Characters unsuitable for file names are replaced."""
+    assert sanitize_filename(name) == filename
+
+
+def test_filename_allocator():
+    """Repeated names in a directory get deterministic numbered suffixes."""
+    names = FilenameAllocator()
+    assert [names.allocate('A', label, '.fxp') for label in (
+        'Kick', 'kick', 'Kick', 'Kick_2', 'Kick', 'Pad/Lead', 'Pad Lead')] == [
+        join('A', fn) for fn in ('Kick.fxp', 'kick_2.fxp', 'Kick_3.fxp',
+                                 'Kick_2_2.fxp', 'Kick_4.fxp', 'Pad_Lead.fxp',
+                                 'Pad_Lead_2.fxp')]
+    assert names.allocate('B', 'Kick', '.fxp') == join('B', 'Kick.fxp')
+
+    # names allocated for a key are returned again for it
+    assert names.allocate('B', 'Kick', '.fxp', ('b', 1)) == join(
+        'B', 'Kick_2.fxp')
+    assert names.allocate('B', 'Kick', '.fxp', ('c', 1)) == join(
+        'B', 'Kick_3.fxp')
+    assert names.allocate('B', 'Kick', '.fxp', ('b', 1)) == join(
+        'B', 'Kick_2.fxp')
+
+
+def test_iter_threaded_bounded():
+    """The producer runs ahead of the consumer only by the queue size."""
+    produced = []
+
+    def produce():
+        for i in range(100):
+            produced.append(i)
+            yield i
+
+    items = iter_threaded(produce(), PIPELINE_DATA_QUEUE_SIZE)
+    assert next(items) == 0
+    time.sleep(0.3)
+    # one item consumed, a full queue and one item waiting to be queued
+    assert len(produced) <= PIPELINE_DATA_QUEUE_SIZE + 2
+    assert list(items) == list(range(1, 100))
+
+
+@pytest.mark.parametrize("watcher_cls", [
+    PollingWatcher,
+    pytest.param(InotifyWatcher, marks=pytest.mark.skipif(
+        not sys.platform.startswith('linux'), reason="requires Linux")),
+])
+def test_watcher(watcher_cls, tmp_path):
+    """Watchers report changed and new files matching the patterns."""
+    subdir = tmp_path / 'presets'
+    subdir.mkdir()
+    watched = subdir / 'vst-1'
+    watched.write_bytes(b'old')
+    other = subdir / 'other'
+    kwargs = {'interval': 0} if watcher_cls is PollingWatcher else {}
+    watcher = watcher_cls([], [str(subdir)], ('vst-*',), **kwargs)
+
+    try:
+        assert watcher.wait(0) == set()
+
+        watched.write_bytes(b'new content')
+        other.write_bytes(b'ignored')
+        os.utime(str(watched), ns=(0, 1))
+        assert watcher.wait(1) == {str(watched)}
+
+        (subdir / 'sub').mkdir()
+        (subdir / 'sub' / 'vst-2').write_bytes(b'new')
+        changed = set()
+        for _ in range(3):
+            changed |= watcher.wait(1)
+        assert str(subdir / 'sub' / 'vst-2') in changed
+    finally:
+        watcher.close()
+
+
+def test_iter_changes():
+    """Changes in quick succession are reported together once."""
+    class FakeWatcher:
+        events = [{'a'}, {'b', 'a'}, set(), {'c'}, set()]
+
+        def wait(self, timeout=None):
+            return self.events.pop(0) if self.events else set()
+
+    assert isinstance(make_watcher(polling=True), PollingWatcher)
+    changes = iter_changes(FakeWatcher(), debounce=0)
+    assert next(changes) == ['a', 'b']
+    assert next(changes) == ['c']
+
+
+@pytest.mark.parametrize("infn", [
+    'MDAx.fxb',
+    'MDAx_Harp_FxCk.fxp',
+    'OXFM_Kick_FPCh.fxp',
+    'vst-1331185229',
+    'vst-1466847281',
+])
+def test_scan_presets(infn):
+    """Header-only scan gives the same metadata as parsing the presets."""
+    infile = join(TESTDATA_DIR, infn)
+
+    if infn.endswith(('.fxp', '.fxb')):
+        infos = scan_presetfile(infile)
+        presets = list(parse_presetfile(infile))
+    else:
+        infos = scan_ardourpresets(infile)
+        presets = read_ardour_presets(infile)
+
+    assert len(infos) == len(presets)
+
+    for info, preset in zip(infos, presets):
+        assert info.type == type(preset).__name__
+        assert info.plugin_id == preset.plugin_id
+        assert info.label == preset.label
+
+        if isinstance(preset, Preset):
+            assert info.num_params == len(preset.params)
+        else:
+            assert info.num_params == preset.num_params
+
+        if infn.endswith(('.fxp', '.fxb')):
+            assert info.plugin_version == preset.plugin_version
+
+    with pytest.raises(FXPParseException):
+        scan_presetfile(join(TESTDATA_DIR, 'OXFM.fxb'))
+
+
+def test_preset_filter():
+    oxfm = parse_plugin_id('OXFM')
+    select = PresetFilter([oxfm], label='s*')
+    assert select('ChunkPreset', oxfm, 'Snare')
+    assert select('Preset', oxfm, 'snare drum')
+    assert not select('ChunkPreset', oxfm, 'Kick')
+    assert not select('ChunkPreset', oxfm + 1, 'Snare')
+    assert select.accepts_file('/presets/vst-1331185229')
+    assert not select.accepts_file('/presets/vst-1466847281')
+    assert select.accepts_file('presets.xml')
+
+    select = PresetFilter(label_regex=r'^(Kick|INIT)$', preset_type='Preset')
+    assert select('Preset', oxfm, 'INIT')
+    assert not select('Preset', oxfm, 'INIT 2')
+    assert not select('ChunkPreset', oxfm, 'Kick')
+    assert select.accepts_file('vst-1466847281')
+
+    # filters are checked before presets are converted
+    calls = []
+
+    def record(preset_type, plugin_id, label):
+        calls.append((preset_type, plugin_id, label))
+        return label == 'Snare'
+
+    presets = read_ardour_presets(join(TESTDATA_DIR, 'vst-1331185229'),
+                                  select=record)
+    assert [preset.label for preset in presets] == ['Snare']
+    assert calls == [('ChunkPreset', oxfm, label)
+                     for label in ('Kick', 'Snare', 'INIT')]
+
+    presets = read_fxp(join(TESTDATA_DIR, 'MDAx.fxb'),
+                       PresetFilter(label='*pad*'))
+    assert [preset.label for preset in presets] == [
+        info.label for info in scan_presetfile(join(TESTDATA_DIR, 'MDAx.fxb'))
+        if 'pad' in info.label.lower()]
+    assert read_fxp(join(TESTDATA_DIR, 'OXFM_Kick_FPCh.fxp'),
+                    PresetFilter(preset_type='Preset')) == []
+
+
+def test_inventory(tmp_path, capsys):
+    presetdir = tmp_path / 'presets'
+    presetdir.mkdir()
+    for fn in ('MDAx_Harp_FxCk.fxp', 'OXFM_Kick_FPCh.fxp', 'OXFM.fxb',
+               'vst-1331185229'):
+        with open(join(TESTDATA_DIR, fn), 'rb') as fp:
+            (presetdir / fn).write_bytes(fp.read())
+
+    dbfile = str(tmp_path / 'inventory.sqlite')
+
+    with Inventory(dbfile) as inventory:
+        assert inventory.update([str(presetdir)]) == (4, 0, 0)
+        assert 'OXFM.fxb' in capsys.readouterr().err
+
+        presets = inventory.query(plugin_id=parse_plugin_id('MDAx'))
+        assert [info.label for path, info in presets] == ['Harp']
+        assert presets[0][0] == str(presetdir / 'MDAx_Harp_FxCk.fxp')
+
+        presets = inventory.query(label='k?CK')
+        assert [info.type for path, info in presets] == ['ChunkPreset'] * 2
+        assert {path for path, info in presets} == {
+            str(presetdir / 'OXFM_Kick_FPCh.fxp'),
+            str(presetdir / 'vst-1331185229')}
+        assert not inventory.query(label='%')
+
+        num_presets = len(inventory.query())
+
+    # unchanged files are not scanned again, removed files are dropped
+    (presetdir / 'MDAx_Harp_FxCk.fxp').unlink()
+
+    with Inventory(dbfile) as inventory:
+        assert inventory.update([str(presetdir)]) == (0, 3, 1)
+        assert len(inventory.query()) == num_presets - 1
+        assert parse_plugin_id('1331185229') == 1331185229
+
+
+def test_inventory_high_plugin_id(tmp_path):
+    """Plugin IDs with the high bit set are stored unsigned."""
+    plugin_id = 0xF0000001
+    # FXP headers store the plugin ID as a signed integer
+    preset = Preset('VST', plugin_id - 2**32, 1, None, 'High', 2,
+                    array('f', [0.5, 0.25]))
+    (tmp_path / 'high.fxp').write_bytes(pack_fxp(preset))
+
+    with Inventory(str(tmp_path / 'inventory.sqlite')) as inventory:
+        assert inventory.update([str(tmp_path)]) == (1, 0, 0)
+        presets = inventory.query(plugin_id=parse_plugin_id(str(plugin_id)))
+        assert [info.label for path, info in presets] == ['High']
+        assert presets[0][1].plugin_id == plugin_id
+        assert inventory.query(plugin_id=plugin_id - 2**32) == presets
+
+    assert format_plugin_id(plugin_id) == str(plugin_id)
+    assert format_plugin_id(plugin_id - 2**32) == str(plugin_id)
+    assert format_plugin_id(parse_plugin_id('OXFM')) == 'OXFM'
+
+
+class _StreamWriter:
+    """Stand-in for ``asyncio.StreamWriter`` collecting the written data."""
+
+    def __init__(self):
+        self.data = bytearray()
+        self.drains = 0
+
+    def write(self, data):
+        self.data += data
+
+    async def drain(self):
+        self.drains += 1
+
+
+def _stream_reader(data, eof=True):
+    reader = asyncio.StreamReader()
+    reader.feed_data(data)
+    if eof:
+        reader.feed_eof()
+    return reader
+
+
+def test_aio():
+    """The asyncio API gives the same results as the blocking functions."""
+    with open(join(TESTDATA_DIR, 'vst-1331185229'), 'rb') as fp:
+        xml = fp.read()
+
+    presets = read_ardour_presets(io.BytesIO(xml))
+    plugin = presets[0].plugin_id
+
+    async def convert():
+        results = [preset async for preset in
+                   aio.read_ardour_presets(_stream_reader(xml))]
+        assert [preset.chunk for preset in results] == [
+            preset.chunk for preset in presets]
+
+        writer = _StreamWriter()
+        for preset in results:
+            await aio.write_fxp(writer, preset)
+
+        assert writer.data == b''.join(map(pack_fxp, presets))
+        fxp_presets = await aio.read_fxp(_stream_reader(pack_fxp(presets[0])))
+        assert fxp_presets[0].chunk == presets[0].chunk
+
+        writer = _StreamWriter()
+        await aio.write_ardour_presets(
+            writer, plugin, aio.read_ardour_presets(_stream_reader(xml)))
+        fp = io.BytesIO()
+        write_ardour_presets(fp, plugin, presets)
+        assert writer.data == fp.getvalue()
+
+    asyncio.run(convert())
+
+
+def test_aio_flow_control():
+    """Large chunks are written in blocks and reading can be cancelled."""
+    preset = ChunkPreset('VST', 1331185229, 1, None, 'Huge', 16,
+                         os.urandom(3 * aio.WRITE_BLOCK_SIZE))
+
+    async def convert():
+        writer = _StreamWriter()
+        await aio.write_fxp(writer, preset)
+        assert writer.drains > 3
+        assert writer.data == pack_fxp(preset)
+
+        # the stream never ends, so reading blocks until cancelled
+        reader = _stream_reader(XML_DECLARATION + b'<VSTPresets>', eof=False)
+        task = asyncio.ensure_future(
+            aio.read_ardour_presets(reader).__anext__())
+        await asyncio.sleep(0.01)
+        assert not task.done()
+        task.cancel()
+
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(convert())
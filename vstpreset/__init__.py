@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+#
+# vstpreset/__init__.py
+#
+"""Read and write VST2 FXP/FXB preset files and Ardour VST presets XML files.
+
+This package contains the file format code shared by the ``ardour2fxp`` and
+``fxp2ardour`` scripts. Its public API is::
+
+    from vstpreset import (read_ardour_presets, read_fxp,
+                           write_ardour_presets, write_fxp)
+
+    presets = read_ardour_presets('vst-1331185229')
+
+    with open('preset.fxp', 'wb') as fp:
+        write_fxp(fp, presets[0])
+
+    with open('vst-1331185229', 'wb') as fp:
+        write_ardour_presets(fp, presets[0].plugin_id, read_fxp('preset.fxp'))
+
+Modules which are slow to import and only needed for some operations, like
+``xml.etree.ElementTree`` or ``json``, are imported when first used, so that
+importing this package and the scripts stays fast.
+
+"""
+
+from .ardour import read_ardour_presets, write_ardour_presets
+from .core import ChunkPreset, Preset
+from .fxp import FXPParseException, read_fxp, write_fxp
+
+__all__ = (
+    'ChunkPreset',
+    'FXPParseException',
+    'Preset',
+    'read_ardour_presets',
+    'read_fxp',
+    'write_ardour_presets',
+    'write_fxp',
+)
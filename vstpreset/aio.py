@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+#
+# vstpreset/aio.py
+#
+"""Read and write presets on asyncio streams.
+
+These are the ``asyncio`` counterparts of the functions in the ``vstpreset``
+package, for use in services which must not block their event loop::
+
+    from vstpreset import aio
+
+    async def convert(reader, writer):
+        async for preset in aio.read_ardour_presets(reader):
+            await aio.write_fxp(writer, preset)
+
+Readers are objects with an ``async read(n)`` method, e.g.
+``asyncio.StreamReader``, writers objects with a ``write(data)`` and an
+``async drain()`` method, e.g. ``asyncio.StreamWriter``.
+
+Parsing and serializing presets is done in an executor, the default executor
+of the event loop or the ``concurrent.futures.ThreadPoolExecutor`` passed as
+``executor``, one block of data at a time, so the event loop stays responsive
+during large conversions. Data is read from a stream only as fast as the
+presets are consumed and each block written is followed by ``drain()``, so a
+slow peer limits the conversion speed instead of filling up memory.
+
+All functions can be cancelled while they wait for a stream or the
+executor. Data already written to a stream is not taken back.
+
+"""
+
+import asyncio
+
+from . import fxp
+from .ardour import XML_DECLARATION, PresetParser, iter_preset_xml
+
+
+READ_SIZE = 64 * 1024
+WRITE_BLOCK_SIZE = 64 * 1024
+
+
+async def _aiter(presets):
+    if hasattr(presets, '__aiter__'):
+        async for preset in presets:
+            yield preset
+    else:
+        for preset in presets:
+            yield preset
+
+
+async def read_ardour_presets(reader, executor=None, stats=None, select=None):
+    """Parse Ardour VST presets XML document from stream incrementally.
+
+    Asynchronous generator yielding Preset or ChunkPreset instances one at a
+    time. The document is read in blocks of ``READ_SIZE`` bytes, which
+    are parsed in the executor. The next block is only read, when all presets
+    completed by the previous one were consumed.
+
+    See ``vstpreset.ardour.PresetParser`` for the errors raised and the
+    meaning of ``stats`` and ``select``.
+
+    """
+    loop = asyncio.get_running_loop()
+    parser = PresetParser(stats, select)
+
+    while True:
+        data = await reader.read(READ_SIZE)
+
+        if not data:
+            break
+
+        for preset in await loop.run_in_executor(executor, parser.feed,
+                                                 data):
+            yield preset
+
+    for preset in await loop.run_in_executor(executor, parser.close):
+        yield preset
+
+
+async def read_fxp(reader, executor=None, select=None):
+    """Read presets from a VST2 FXP preset or FXB bank file stream.
+
+    The stream is read until EOF and the data is parsed in the executor.
+
+    Returns list of Preset or ChunkPreset instances. See
+    ``vstpreset.fxp.parse_buffer`` for the meaning of ``select``.
+
+    """
+    data = bytearray()
+
+    while True:
+        block = await reader.read(READ_SIZE)
+
+        if not block:
+            break
+
+        data += block
+
+    return await asyncio.get_running_loop().run_in_executor(
+        executor, fxp.read_fxp, data, select)
+
+
+async def write_fxp(writer, preset, fx_version=None, executor=None):
+    """Write preset as VST2 FXP program to stream.
+
+    The FXP header is written first, then the parameter values resp. chunk
+    data in blocks of ``WRITE_BLOCK_SIZE`` bytes, waiting for the stream to
+    drain after each block. See ``vstpreset.fxp.pack_fxp`` for the meaning of
+    ``fx_version``.
+
+    """
+    header, payload = await asyncio.get_running_loop().run_in_executor(
+        executor, fxp.pack_fxp_parts, preset, fx_version)
+    writer.write(header)
+    payload = memoryview(payload).cast('B')
+
+    for offset in range(0, len(payload), WRITE_BLOCK_SIZE):
+        writer.write(payload[offset:offset + WRITE_BLOCK_SIZE])
+        await writer.drain()
+
+    await writer.drain()
+
+
+async def write_ardour_presets(writer, plugin, presets, executor=None):
+    """Write Ardour VST presets XML document for plugin to stream.
+
+    ``presets`` is an iterable or asynchronous iterable of presets, e.g. as
+    returned by ``read_ardour_presets``. Each preset is serialized in the
+    executor, in blocks for chunk presets, and each block is written as soon
+    as it is ready, waiting for the stream to drain after it.
+
+    """
+    loop = asyncio.get_running_loop()
+    writer.write(XML_DECLARATION)
+    index = 0
+
+    async for preset in _aiter(presets):
+        if not index:
+            writer.write(b'<VSTPresets>')
+
+        blocks = iter_preset_xml(preset, plugin, index)
+
+        while True:
+            data = await loop.run_in_executor(executor, next, blocks, None)
+
+            if data is None:
+                break
+
+            writer.write(data)
+            await writer.drain()
+
+        index += 1
+
+    writer.write(b'</VSTPresets>' if index else b'<VSTPresets />')
+    await writer.drain()
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+#
+# vstpreset/archive.py
+#
+"""Read and write preset files as members of zip and tar archives.
+
+The archive format is determined by the file name extension.
+
+"""
+
+import io
+import os
+import time
+
+from collections import namedtuple
+from os.path import basename, dirname, join, relpath
+
+
+# file name extension -> compression for tarfile, None for zip archives
+ARCHIVE_FORMATS = {
+    '.zip': None,
+    '.tar': '',
+    '.tar.gz': 'gz',
+    '.tgz': 'gz',
+    '.tar.bz2': 'bz2',
+    '.tbz2': 'bz2',
+    '.tar.xz': 'xz',
+    '.txz': 'xz',
+}
+
+ArchiveMember = namedtuple('ArchiveMember', ('name', 'data'))
+
+
+def _archive_format(path):
+    name = basename(path).lower()
+
+    for ext, compression in ARCHIVE_FORMATS.items():
+        if name.endswith(ext):
+            return ext, compression
+
+    return None, None
+
+
+def is_archive(path):
+    """Return True if path has the file name extension of a known archive."""
+    return _archive_format(path)[0] is not None
+
+
+def iter_archive(path, patterns, select=None, head_size=0):
+    """Read preset files from a zip or tar archive.
+
+    Yields an ``ArchiveMember`` with the name and the data for each regular
+    file in the archive, whose file name matches any of the given patterns
+    (case-insensitively). The name is the path of the archive joined with the
+    name of the member.
+
+    If ``select`` is given, it is called with the name and the first
+    ``head_size`` bytes of each matching member and members for which it
+    returns false are skipped, without reading (and decompressing) the rest
+    of their data.
+
+    """
+    import fnmatch
+
+    def matches(name):
+        name = name.rsplit('/', 1)[-1].lower()
+        return any(fnmatch.fnmatch(name, pat) for pat in patterns)
+
+    def read(name, fp):
+        name = join(path, name)
+        if select is None:
+            return ArchiveMember(name, fp.read())
+
+        head = fp.read(head_size)
+        if not select(name, head):
+            return None
+
+        return ArchiveMember(name, head + fp.read())
+
+    if _archive_format(path)[1] is None:
+        import zipfile
+
+        with zipfile.ZipFile(path) as archive:
+            for info in archive.infolist():
+                if not info.is_dir() and matches(info.filename):
+                    with archive.open(info) as fp:
+                        member = read(info.filename, fp)
+
+                    if member is not None:
+                        yield member
+    else:
+        import tarfile
+
+        with tarfile.open(path, 'r:*') as archive:
+            for info in archive:
+                if info.isfile() and matches(info.name):
+                    member = read(info.name, archive.extractfile(info))
+
+                    if member is not None:
+                        yield member
+
+
+class ArchiveWriter:
+    """Write output files as members of a zip or tar archive.
+
+    Has the same interface as ``vstpreset.util.OutputDir``. File names passed
+    to ``exists`` and ``write`` are below ``path``, their path relative to it
+    is used as the member name. Data is added to the archive as it is written
+    and the archive is written to a temporary file, which replaces ``path``
+    when ``close`` is called. ``abort`` discards it instead, leaving an
+    existing archive at ``path`` untouched.
+
+    """
+
+    def __init__(self, path, sync=False):
+        ext, compression = _archive_format(path)
+        if ext is None:
+            raise ValueError("Unknown archive format: {}".format(path))
+
+        self.path = path
+        self.sync = sync
+        self._names = set()
+        self._tmp_path = join(dirname(path), '.{}.tmp'.format(basename(path)))
+
+        if dirname(path):
+            os.makedirs(dirname(path), exist_ok=True)
+
+        if compression is None:
+            import zipfile
+
+            self._archive = zipfile.ZipFile(self._tmp_path, 'w',
+                                            zipfile.ZIP_DEFLATED)
+        else:
+            import tarfile
+
+            self._archive = tarfile.open(self._tmp_path, 'w:' + compression)
+
+    def _member_name(self, fn):
+        return relpath(fn, self.path).replace(os.sep, '/')
+
+    def exists(self, fn):
+        """Return True if a member for the output file was written already."""
+        return self._member_name(fn) in self._names
+
+    def write(self, fn, data):
+        """Add data as archive member for output file."""
+        name = self._member_name(fn)
+
+        if hasattr(self._archive, 'writestr'):
+            self._archive.writestr(name, data)
+        else:
+            import tarfile
+
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = time.time()
+            info.mode = 0o644
+            self._archive.addfile(info, io.BytesIO(data))
+
+        self._names.add(name)
+
+    def close(self):
+        """Finish the archive and move it to its final path."""
+        if self._archive is None:
+            return
+
+        self._archive.close()
+        self._archive = None
+
+        if self.sync:
+            fd = os.open(self._tmp_path, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+        os.replace(self._tmp_path, self.path)
+
+    def abort(self):
+        """Discard the archive written so far."""
+        if self._archive is None:
+            return
+
+        try:
+            self._archive.close()
+        finally:
+            self._archive = None
+
+            try:
+                os.unlink(self._tmp_path)
+            except FileNotFoundError:
+                pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
@@ -0,0 +1,849 @@
+# -*- coding: utf-8 -*-
+#
+# vstpreset/ardour.py
+#
+"""Read and write Ardour VST presets XML files."""
+
+import os
+
+from binascii import a2b_base64, b2a_base64
+from os.path import basename, dirname, exists, join
+from time import perf_counter
+
+from .core import ChunkPreset, Preset, PresetInfo
+from .params import decode_params, index_strings, params_xml
+
+
+XML_DECLARATION = b"<?xml version='1.0' encoding='UTF-8'?>\n"
+XML_READ_SIZE = 64 * 1024
+B64_BLOCK_SIZE = 3 * 64 * 1024
+# characters ignored by a2b_base64
+_B64_IGNORED = bytes(
+    c for c in range(256) if c not in
+    b'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/=')
+
+_ATTRIB_ENTITIES = (
+    ('&', '&amp;'),
+    ('<', '&lt;'),
+    ('>', '&gt;'),
+    ('"', '&quot;'),
+    ('\r', '&#13;'),
+    ('\n', '&#10;'),
+    ('\t', '&#09;'),
+)
+
+
+class PresetFileError(Exception):
+    """Raised when an existing Ardour preset file cannot be updated."""
+
+
+class Base64Decoder:
+    """Incremental decoder for base64 text received in pieces of any size.
+
+    Text is decoded in blocks of ``B64_BLOCK_SIZE`` decoded bytes as soon as
+    enough of it was fed, so only one block of text is held in memory at a
+    time. The result is the same as decoding all text at once with
+    ``binascii.a2b_base64``.
+
+    """
+
+    def __init__(self):
+        # decoded blocks
+        self._blocks = []
+        self._pending = []
+        self._size = 0
+
+    def feed(self, text):
+        """Add a piece of base64 text, decoding complete blocks."""
+        self._pending.append(text)
+        self._size += len(text)
+
+        if self._size >= B64_BLOCK_SIZE // 3 * 4:
+            self._decode()
+
+    def close(self):
+        """Decode the remaining text and return the data as bytes."""
+        self._decode(final=True)
+        blocks, self._blocks = self._blocks, []
+        return b''.join(blocks)
+
+    def _decode(self, final=False):
+        text = ''.join(self._pending).encode('ascii')
+
+        data = None
+
+        if not final:
+            end = len(text) & ~3
+            try:
+                data = a2b_base64(memoryview(text)[:end])
+            except ValueError:
+                pass
+
+        if data is None or len(data) != end // 4 * 3:
+            # padding or ignored characters (e.g. line breaks), which shift
+            # the block boundaries
+            text = text.translate(None, _B64_IGNORED)
+            end = len(text) if final else len(text) & ~3
+            data = a2b_base64(memoryview(text)[:end])
+
+        self._blocks.append(data)
+        self._pending = [text[end:].decode('ascii')] if end < len(text) else []
+        self._size = len(text) - end
+
+
+def _parse_preset_attrib(attrib):
+    """Return preset metadata from attributes of a preset XML element.
+
+    Returns a ``(type, plugin_id, version, hash, label, num_params)`` tuple.
+    Raises ``KeyError`` or ``ValueError`` if the attributes are not valid.
+
+    """
+    type, plugin_id, hash = attrib['uri'].split(':', 2)
+    plugin_id = int(plugin_id)
+    version = attrib.get('version')
+    num_params = attrib.get('numParams')
+    label = attrib['label']
+
+    if version is not None:
+        version = int(version)
+
+    if num_params is not None:
+        num_params = int(num_params)
+
+    if type != "VST":
+        raise ValueError
+
+    return type, plugin_id, version, hash, label, num_params
+
+
+def _decode_param_values(indices, values):
+    """Return parameter values as ``array('f')``, ordered by their indices."""
+    if indices != index_strings(len(indices)):
+        # parameters not in index order, sort them first
+        values = dict(zip(map(int, indices), values))
+        values = [value for _, value in sorted(values.items())]
+
+    return decode_params(values)
+
+
+def _parse_preset_node(preset, stats=None):
+    """Convert a single 'Preset' or 'ChunkPreset' XML element.
+
+    Returns a Preset or ChunkPreset instance or None, if the element is not a
+    valid preset.
+
+    """
+    if preset.tag not in ('Preset', 'ChunkPreset'):
+        print("Invalid preset type: {}".format(preset.tag))
+        return None
+
+    try:
+        (type, plugin_id, version, hash, label,
+         num_params) = _parse_preset_attrib(preset.attrib)
+    except (KeyError, ValueError):
+        print("Invalid preset format: {}".format(preset.attrib))
+        return None
+
+    start = perf_counter()
+
+    if preset.tag == 'Preset':
+        attribs = [param.attrib for param in preset]
+        params = _decode_param_values(
+            [attrib['index'] for attrib in attribs],
+            [attrib['value'] for attrib in attribs])
+
+        if stats is not None:
+            stats.add('decode params', perf_counter() - start,
+                      presets=1)
+
+        return Preset(type, plugin_id, version, hash, label, num_params,
+                      params)
+    else:
+        chunk = a2b_base64(preset.text or '')
+
+        if stats is not None:
+            stats.add('decode base64', perf_counter() - start,
+                      bytes=len(chunk), presets=1)
+
+        return ChunkPreset(type, plugin_id, version, hash, label, num_params,
+                           chunk)
+
+
+def parse_ardourpresets(root):
+    """Parse ardour VST presets XML document.
+
+    Returns list of Preset or ChunkPreset instances.
+
+    """
+    if root.tag != 'VSTPresets':
+        raise ValueError("Root node must be 'VSTPresets'.")
+
+    presets = []
+    for node in root:
+        preset = _parse_preset_node(node)
+        if preset is not None:
+            presets.append(preset)
+
+    return presets
+
+
+class _PresetBuilder:
+    """Parser target converting preset elements as they are parsed.
+
+    No element tree is built. The parameter values of 'Preset' elements are
+    collected from the attributes of their children and the text of
+    'ChunkPreset' elements is decoded with a ``Base64Decoder`` while it is
+    parsed. Converted presets are appended to ``presets``. Preset elements
+    not selected by ``select`` are skipped without converting their content.
+
+    """
+
+    def __init__(self, stats=None, select=None):
+        self.presets = []
+        self.stats = stats
+        self.select = select
+        # time spent on converting presets, not on parsing XML
+        self.convert_time = 0.0
+        self._decode_time = 0.0
+        self._depth = 0
+        self._preset = None
+        self._indices = None
+        self._values = None
+        self._decoder = None
+
+    def start(self, tag, attrib):
+        self._depth += 1
+        depth = self._depth
+
+        if depth == 3:
+            if self._indices is not None:
+                self._indices.append(attrib['index'])
+                self._values.append(attrib['value'])
+        elif depth == 2:
+            if tag not in ('Preset', 'ChunkPreset'):
+                print("Invalid preset type: {}".format(tag))
+                return
+
+            try:
+                preset = _parse_preset_attrib(attrib)
+            except (KeyError, ValueError):
+                print("Invalid preset format: {}".format(attrib))
+                return
+
+            if self.select is not None and not self.select(
+                    tag, preset[1], preset[4]):
+                return
+
+            self._preset = preset
+
+            if tag == 'Preset':
+                self._indices = []
+                self._values = []
+            else:
+                self._decoder = Base64Decoder()
+        elif depth == 1 and tag != 'VSTPresets':
+            raise ValueError("Root node must be 'VSTPresets'.")
+
+    def data(self, text):
+        if self._depth == 2 and self._decoder is not None:
+            start = perf_counter()
+            self._decoder.feed(text)
+            self._decode_time += perf_counter() - start
+
+    def end(self, tag):
+        self._depth -= 1
+
+        if self._depth == 1 and self._preset is not None:
+            start = perf_counter()
+
+            if self._decoder is not None:
+                chunk = self._decoder.close()
+                self.presets.append(ChunkPreset(*self._preset, chunk))
+                self._decoder = None
+                elapsed = perf_counter() - start + self._decode_time
+                self._decode_time = 0.0
+
+                if self.stats is not None:
+                    self.stats.add('decode base64', elapsed,
+                                   bytes=len(chunk), presets=1)
+            else:
+                params = _decode_param_values(self._indices, self._values)
+                self.presets.append(Preset(*self._preset, params))
+                self._indices = self._values = None
+                elapsed = perf_counter() - start
+
+                if self.stats is not None:
+                    self.stats.add('decode params', elapsed, presets=1)
+
+            self.convert_time += elapsed
+            self._preset = None
+
+    def close(self):
+        pass
+
+
+class PresetParser:
+    """Incremental parser for Ardour VST presets XML documents.
+
+    The document is passed to ``feed`` in blocks of any size. ``feed``
+    returns the list of Preset or ChunkPreset instances completed by the
+    block and ``close``, which must be called at the end of the document,
+    the remaining ones. Parser errors are raised as
+    ``xml.etree.ElementTree.ParseError`` and an invalid root element as
+    ``ValueError``.
+
+    If a ``Stats`` instance is passed as ``stats``, time spent on parsing XML
+    and decoding preset data is recorded in it.
+
+    If ``select`` is given, it is called with the element name ('Preset' or
+    'ChunkPreset'), plugin ID and label of each preset, as soon as its start
+    tag is parsed. Presets for which it returns false are skipped, without
+    converting their parameter values or decoding their chunk data, e.g. a
+    ``vstpreset.util.PresetFilter``.
+
+    """
+
+    def __init__(self, stats=None, select=None):
+        from xml.etree.ElementTree import XMLParser
+
+        self.stats = stats
+        self._builder = _PresetBuilder(stats, select)
+        self._parser = XMLParser(target=self._builder)
+
+    def feed(self, data):
+        """Parse a block of the document and return the completed presets."""
+        return self._run(self._parser.feed, data)
+
+    def close(self):
+        """Finish parsing the document and return the remaining presets."""
+        return self._run(self._parser.close)
+
+    def _run(self, func, data=b''):
+        builder = self._builder
+        start = perf_counter()
+
+        if data:
+            func(data)
+        else:
+            func()
+
+        if self.stats is not None:
+            self.stats.add('parse xml',
+                           perf_counter() - start - builder.convert_time,
+                           bytes=len(data))
+
+        builder.convert_time = 0.0
+        presets, builder.presets = builder.presets, []
+        return presets
+
+
+def iter_ardourpresets(source, stats=None, select=None):
+    """Parse ardour VST presets XML document incrementally.
+
+    ``source`` is a filename or file object. Yields Preset or ChunkPreset
+    instances one at a time. The document is read in blocks of
+    ``XML_READ_SIZE`` bytes and no element tree is built, so memory usage is
+    bounded by the size of the largest preset, not the size of the document.
+    The base64 text of chunk presets is decoded in blocks while it is parsed,
+    so the complete text is never held in memory.
+
+    See ``PresetParser`` for the meaning of ``stats`` and ``select``.
+
+    """
+    parser = PresetParser(stats, select)
+    fp = open(source, 'rb') if isinstance(source, str) else source
+
+    try:
+        while True:
+            data = fp.read(XML_READ_SIZE)
+
+            if not data:
+                break
+
+            yield from parser.feed(data)
+
+        yield from parser.close()
+    finally:
+        if fp is not source:
+            fp.close()
+
+
+def read_ardour_presets(source, select=None):
+    """Read presets from an Ardour VST presets XML file.
+
+    ``source`` is a filename or file object.
+
+    Returns list of Preset or ChunkPreset instances. See ``PresetParser`` for
+    the meaning of ``select``.
+
+    """
+    return list(iter_ardourpresets(source, select=select))
+
+
+def scan_ardourpresets(fn):
+    """Read the metadata of all presets in an Ardour VST presets XML file.
+
+    Only the attributes of the preset elements are read, parameter values and
+    chunk data are neither converted nor decoded.
+
+    Returns list of ``PresetInfo`` instances. Raises ``ValueError`` if the
+    file is not an Ardour VST presets XML file.
+
+    """
+    from xml.parsers import expat
+
+    infos = []
+    depth = 0
+    # number of 'Parameter' elements, if the preset has no numParams attribute
+    num_children = None
+
+    def start_element(name, attrs):
+        nonlocal depth, num_children
+        depth += 1
+
+        if depth == 1 and name != 'VSTPresets':
+            raise ValueError("Root node must be 'VSTPresets'.")
+        elif depth == 2:
+            if name not in ('Preset', 'ChunkPreset'):
+                print("Invalid preset type: {}".format(name))
+                return
+
+            try:
+                _, plugin_id, version, _, label, num_params = (
+                    _parse_preset_attrib(attrs))
+            except (KeyError, ValueError):
+                print("Invalid preset format: {}".format(attrs))
+                return
+
+            infos.append(PresetInfo(name, plugin_id, version, label,
+                                    num_params))
+
+            if num_params is None and name == 'Preset':
+                num_children = 0
+        elif depth == 3 and num_children is not None:
+            num_children += 1
+
+    def end_element(name):
+        nonlocal depth, num_children
+        depth -= 1
+
+        if depth == 1 and num_children is not None:
+            infos[-1] = infos[-1]._replace(num_params=num_children)
+            num_children = None
+
+    parser = expat.ParserCreate()
+    parser.StartElementHandler = start_element
+    parser.EndElementHandler = end_element
+
+    with open(fn, 'rb') as fp:
+        try:
+            parser.ParseFile(fp)
+        except expat.ExpatError as exc:
+            raise ValueError(str(exc)) from exc
+
+    return infos
+
+
+def _escape_attrib(text):
+    # same escaping as used by xml.etree.ElementTree for attribute values
+    for char, entity in _ATTRIB_ENTITIES:
+        if char in text:
+            text = text.replace(char, entity)
+    return text
+
+
+def iter_preset_xml(preset, plugin, index, stats=None):
+    """Serialize preset as XML element incrementally.
+
+    ``index`` is the position of the preset in the list of presets written
+    for the plugin, which is used for generating the preset URI.
+
+    Yields the UTF-8 encoded XML in slices. The chunk data of ChunkPresets is
+    base64-encoded in blocks of ``B64_BLOCK_SIZE`` bytes, so the encoded
+    chunk never needs to be held in memory as a whole. The output is identical
+    to serializing the element with ``xml.etree.ElementTree``.
+
+    """
+    import hashlib
+
+    start = perf_counter()
+    sha1 = hashlib.sha1()
+    sha1.update(bytes(preset.label, 'latin1'))
+    sha1.update(bytes(str(index), 'ascii'))
+    uri = '{}:{:010d}:x{}'.format('VST', plugin, sha1.hexdigest())
+    tag = 'Preset' if isinstance(preset, Preset) else 'ChunkPreset'
+    start_tag = '<{} uri="{}" label="{}" version="{}" numParams="{}"'.format(
+        tag, _escape_attrib(uri), _escape_attrib(preset.label),
+        _escape_attrib(str(preset.plugin_version)),
+        _escape_attrib(str(preset.num_params)))
+
+    if isinstance(preset, Preset):
+        if len(preset.params):
+            yield ''.join((start_tag, '>', params_xml(preset.params),
+                           '</Preset>')).encode('utf-8')
+        else:
+            yield (start_tag + ' />').encode('utf-8')
+
+        if stats is not None:
+            stats.add('build xml', perf_counter() - start, presets=1)
+    elif isinstance(preset, ChunkPreset):
+        chunk = memoryview(preset.chunk)
+
+        if len(chunk):
+            yield (start_tag + '>').encode('utf-8')
+
+            for offset in range(0, len(chunk), B64_BLOCK_SIZE):
+                yield b2a_base64(chunk[offset:offset + B64_BLOCK_SIZE],
+                                 newline=False)
+
+            yield b'</ChunkPreset>'
+        else:
+            yield (start_tag + ' />').encode('utf-8')
+
+        if stats is not None:
+            stats.add('encode base64', perf_counter() - start,
+                      bytes=len(chunk), presets=1)
+
+
+def preset_xml(preset, plugin, index, stats=None):
+    """Return serialized XML element for preset as UTF-8 encoded bytes.
+
+    See ``iter_preset_xml`` for a description of the arguments.
+
+    """
+    return b''.join(iter_preset_xml(preset, plugin, index, stats))
+
+
+def write_ardour_presets(fp, plugin, presets, stats=None):
+    """Write Ardour VST presets XML document for plugin to binary file object.
+
+    Each preset is serialized and written as soon as it is converted, without
+    building an element tree of the whole document in memory.
+
+    """
+    start = perf_counter()
+    size = 0
+
+    def write(data):
+        nonlocal size
+        fp.write(data)
+        size += len(data)
+
+    write(XML_DECLARATION)
+
+    if presets:
+        write(b'<VSTPresets>')
+
+        for i, preset in enumerate(presets):
+            for data in iter_preset_xml(preset, plugin, i, stats):
+                write(data)
+
+        write(b'</VSTPresets>')
+    else:
+        write(b'<VSTPresets />')
+
+    if stats is not None:
+        stats.add('write xml', perf_counter() - start, bytes=size,
+                  presets=len(presets))
+
+
+class PresetIndex:
+    """Index of the preset elements in an Ardour VST presets XML file.
+
+    For each preset element, the index stores its label, its byte range in
+    the file, the end of the whitespace following it and the SHA1 hash of
+    its content. It also stores the offset of the closing root element tag.
+
+    The index is kept in a hidden JSON sidecar file next to the preset file
+    and is only considered valid, if the size and modification time of the
+    preset file match the values recorded in the index.
+
+    """
+
+    version = 1
+
+    def __init__(self, xml_fn, entries, end, empty=False):
+        self.xml_fn = xml_fn
+        self.entries = entries
+        self.end = end
+        self.empty = empty
+
+    @staticmethod
+    def sidecar_name(xml_fn):
+        """Return path of index sidecar file for given preset file."""
+        return join(dirname(xml_fn), '.' + basename(xml_fn) + '.index')
+
+    @classmethod
+    def load(cls, xml_fn):
+        """Return index for given preset file.
+
+        The index is read from the sidecar file, if it is up-to-date, or
+        otherwise rebuilt from the preset file.
+
+        """
+        import json
+
+        st = os.stat(xml_fn)
+
+        try:
+            with open(cls.sidecar_name(xml_fn), encoding='utf-8') as fp:
+                data = json.load(fp)
+
+            if (data['version'] == cls.version and
+                    data['size'] == st.st_size and
+                    data['mtime_ns'] == st.st_mtime_ns):
+                return cls(xml_fn, data['entries'], data['end'], data['empty'])
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+        return cls.build(xml_fn)
+
+    @classmethod
+    def build(cls, xml_fn):
+        """Build index by scanning given preset file.
+
+        Raises ``ValueError`` if the file is not a UTF-8 encoded Ardour VST
+        presets XML file.
+
+        """
+        import hashlib
+        import re
+        from xml.parsers import expat
+
+        with open(xml_fn, 'rb') as fp:
+            data = fp.read()
+
+        whitespace = re.compile(rb'[ \t\r\n]*')
+        parser = expat.ParserCreate()
+        entries = []
+        state = {'depth': 0}
+
+        def xml_decl(version, encoding, standalone):
+            if encoding and encoding.lower() not in ('utf-8', 'utf8'):
+                raise ValueError("Unsupported encoding: {}".format(encoding))
+
+        def start_element(name, attrs):
+            depth = state['depth']
+            if depth == 0 and name != 'VSTPresets':
+                raise ValueError("Root XML element must be 'VSTPresets'.")
+            elif depth == 1:
+                state['start'] = parser.CurrentByteIndex
+                state['label'] = attrs.get('label')
+            state['depth'] = depth + 1
+
+        def end_element(name):
+            state['depth'] -= 1
+            depth = state['depth']
+            pos = parser.CurrentByteIndex
+
+            if depth == 0:
+                state['empty'] = not data.startswith(b'</', pos)
+                state['end'] = pos
+            elif depth == 1:
+                # For non-empty elements, the parser position is at the start
+                # of the end tag, for empty elements directly after the tag.
+                end_tag = b'</' + name.encode('utf-8')
+                if (data.startswith(end_tag, pos) and
+                        data[pos + len(end_tag):pos + len(end_tag) + 1]
+                        in b'> \t\r\n'):
+                    pos = data.index(b'>', pos) + 1
+
+                start = state['start']
+                tail_end = whitespace.match(data, pos).end()
+
+                if name in ('Preset', 'ChunkPreset'):
+                    entries.append([state['label'], start, pos, tail_end,
+                                    hashlib.sha1(data[start:pos]).hexdigest()])
+
+        parser.XmlDeclHandler = xml_decl
+        parser.StartElementHandler = start_element
+        parser.EndElementHandler = end_element
+
+        try:
+            parser.Parse(data, True)
+        except expat.ExpatError as exc:
+            raise ValueError(str(exc))
+
+        if 'end' not in state:
+            raise ValueError("No root XML element found.")
+
+        return cls(xml_fn, entries, state['end'], state['empty'])
+
+    def save(self):
+        """Write index to sidecar file, recording current preset file stats."""
+        import json
+
+        st = os.stat(self.xml_fn)
+        data = {
+            'version': self.version,
+            'size': st.st_size,
+            'mtime_ns': st.st_mtime_ns,
+            'end': self.end,
+            'empty': self.empty,
+            'entries': self.entries,
+        }
+
+        with open(self.sidecar_name(self.xml_fn), 'w', encoding='utf-8') as fp:
+            json.dump(data, fp)
+
+    def update(self, edits):
+        """Apply edits to the preset file and update the index accordingly.
+
+        ``edits`` is a list of ``(entry, label, data)`` tuples, where
+        ``entry`` is the index entry of the preset element to replace
+        (including the whitespace following it) or None to append a new
+        preset element, and ``data`` is the serialized XML of the new element.
+
+        Replacements which do not change the size of the replaced range are
+        written in place. Only the part of the file from the first edit, which
+        changes the size of the file, is rewritten.
+
+        """
+        import hashlib
+
+        replaced = {}
+        appended = []
+
+        for entry, label, data in edits:
+            if entry is None:
+                appended.append((label, data))
+            elif (entry[2] != entry[3] or
+                    hashlib.sha1(data).hexdigest() != entry[4]):
+                replaced[id(entry)] = data
+
+        splices = [(entry[1], entry[3], replaced[id(entry)])
+                   for entry in self.entries if id(entry) in replaced]
+
+        if appended:
+            data = b''.join(data for _, data in appended)
+            if self.empty:
+                # replace '/>' of empty root element
+                splices.append((self.end - 2, self.end,
+                                b'>' + data + b'</VSTPresets>'))
+            else:
+                splices.append((self.end, self.end, data))
+
+        if not splices:
+            return False
+
+        with open(self.xml_fn, 'r+b') as fp:
+            # write replacements which do not change the size in place
+            for i, (start, end, data) in enumerate(splices):
+                if len(data) != end - start:
+                    break
+                fp.seek(start)
+                fp.write(data)
+            else:
+                i = len(splices)
+
+            if i < len(splices):
+                # rewrite the rest of the file
+                offset = splices[i][0]
+                fp.seek(offset)
+                tail = fp.read()
+                out = []
+                pos = offset
+
+                for start, end, data in splices[i:]:
+                    out.append(tail[pos - offset:start - offset])
+                    out.append(data)
+                    pos = end
+
+                out.append(tail[pos - offset:])
+                fp.seek(offset)
+                fp.write(b''.join(out))
+                fp.truncate()
+
+        shift = 0
+        entries = []
+        for entry in self.entries:
+            data = replaced.get(id(entry))
+            start = entry[1] + shift
+
+            if data is None:
+                entries.append([entry[0], start, entry[2] + shift,
+                                entry[3] + shift, entry[4]])
+            else:
+                end = start + len(data)
+                entries.append([entry[0], start, end, end,
+                                hashlib.sha1(data).hexdigest()])
+                shift += len(data) - (entry[3] - entry[1])
+
+        pos = self.end + shift
+        if appended and self.empty:
+            pos -= 1
+            self.empty = False
+
+        for label, data in appended:
+            entries.append([label, pos, pos + len(data), pos + len(data),
+                            hashlib.sha1(data).hexdigest()])
+            pos += len(data)
+
+        self.entries = entries
+        self.end = pos
+        return True
+
+
+def _update_presetfile(xml_fn, plugin, presets, merge=False, stats=None):
+    start = perf_counter()
+
+    try:
+        index = PresetIndex.load(xml_fn)
+    except Exception as exc:
+        raise PresetFileError(
+            "Output file '{}' already exists, but does not seem to be an "
+            "Ardour VST preset file. Cannot merge.\n{}".format(xml_fn, exc))
+
+    if stats is not None:
+        stats.add('load index', perf_counter() - start)
+
+    preset_entries = {}
+    for entry in index.entries:
+        preset_entries.setdefault(entry[0], []).append(entry)
+
+    edits = []
+    for i, preset in enumerate(presets):
+        data = preset_xml(preset, plugin, i, stats)
+
+        if merge and preset.label in preset_entries:
+            # replace next existing preset with same label
+            entry = preset_entries[preset.label].pop(0)
+
+            # if no more presets with this label exist, remove the key
+            if not preset_entries[preset.label]:
+                del preset_entries[preset.label]
+        else:
+            entry = None
+
+        edits.append((entry, preset.label, data))
+
+    start = perf_counter()
+    index.update(edits)
+    index.save()
+
+    if stats is not None:
+        stats.add('patch xml', perf_counter() - start,
+                  bytes=sum(len(edit[2]) for edit in edits),
+                  presets=len(edits))
+
+
+def write_presetfile(xml_fn, plugin, presets, append=False, merge=False,
+                     stats=None):
+    """Write presets for plugin to an Ardour VST presets XML file.
+
+    If ``append`` or ``merge`` is true and ``xml_fn`` exists, the presets are
+    appended resp. merged into the existing file. Raises ``PresetFileError``
+    if the existing file is not a valid Ardour VST presets file.
+
+    Appending and merging only patches the changed parts of the existing
+    file, using a ``PresetIndex`` to locate the existing presets.
+
+    If a ``Stats`` instance is passed as ``stats``, the time spent on the
+    different stages of writing is recorded in it.
+
+    """
+    if (append or merge) and exists(xml_fn):
+        return _update_presetfile(xml_fn, plugin, presets, merge, stats)
+
+    with open(xml_fn, 'wb') as fp:
+        write_ardour_presets(fp, plugin, presets, stats)
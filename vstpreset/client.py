@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+#
+# vstpreset/client.py
+#
+"""Client for the resident conversion server (see ``vstpreset.server``).
+
+The scripts use ``call_server`` to forward their command line to the server,
+if it is running. Only the standard library modules needed to check for the
+server socket are imported up front, so this costs next to nothing when no
+server is running.
+
+"""
+
+import os
+import stat
+import sys
+
+from os.path import join
+
+
+SOCKET_ENV_VAR = 'VSTPRESET_SOCKET'
+
+
+def socket_path():
+    """Return path of the server socket.
+
+    The path can be set with the environment variable ``VSTPRESET_SOCKET``.
+    Otherwise it is ``vstpreset-UID.sock`` in ``$XDG_RUNTIME_DIR``,
+    ``$TMPDIR`` or ``/tmp``.
+
+    """
+    path = os.environ.get(SOCKET_ENV_VAR)
+
+    if not path:
+        runtime_dir = (os.environ.get('XDG_RUNTIME_DIR') or
+                       os.environ.get('TMPDIR') or '/tmp')
+        uid = os.getuid() if hasattr(os, 'getuid') else 0
+        path = join(runtime_dir, 'vstpreset-{:d}.sock'.format(uid))
+
+    return path
+
+
+def _is_own_socket(path):
+    """Return True if path is a socket owned by the current user.
+
+    Sockets in a shared directory like ``/tmp`` could be created by another
+    user, who would then receive the command lines and could fake their
+    results.
+
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return False
+
+    return stat.S_ISSOCK(st.st_mode) and (
+        not hasattr(os, 'getuid') or st.st_uid == os.getuid())
+
+
+def _connect(path=None):
+    path = path or socket_path()
+
+    if not _is_own_socket(path):
+        return None
+
+    import socket
+
+    if not hasattr(socket, 'AF_UNIX'):
+        return None
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        return None
+
+    return sock
+
+
+def request(req, path=None):
+    """Send request to the server and yield its response messages.
+
+    ``req`` is a dict, which is sent JSON-encoded. Each response message is
+    yielded as a dict. The last message contains the key ``status``.
+
+    Raises ``ConnectionRefusedError`` if no server is listening on the socket
+    and ``ConnectionError`` if it closed the connection before sending the
+    final message.
+
+    """
+    import json
+
+    sock = _connect(path)
+    if sock is None:
+        raise ConnectionRefusedError("Conversion server is not running.")
+
+    with sock, sock.makefile('rwb') as fp:
+        fp.write(json.dumps(req).encode('utf-8') + b'\n')
+        fp.flush()
+
+        for line in fp:
+            msg = json.loads(line.decode('utf-8'))
+            yield msg
+
+            if 'status' in msg:
+                return
+
+    raise ConnectionError("Conversion server closed the connection.")
+
+
+def call_server(script, args, path=None, cwd=None):
+    """Run script with given command line arguments in the conversion server.
+
+    Output of the script is written to ``sys.stdout`` resp. ``sys.stderr`` as
+    it is received. Relative paths in the arguments are resolved relative to
+    ``cwd`` (default: the current working directory).
+
+    Returns the exit status or None, if the server is not running or its
+    socket is not owned by the current user.
+
+    """
+    if not _is_own_socket(path or socket_path()):
+        return None
+
+    req = {'op': 'run', 'script': script, 'args': args,
+           'cwd': cwd or os.getcwd()}
+
+    try:
+        for msg in request(req, path):
+            if 'stdout' in msg:
+                sys.stdout.write(msg['stdout'])
+            elif 'stderr' in msg:
+                sys.stderr.write(msg['stderr'])
+            elif 'error' in msg:
+                print(msg['error'], file=sys.stderr)
+            elif 'status' in msg:
+                sys.stdout.flush()
+                return msg['status']
+    except ConnectionRefusedError:
+        return None
+    except ConnectionError as exc:
+        print(exc, file=sys.stderr)
+        return 1
+
+
+def convert(data, source, fx_version=None, path=None):
+    """Convert preset data in the conversion server.
+
+    ``data`` is the content of an Ardour VST presets XML file (if ``source``
+    is ``'ardour'``) or of an FXP preset or FXB bank file (``'fxp'``).
+
+    Returns a list of dicts with the keys ``plugin_id``, ``label`` and
+    ``data`` (the FXP program data), one per preset, resp. with the keys
+    ``plugin_id`` and ``data`` (the Ardour presets XML data), one per plugin.
+
+    Raises ``ConnectionError`` if the server is not running and
+    ``ValueError`` if the data could not be converted.
+
+    """
+    from binascii import a2b_base64, b2a_base64
+
+    req = {
+        'op': 'convert',
+        'source': source,
+        'data': b2a_base64(data, newline=False).decode('ascii'),
+        'fx_version': fx_version,
+    }
+    results = []
+
+    for msg in request(req, path):
+        if 'result' in msg:
+            result = msg['result']
+            result['data'] = a2b_base64(result['data'])
+            results.append(result)
+        elif 'error' in msg:
+            raise ValueError(msg['error'])
+
+    return results
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+#
+# vstpreset/core.py
+#
+"""Constants and preset types shared by the FXP and Ardour preset modules."""
+
+from array import array
+from collections import namedtuple
+from struct import Struct, calcsize
+
+
+FXP_HEADER_FMT = '>4si4s4i28s'
+FXP_PREAMBEL_SIZE = calcsize('>4si')
+FXP_HEADER_SIZE = calcsize(FXP_HEADER_FMT)
+FXP_FORMAT_VERSION = 1
+FXB_HEADER_FMT = '>4si4s4i128s'
+FXB_HEADER_SIZE = calcsize(FXB_HEADER_FMT)
+FXB_FORMAT_VERSION = 1
+CHUNK_MAGIC = b'CcnK'
+FX_MAGIC_PARAMS = b'FxCk'
+FX_MAGIC_CHUNK = b'FPCh'
+FX_MAGIC_BANK_PARAMS = b'FxBk'
+FX_MAGIC_BANK_CHUNK = b'FBCh'
+FX_DEFAULT_VERSION = 1
+FXP_HEADER = Struct(FXP_HEADER_FMT)
+FXB_HEADER = Struct(FXB_HEADER_FMT)
+CHUNK_SIZE = Struct('>i')
+PRESET_BASE_FIELDS = (
+    'type',
+    'plugin_id',
+    'plugin_version',
+    'hash',
+    'label',
+    'num_params',
+)
+
+# Preset metadata read without the parameter values or chunk data. ``type``
+# is 'Preset' or 'ChunkPreset'.
+PresetInfo = namedtuple(
+    'PresetInfo',
+    ('type', 'plugin_id', 'plugin_version', 'label', 'num_params')
+)
+
+
+class _PresetBase:
+    """Base class of the compact preset record types.
+
+    Instances behave like named tuples: fields can be accessed by name,
+    iterated over in order and replaced with ``_replace``. Two presets compare
+    equal if they are of the same type and their field values are equal.
+    Parameter values are stored in an ``array('f')``, so they take four bytes
+    each instead of a Python float object.
+
+    """
+
+    __slots__ = ()
+    _fields = ()
+
+    def __init__(self, *args, **kwargs):
+        values = dict(zip(self._fields, args), **kwargs)
+
+        if len(args) > len(self._fields) or len(values) != len(self._fields):
+            raise TypeError("{}() takes fields {}".format(
+                type(self).__name__, ', '.join(self._fields)))
+
+        for name in self._fields:
+            setattr(self, name, values[name])
+
+    def __iter__(self):
+        return (getattr(self, name) for name in self._fields)
+
+    def __eq__(self, other):
+        if type(self) is not type(other):
+            return NotImplemented
+        return tuple(self) == tuple(other)
+
+    def __hash__(self):
+        return hash((type(self).__name__,) + tuple(
+            value.tobytes() if isinstance(value, (array, memoryview))
+            else value for value in self))
+
+    def __repr__(self):
+        return '{}({})'.format(type(self).__name__, ', '.join(
+            '{}={!r}'.format(name, getattr(self, name))
+            for name in self._fields))
+
+    def __reduce__(self):
+        return type(self), tuple(self)
+
+    def _replace(self, **kwargs):
+        return type(self)(**dict(zip(self._fields, self), **kwargs))
+
+
+class ChunkPreset(_PresetBase):
+    """Preset storing the plugin state as an opaque binary chunk."""
+
+    __slots__ = _fields = PRESET_BASE_FIELDS + ('chunk',)
+
+
+class Preset(_PresetBase):
+    """Preset storing the plugin state as a list of parameter values."""
+
+    __slots__ = _fields = PRESET_BASE_FIELDS + ('params',)
+
+
+def preset_digest(preset):
+    """Return hash of the plugin ID, type and payload of a preset.
+
+    The payload are the parameter values resp. the chunk data, so presets
+    differing only in label or plugin version have the same digest.
+
+    """
+    import hashlib
+
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(type(preset).__name__.encode('ascii'))
+    digest.update(preset.plugin_id.to_bytes(4, 'big'))
+
+    if isinstance(preset, Preset):
+        digest.update(array('f', preset.params).tobytes())
+    else:
+        digest.update(preset.chunk)
+
+    return digest.digest()
@@ -0,0 +1,511 @@
+# -*- coding: utf-8 -*-
+#
+# vstpreset/fxp.py
+#
+"""Read and write VST2 FXP preset and FXB preset bank files."""
+
+import io
+import mmap
+import sys
+
+from array import array
+from collections import namedtuple
+from os import PathLike
+from struct import unpack_from
+
+from .core import (CHUNK_MAGIC, CHUNK_SIZE, FX_DEFAULT_VERSION,
+                   FX_MAGIC_BANK_CHUNK, FX_MAGIC_BANK_PARAMS, FX_MAGIC_CHUNK,
+                   FX_MAGIC_PARAMS, FXB_FORMAT_VERSION, FXB_HEADER,
+                   FXB_HEADER_FMT, FXB_HEADER_SIZE, FXP_FORMAT_VERSION,
+                   FXP_HEADER, FXP_HEADER_FMT, FXP_HEADER_SIZE,
+                   FXP_PREAMBEL_SIZE, ChunkPreset, Preset, PresetInfo)
+
+
+FXPHeader = namedtuple(
+    'FXPHeader',
+    ('magic', 'size', 'type', 'version', 'plugin_id', 'plugin_version',
+     'num_params', 'label')
+)
+FXBHeader = namedtuple(
+    'FXBHeader',
+    ('magic', 'size', 'type', 'version', 'plugin_id', 'plugin_version',
+     'num_programs', 'future')
+)
+
+# number of bytes needed by peek_presetinfo
+FXP_PEEK_SIZE = FXP_HEADER_SIZE + CHUNK_SIZE.size
+
+
+class FXPParseException(Exception):
+    """Raised when there is an error parsing FXP file data."""
+
+
+def _parse_program(buf, offset=0, select=None):
+    """Parse a single FXP program from buffer starting at given offset.
+
+    Returns a ``(preset, end)`` tuple, where ``preset`` is a Preset or
+    ChunkPreset instance and ``end`` the offset of the first byte after the
+    program data. The chunk data of a ChunkPreset is a ``memoryview`` slice of
+    ``buf``, i.e. it is not copied.
+
+    If the program is not selected by ``select`` (see ``parse_buffer``),
+    ``preset`` is None and the program data is not converted.
+
+    """
+    end = offset + FXP_HEADER_SIZE
+    if len(buf) < end:
+        raise FXPParseException("FXP program header truncated.")
+
+    fxp = FXPHeader(*unpack_from(FXP_HEADER_FMT, buf, offset))
+    if fxp.magic != CHUNK_MAGIC:
+        raise FXPParseException("Invalid magic header bytes for FXP file.")
+    label = fxp.label.rstrip(b'\0').decode('latin1')
+
+    if fxp.type == FX_MAGIC_PARAMS:
+        offset, end = end, end + fxp.num_params * 4
+        if len(buf) < end:
+            raise FXPParseException("Program parameter data truncated.")
+
+        if select is not None and not select('Preset', fxp.plugin_id, label):
+            return None, end
+
+        params = array('f')
+        params.frombytes(buf[offset:end])
+        if sys.byteorder == 'little':
+            params.byteswap()
+
+        preset = Preset('VST', fxp.plugin_id, fxp.plugin_version,
+                        None, label, fxp.num_params, params)
+    elif fxp.type == FX_MAGIC_CHUNK:
+        if len(buf) < end + 4:
+            raise FXPParseException("Program chunk size truncated.")
+
+        chunk_size = unpack_from('>i', buf, end)[0]
+        offset, end = end + 4, end + 4 + chunk_size
+
+        if select is not None and not select('ChunkPreset', fxp.plugin_id,
+                                             label):
+            if len(buf) < end:
+                raise FXPParseException("Program chunk data truncated.")
+            return None, end
+
+        chunk = memoryview(buf)[offset:end]
+        if len(chunk) != chunk_size:
+            raise FXPParseException(
+                "Program chunk data truncated, expected {:d} bytes, "
+                "read {:d}.".format(chunk_size, len(chunk)))
+        preset = ChunkPreset('VST', fxp.plugin_id, fxp.plugin_version,
+                             None, label, fxp.num_params, chunk)
+    else:
+        raise FXPParseException("Invalid program type magic bytes. Type "
+                                "'{}' not supported.".format(fxp.type))
+
+    return preset, end
+
+
+def _parse_bank(buf, select=None):
+    if len(buf) < FXB_HEADER_SIZE:
+        raise FXPParseException("FXB bank header truncated.")
+
+    fxb = FXBHeader(*unpack_from(FXB_HEADER_FMT, buf))
+    if fxb.magic != CHUNK_MAGIC:
+        raise FXPParseException("Invalid magic header bytes for FXB file.")
+
+    if fxb.type == FX_MAGIC_BANK_CHUNK:
+        raise FXPParseException("FXB banks with opaque chunk data (type "
+                                "'FBCh') are not supported.")
+    elif fxb.type != FX_MAGIC_BANK_PARAMS:
+        raise FXPParseException("Invalid bank type magic bytes. Type "
+                                "'{}' not supported.".format(fxb.type))
+
+    presets = []
+    offset = FXB_HEADER_SIZE
+    for _ in range(fxb.num_programs):
+        preset, offset = _parse_program(buf, offset, select)
+        if preset is not None:
+            presets.append(preset)
+
+    return presets
+
+
+def parse_buffer(buf, select=None):
+    """Parse VST2 FXP preset or FXB bank data from a bytes-like object.
+
+    The data type is determined by the magic bytes in the header.
+
+    Returns list of Preset or ChunkPreset instances. The chunk data of
+    ChunkPresets are ``memoryview`` slices of ``buf``.
+
+    If ``select`` is given, it is called with the preset type name ('Preset'
+    or 'ChunkPreset'), plugin ID and label from the header of each program,
+    e.g. a ``vstpreset.util.PresetFilter``. Programs for which it returns
+    false are skipped, without converting parameter values or accessing
+    chunk data.
+
+    """
+    fx_magic = bytes(buf[FXP_PREAMBEL_SIZE:FXP_PREAMBEL_SIZE + 4])
+
+    if fx_magic in (FX_MAGIC_BANK_PARAMS, FX_MAGIC_BANK_CHUNK):
+        return _parse_bank(buf, select)
+
+    preset = _parse_program(buf, 0, select)[0]
+    return [] if preset is None else [preset]
+
+
+class FXPFile:
+    """Memory-mapped, read-only VST2 FXP preset or FXB bank file.
+
+    Use as a context manager::
+
+        with FXPFile('preset.fxp') as fxp:
+            for preset in fxp.presets:
+                ...
+
+    The chunk data of ChunkPresets are ``memoryview`` slices of the mapped
+    file, so no chunk data is copied. They are only valid until the file is
+    closed and references to them must not be kept beyond that.
+
+    See ``parse_buffer`` for the meaning of ``select``. The pages of the file
+    holding the data of programs, which are not selected, are never read.
+
+    """
+
+    def __init__(self, fn, select=None):
+        self.fn = fn
+        with open(fn, 'rb') as fp:
+            try:
+                self._mmap = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # empty files can not be mapped
+                raise FXPParseException("FXP program header truncated.")
+
+        try:
+            self.presets = parse_buffer(self._mmap, select)
+        except Exception:
+            self._mmap.close()
+            raise
+
+    def close(self):
+        """Unmap the file data."""
+        self.presets = []
+        try:
+            self._mmap.close()
+        except BufferError:
+            # Some chunk views are still referenced elsewhere. The mapping
+            # will be released when they are garbage collected.
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _copy_chunk(preset):
+    if isinstance(preset, ChunkPreset):
+        preset = preset._replace(chunk=preset.chunk.tobytes())
+    return preset
+
+
+def parse_fxp(fn):
+    """Parse VST2 FXP preset file.
+
+    Returns Preset or ChunkPreset instance.
+
+    """
+    with FXPFile(fn) as fxp:
+        if len(fxp.presets) != 1:
+            raise FXPParseException("Not an FXP preset file.")
+        return _copy_chunk(fxp.presets[0])
+
+
+def parse_fxb(fn):
+    """Parse VST2 FXB preset bank file.
+
+    Returns list of Preset or ChunkPreset instances, one for each program in
+    the bank. Only regular banks (type 'FxBk') can be parsed, banks which
+    store the state of all programs as one opaque chunk (type 'FBCh') are not
+    supported, since they can not be split into single presets.
+
+    """
+    with open(fn, 'rb') as fp:
+        return [_copy_chunk(preset) for preset in _parse_bank(fp.read())]
+
+
+def parse_presetfile(fn, select=None):
+    """Parse VST2 FXP preset or FXB bank file.
+
+    The file type is determined by the magic bytes in the file header.
+
+    Returns list of Preset or ChunkPreset instances. See ``parse_buffer`` for
+    the meaning of ``select``.
+
+    """
+    with FXPFile(fn, select) as fxp:
+        return [_copy_chunk(preset) for preset in fxp.presets]
+
+
+def _scan_program(fp):
+    data = fp.read(FXP_HEADER_SIZE)
+    if len(data) < FXP_HEADER_SIZE:
+        raise FXPParseException("FXP program header truncated.")
+
+    fxp = FXPHeader(*FXP_HEADER.unpack(data))
+    if fxp.magic != CHUNK_MAGIC:
+        raise FXPParseException("Invalid magic header bytes for FXP file.")
+
+    if fxp.type == FX_MAGIC_PARAMS:
+        type = 'Preset'
+        size = fxp.num_params * 4
+    elif fxp.type == FX_MAGIC_CHUNK:
+        type = 'ChunkPreset'
+        data = fp.read(CHUNK_SIZE.size)
+        if len(data) < CHUNK_SIZE.size:
+            raise FXPParseException("Program chunk size truncated.")
+        size = CHUNK_SIZE.unpack(data)[0]
+    else:
+        raise FXPParseException("Invalid program type magic bytes. Type "
+                                "'{}' not supported.".format(fxp.type))
+
+    # skip parameter values resp. chunk data
+    fp.seek(size, 1)
+    return PresetInfo(type, fxp.plugin_id, fxp.plugin_version,
+                      fxp.label.rstrip(b'\0').decode('latin1'), fxp.num_params)
+
+
+def peek_presetinfo(data):
+    """Return metadata of FXP program from the start of its file data.
+
+    ``data`` must contain at least the first ``FXP_PEEK_SIZE`` bytes of the
+    file, if it is that long. Returns a ``PresetInfo`` instance or None if the
+    data is the start of an FXB bank, which may contain programs for different
+    plugins.
+
+    """
+    if data[FXP_PREAMBEL_SIZE:FXP_PREAMBEL_SIZE + 4] in (
+            FX_MAGIC_BANK_PARAMS, FX_MAGIC_BANK_CHUNK):
+        return None
+
+    return _scan_program(io.BytesIO(data))
+
+
+def scan_presetfile(fn):
+    """Read the metadata of all presets in a VST2 FXP or FXB file.
+
+    Only the FXP program headers (and the FXB bank header) are read, the
+    parameter values and chunk data are skipped.
+
+    Returns list of ``PresetInfo`` instances.
+
+    """
+    with open(fn, 'rb') as fp:
+        data = fp.read(FXP_PREAMBEL_SIZE + 4)
+        fx_magic = data[FXP_PREAMBEL_SIZE:]
+
+        if fx_magic not in (FX_MAGIC_BANK_PARAMS, FX_MAGIC_BANK_CHUNK):
+            fp.seek(0)
+            return [_scan_program(fp)]
+
+        data += fp.read(FXB_HEADER_SIZE - len(data))
+        if len(data) < FXB_HEADER_SIZE:
+            raise FXPParseException("FXB bank header truncated.")
+
+        fxb = FXBHeader(*FXB_HEADER.unpack(data))
+        if fxb.magic != CHUNK_MAGIC:
+            raise FXPParseException("Invalid magic header bytes for FXB "
+                                    "file.")
+        elif fxb.type == FX_MAGIC_BANK_CHUNK:
+            raise FXPParseException("FXB banks with opaque chunk data (type "
+                                    "'FBCh') are not supported.")
+
+        return [_scan_program(fp) for _ in range(fxb.num_programs)]
+
+
+def read_fxp(source, select=None):
+    """Read presets from a VST2 FXP preset or FXB bank file.
+
+    ``source`` is a file name or a bytes-like object containing the file
+    data. The file type is determined by the magic bytes in the header.
+
+    Returns list of Preset or ChunkPreset instances. The chunk data of
+    ChunkPresets is copied, i.e. it does not reference ``source``. See
+    ``parse_buffer`` for the meaning of ``select``.
+
+    """
+    if isinstance(source, (str, PathLike)):
+        return parse_presetfile(source, select)
+
+    return [_copy_chunk(preset) for preset in parse_buffer(source, select)]
+
+
+def pack_fxp_parts(preset, fx_version=None):
+    """Return VST2 FXP program data for preset as header and payload.
+
+    Returns a ``(header, payload)`` tuple, where ``header`` is a bytearray
+    with the FXP header, including the chunk size for ChunkPresets, and
+    ``payload`` is the chunk data resp. an ``array`` with the parameter values
+    in FXP (big-endian) byte order. See ``pack_fxp`` for the meaning of
+    ``fx_version``.
+
+    """
+    if fx_version is None:
+        if preset.plugin_version is not None:
+            fx_version = preset.plugin_version
+        else:
+            fx_version = FX_DEFAULT_VERSION
+
+    if isinstance(preset, Preset):
+        if preset.num_params is None:
+            num_params = len(preset.params)
+        else:
+            num_params = preset.num_params
+
+        if num_params != len(preset.params):
+            raise ValueError(
+                "Preset {!r} has {:d} parameters, expected {:d}.".format(
+                    preset.label, len(preset.params), num_params))
+
+        data_size = num_params * 4
+        fx_magic = FX_MAGIC_PARAMS
+    elif isinstance(preset, ChunkPreset):
+        if preset.num_params is None:
+            num_params = int(len(preset.chunk) / 4)
+        else:
+            num_params = preset.num_params
+
+        data_size = CHUNK_SIZE.size + len(preset.chunk)
+        fx_magic = FX_MAGIC_CHUNK
+    else:
+        raise TypeError("Wrong preset type: {!r}".format(preset))
+
+    header_size = FXP_HEADER_SIZE
+    if fx_magic == FX_MAGIC_CHUNK:
+        header_size += CHUNK_SIZE.size
+
+    header = bytearray(header_size)
+    FXP_HEADER.pack_into(
+        header,
+        0,
+        CHUNK_MAGIC,
+        FXP_HEADER_SIZE - FXP_PREAMBEL_SIZE + data_size,
+        fx_magic,
+        FXP_FORMAT_VERSION,
+        preset.plugin_id,
+        fx_version,
+        num_params,
+        preset.label.encode('latin1', errors='replace')
+    )
+
+    if fx_magic == FX_MAGIC_PARAMS:
+        # convert the parameter values as a whole to FXP byte order
+        payload = array('f', preset.params)
+        if sys.byteorder == 'little':
+            payload.byteswap()
+    else:
+        CHUNK_SIZE.pack_into(header, FXP_HEADER_SIZE, len(preset.chunk))
+        payload = preset.chunk
+
+    return header, payload
+
+
+def pack_fxp(preset, fx_version=None):
+    """Return VST2 FXP program data for preset as a bytearray.
+
+    If ``fx_version`` is None, the plugin version of the preset is used or,
+    if that is not set either, ``FX_DEFAULT_VERSION``.
+
+    """
+    buf, payload = pack_fxp_parts(preset, fx_version)
+    buf += payload
+    return buf
+
+
+def program_digest(data):
+    """Return hash of the plugin ID, type and payload of FXP program data.
+
+    ``data`` is FXP program data as returned by ``pack_fxp``. The payload are
+    the parameter values resp. the chunk data, so programs differing only in
+    label or plugin version have the same digest.
+
+    """
+    import hashlib
+
+    data = memoryview(data)
+    digest = hashlib.blake2b(digest_size=16)
+    # program type and plugin ID from the FXP header
+    digest.update(data[8:12])
+    digest.update(data[16:20])
+    digest.update(data[FXP_HEADER_SIZE:])
+    return digest.digest()
+
+
+def write_fxp(fp, preset, fx_version=None):
+    """Write preset as VST2 FXP program to given binary file object.
+
+    The FXP header, including the chunk size of ChunkPresets, is written
+    first and the parameter values resp. chunk data are written directly
+    after it, without copying them into a buffer for the whole program. See
+    ``pack_fxp`` for the meaning of ``fx_version``.
+
+    """
+    header, payload = pack_fxp_parts(preset, fx_version)
+    fp.write(header)
+    fp.write(payload)
+
+
+def pack_fxb(plugin_id, programs, fx_version=None):
+    """Return VST2 FXB preset bank data as a bytearray.
+
+    ``programs`` is a sequence of FXP program data, as returned by
+    ``pack_fxp``, for presets of the plugin with the given ``plugin_id``.
+
+    If ``fx_version`` is None, the plugin version of the first program is
+    used.
+
+    Only programs with parameter values can be stored in a regular bank (type
+    'FxBk'). Plugins storing their state as a chunk save banks as one opaque
+    chunk (type 'FBCh') instead, which can not be assembled from programs, so
+    ``ValueError`` is raised for chunk programs.
+
+    """
+    for data in programs:
+        # program type from the FXP header
+        if bytes(data[8:12]) == FX_MAGIC_CHUNK:
+            raise ValueError("FXB banks can not contain chunk programs.")
+
+    if fx_version is None:
+        fx_version = (FXP_HEADER.unpack_from(programs[0])[5]
+                      if programs else FX_DEFAULT_VERSION)
+
+    size = FXB_HEADER_SIZE + sum(len(data) for data in programs)
+    buf = bytearray(size)
+    FXB_HEADER.pack_into(
+        buf,
+        0,
+        CHUNK_MAGIC,
+        size - FXP_PREAMBEL_SIZE,
+        FX_MAGIC_BANK_PARAMS,
+        FXB_FORMAT_VERSION,
+        plugin_id,
+        fx_version,
+        len(programs),
+        b''
+    )
+
+    offset = FXB_HEADER_SIZE
+    for data in programs:
+        buf[offset:offset + len(data)] = data
+        offset += len(data)
+
+    return buf
+
+
+def write_fxb(fp, plugin_id, programs, fx_version=None):
+    """Write VST2 FXB preset bank to given binary file object.
+
+    The bank data is written with a single call to ``fp.write``. See
+    ``pack_fxb`` for the meaning of the arguments.
+
+    """
+    fp.write(pack_fxb(plugin_id, programs, fx_version))
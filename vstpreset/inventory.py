@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+#
+# vstpreset/inventory.py
+#
+"""Build and query an inventory of VST2 presets in FXP/FXB and Ardour files.
+
+Only the preset metadata (plugin ID, preset type, plugin version, label and
+number of parameters) is read from the preset files, without decoding the
+parameter values or chunk data. The inventory is stored in an SQLite database,
+which is updated incrementally: only files, whose modification time or size
+changed since the last scan, are read again. Queries are answered from the
+database without reading any preset files.
+
+Scan directories and list all presets for a plugin with::
+
+    $ python -m vstpreset.inventory -r ~/.config/ardour6/presets -r my-fxps
+    $ python -m vstpreset.inventory -p OXFM
+
+"""
+
+import os
+import sys
+
+from os.path import abspath, basename, isdir, join
+from struct import pack
+
+from .util import find_files, parse_plugin_id
+
+
+INVENTORY_FILENAME = 'vstpreset-inventory.sqlite'
+SCAN_PATTERNS = ('*.fxp', '*.fxb', 'vst-*')
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    error TEXT
+);
+CREATE TABLE IF NOT EXISTS presets (
+    path TEXT NOT NULL REFERENCES files (path) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    type TEXT NOT NULL,
+    plugin_id INTEGER NOT NULL,
+    plugin_version INTEGER,
+    label TEXT NOT NULL,
+    num_params INTEGER,
+    PRIMARY KEY (path, position)
+);
+CREATE INDEX IF NOT EXISTS presets_plugin_id ON presets (plugin_id);
+CREATE INDEX IF NOT EXISTS presets_label ON presets (label COLLATE NOCASE);
+"""
+
+
+def format_plugin_id(plugin_id):
+    """Return plugin ID as four characters, if printable, else as integer."""
+    plugin_id &= 0xFFFFFFFF
+    name = pack('>I', plugin_id).decode('latin1')
+    return name if name.isascii() and name.isprintable() else str(plugin_id)
+
+
+def scan_file(fn):
+    """Read metadata of all presets in an FXP/FXB or Ardour presets file.
+
+    The file type is determined by the file name extension.
+
+    Returns list of ``PresetInfo`` instances. Plugin IDs are normalized to
+    unsigned integers, since FXP headers store them signed.
+
+    """
+    if fn.lower().endswith(('.fxp', '.fxb')):
+        from .fxp import scan_presetfile
+        infos = scan_presetfile(fn)
+    else:
+        from .ardour import scan_ardourpresets
+        infos = scan_ardourpresets(fn)
+
+    return [info._replace(plugin_id=info.plugin_id & 0xFFFFFFFF)
+            for info in infos]
+
+
+def _glob_to_like(pattern):
+    # translate shell-style wildcards to an SQL LIKE pattern
+    trans = {'\\': '\\\\', '%': '\\%', '_': '\\_', '*': '%', '?': '_'}
+    return ''.join(trans.get(c, c) for c in pattern)
+
+
+class Inventory:
+    """Preset inventory stored in an SQLite database.
+
+    Use as a context manager, which commits changes to the database and
+    closes it.
+
+    """
+
+    def __init__(self, path=INVENTORY_FILENAME):
+        import sqlite3
+
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.execute('PRAGMA foreign_keys = ON')
+        self.db.executescript(_SCHEMA)
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def update(self, paths):
+        """Scan files and directories, updating the inventory incrementally.
+
+        ``paths`` is a list of preset files and directories, which are
+        searched recursively for files matching ``SCAN_PATTERNS``. Files, whose
+        modification time and size did not change since they were last
+        scanned, are skipped. Inventory entries for files, which no longer
+        exist below the given directories, are removed.
+
+        Returns ``(scanned, unchanged, removed)`` tuple with the number of
+        files.
+
+        """
+        known = {row[0]: tuple(row[1:]) for row in self.db.execute(
+            'SELECT path, mtime_ns, size FROM files')}
+        scanned = unchanged = 0
+        seen = set()
+
+        for path in paths:
+            path = abspath(path)
+            files = find_files(path, SCAN_PATTERNS) if isdir(path) else [path]
+
+            for fn in files:
+                try:
+                    st = os.stat(fn)
+                except OSError as exc:
+                    print("Could not read '{}': {}".format(fn, exc),
+                          file=sys.stderr)
+                    continue
+
+                seen.add(fn)
+
+                if known.get(fn) == (st.st_mtime_ns, st.st_size):
+                    unchanged += 1
+                    continue
+
+                self._scan(fn, st)
+                scanned += 1
+
+        # remove files, which were deleted from scanned directories
+        dirs = tuple(join(abspath(path), '') for path in paths
+                     if isdir(path))
+        removed = [(fn,) for fn in known
+                   if fn not in seen and fn.startswith(dirs)]
+        self.db.executemany('DELETE FROM files WHERE path = ?', removed)
+        self.db.commit()
+        return scanned, unchanged, len(removed)
+
+    def _scan(self, fn, st):
+        try:
+            infos = scan_file(fn)
+            error = None
+        except Exception as exc:
+            print("Could not scan '{}': {}".format(fn, exc),
+                  file=sys.stderr)
+            infos = []
+            error = str(exc)
+
+        self.db.execute('DELETE FROM files WHERE path = ?', (fn,))
+        self.db.execute('INSERT INTO files VALUES (?, ?, ?, ?)',
+                        (fn, st.st_mtime_ns, st.st_size, error))
+        self.db.executemany(
+            'INSERT INTO presets VALUES (?, ?, ?, ?, ?, ?, ?)',
+            ((fn, i) + tuple(info) for i, info in enumerate(infos)))
+
+    def query(self, plugin_id=None, label=None):
+        """Return list of presets in the inventory.
+
+        ``plugin_id`` restricts the result to presets for the plugin with the
+        given (integer) ID, ``label`` to presets whose label matches the given
+        shell-style pattern case-insensitively.
+
+        Each preset is returned as a ``(path, PresetInfo)`` tuple, ordered by
+        plugin ID, label and path.
+
+        """
+        from .core import PresetInfo
+
+        sql = ('SELECT path, type, plugin_id, plugin_version, label, '
+               'num_params FROM presets')
+        conditions = []
+        args = []
+
+        if plugin_id is not None:
+            conditions.append('plugin_id = ?')
+            args.append(plugin_id & 0xFFFFFFFF)
+
+        if label is not None:
+            conditions.append("label LIKE ? ESCAPE '\\'")
+            args.append(_glob_to_like(label))
+
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+
+        sql += ' ORDER BY plugin_id, label COLLATE NOCASE, path, position'
+        return [(row[0], PresetInfo(*row[1:]))
+                for row in self.db.execute(sql, args)]
+
+
+def main(args=None):
+    import argparse
+
+    argparser = argparse.ArgumentParser(
+        prog='vstpreset-inventory', description=__doc__.splitlines()[0])
+    argparser.add_argument('-i', '--inventory', default=INVENTORY_FILENAME,
+                           metavar='FILE',
+                           help="Inventory database file (default: "
+                                "%(default)s)")
+    argparser.add_argument('-l', '--label', metavar='PATTERN',
+                           help="Only list presets whose label matches the "
+                                "shell-style PATTERN (case-insensitive)")
+    argparser.add_argument('-p', '--plugin-id', type=parse_plugin_id,
+                           metavar='ID',
+                           help="Only list presets for the plugin with the "
+                                "given ID (four characters or integer)")
+    argparser.add_argument('-r', '--recursive', action='append', default=[],
+                           metavar='DIR',
+                           help="Add all preset files found in DIR and its "
+                                "sub-directories to the inventory (may be "
+                                "given more than once)")
+    argparser.add_argument('--json', action='store_true',
+                           help="List presets as JSON")
+    argparser.add_argument('infiles', nargs='*', metavar='FILE',
+                           help="FXP/FXB or Ardour VST presets file(s) to add "
+                                "to the inventory")
+
+    args = argparser.parse_args(args)
+
+    with Inventory(args.inventory) as inventory:
+        if args.infiles or args.recursive:
+            scanned, unchanged, removed = inventory.update(
+                args.infiles + args.recursive)
+            print("Scanned {:d} file(s), {:d} unchanged, {:d} removed."
+                  .format(scanned, unchanged, removed), file=sys.stderr)
+
+            # only list presets, if asked to
+            if args.plugin_id is None and args.label is None:
+                return
+
+        presets = inventory.query(args.plugin_id, args.label)
+
+    if args.json:
+        import json
+
+        json.dump([dict(info._asdict(), path=path) for path, info in presets],
+                  sys.stdout, indent=2)
+        print()
+        return
+
+    for path, info in presets:
+        print("{:<10} {:<11} {:>7} {:>6}  {:<28} {}".format(
+            format_plugin_id(info.plugin_id), info.type,
+            '-' if info.plugin_version is None else info.plugin_version,
+            '-' if info.num_params is None else info.num_params,
+            info.label, basename(path)))
+
+
+if __name__ == '__main__':
+    sys.exit(main() or 0)
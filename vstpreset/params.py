@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+#
+# vstpreset/params.py
+#
+"""Batch conversion of preset parameter values from and to XML.
+
+All parameter values of a preset are converted at once. Parsing uses NumPy,
+if it is installed and the preset has at least ``NUMPY_MIN_PARAMS``
+parameters, and the standard library ``array`` module otherwise. Both give
+identical results: values are parsed as double precision floats and rounded
+to single precision. Values are formatted with ``repr`` of the single
+precision value widened to a Python float, like ``str(float)`` does.
+
+"""
+
+import threading
+
+from array import array
+
+
+NUMPY_MIN_PARAMS = 256
+
+_numpy = None
+# the caches only grow, under the lock, since the conversion server and the
+# aio module call these functions from several threads
+_cache_lock = threading.Lock()
+_index_strings = []
+_param_prefixes = []
+
+
+def _get_numpy():
+    global _numpy
+
+    if _numpy is None:
+        try:
+            import numpy
+        except ImportError:
+            numpy = False
+
+        _numpy = numpy
+
+    return _numpy
+
+
+def index_strings(num):
+    """Return list of the strings of parameter indices 0 to ``num - 1``."""
+    if len(_index_strings) < num:
+        with _cache_lock:
+            start = len(_index_strings)
+            _index_strings.extend([str(j) for j in range(start, num)])
+
+    return _index_strings[:num]
+
+
+def decode_params(values, use_numpy=None):
+    """Convert sequence of parameter value strings to an ``array('f')``.
+
+    If ``use_numpy`` is None, NumPy is used if it is installed and there are
+    at least ``NUMPY_MIN_PARAMS`` values. Raises ``ValueError`` if a value is
+    not a valid float.
+
+    """
+    if use_numpy is None:
+        use_numpy = len(values) >= NUMPY_MIN_PARAMS
+
+    numpy = _get_numpy() if use_numpy else None
+
+    if numpy:
+        try:
+            # values out of single precision range become infinite, like
+            # with array('f')
+            with numpy.errstate(over='ignore'):
+                data = numpy.array(values, dtype=numpy.float64).astype(
+                    numpy.float32)
+        except ValueError:
+            # let float() raise the error for the offending value
+            pass
+        else:
+            params = array('f')
+            params.frombytes(data.tobytes())
+            return params
+
+    return array('f', map(float, values))
+
+
+def encode_params(params):
+    """Return list of parameter value strings for an ``array('f')``."""
+    # NumPy's float to string conversion gives the same result, but is slower
+    return list(map(repr, params))
+
+
+def params_xml(params):
+    """Return 'Parameter' XML elements for all parameter values as string.
+
+    The output is identical to serializing ``Parameter`` elements with the
+    attributes ``index`` and ``value`` with ``xml.etree.ElementTree``.
+
+    """
+    num = len(params)
+
+    if not num:
+        return ''
+
+    if len(_param_prefixes) < num:
+        with _cache_lock:
+            start = len(_param_prefixes)
+            _param_prefixes.extend([
+                '<Parameter index="{:d}" value="'.format(j)
+                for j in range(start, num)])
+
+    return '" />'.join(map(str.__add__, _param_prefixes[:num],
+                           encode_params(params))) + '" />'
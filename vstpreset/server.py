@@ -0,0 +1,352 @@
+# -*- coding: utf-8 -*-
+#
+# vstpreset/server.py
+#
+"""Resident conversion server listening on a Unix domain socket.
+
+Starting a new Python interpreter for each conversion costs far more than
+converting a single preset. The server keeps the scripts and the modules they
+use loaded and runs conversions for any number of concurrently connected
+clients in a thread pool.
+
+Clients send requests as JSON objects, one per line, and receive a stream of
+JSON objects, one per line, as response. The last object of each response has
+a ``status`` key with the exit status (0 on success). Supported requests are:
+
+``{"op": "run", "script": "ardour2fxp", "args": [...], "cwd": "/path"}``
+    Run ``ardour2fxp`` or ``fxp2ardour`` with the given command line
+    arguments. Relative paths are resolved relative to ``cwd``. Output of the
+    script is sent as ``{"stdout": "..."}`` and ``{"stderr": "..."}`` objects.
+
+``{"op": "convert", "source": "ardour", "data": "...", "fx_version": null}``
+    Convert the base64-encoded content of an Ardour VST presets XML file
+    (``"source": "ardour"``) or an FXP/FXB file (``"source": "fxp"``). Each
+    converted preset resp. Ardour presets file is sent as
+    ``{"result": {"plugin_id": ..., "label": ..., "data": "..."}}``, with the
+    data base64-encoded (there is no label for Ardour preset files).
+
+Errors are sent as ``{"error": "..."}`` objects, followed by a status of 1.
+
+Start the server with::
+
+    $ python -m vstpreset.server
+
+The scripts forward their command line to the server automatically, when it
+is running. See ``vstpreset.client`` for the client side.
+
+"""
+
+import argparse
+import asyncio
+import contextvars
+import importlib
+import io
+import json
+import os
+import signal
+import socket
+import sys
+
+from binascii import a2b_base64, b2a_base64
+from concurrent.futures import ThreadPoolExecutor
+from os.path import exists, join
+
+from .ardour import iter_ardourpresets, write_ardour_presets
+from .client import socket_path
+from .fxp import pack_fxp, parse_buffer
+
+
+SCRIPTS = ('ardour2fxp', 'fxp2ardour')
+# modules imported by the scripts only when first used
+WARM_UP_MODULES = ('hashlib', 'json', 'xml.etree.ElementTree',
+                   'xml.parsers.expat')
+PATH_ARGS = ('infiles', 'recursive')
+MAX_REQUEST_SIZE = 256 * 1024 * 1024
+
+# Function receiving the output of the request handled in the current context.
+_output = contextvars.ContextVar('output', default=None)
+
+
+class _OutputProxy:
+    """Replacement for ``sys.stdout`` and ``sys.stderr``.
+
+    Output written while handling a request is sent to the client of that
+    request, all other output to the original stream.
+
+    """
+
+    def __init__(self, name, stream):
+        self._name = name
+        self._stream = stream
+        self._pid = os.getpid()
+
+    def write(self, text):
+        send = _output.get()
+
+        # forked worker processes inherit the context, but not the loop
+        if send is None or os.getpid() != self._pid:
+            return self._stream.write(text)
+
+        send({self._name: text})
+        return len(text)
+
+    def flush(self):
+        if _output.get() is None:
+            self._stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+
+def _exit_status(ret):
+    """Return exit status for return value of ``main`` or ``sys.exit``."""
+    if ret is None:
+        return 0
+    elif isinstance(ret, int):
+        return ret
+
+    print(ret, file=sys.stderr)
+    return 1
+
+
+def run_script(script, argv, cwd):
+    """Run script with command line arguments ``argv`` in directory ``cwd``.
+
+    Returns the exit status.
+
+    """
+    if script not in SCRIPTS:
+        raise ValueError("Unknown script: {}".format(script))
+
+    module = importlib.import_module(script)
+    argparser = module.make_argparser()
+    argparser.prog = script
+
+    try:
+        args = argparser.parse_args(argv)
+    except SystemExit as exc:
+        return _exit_status(exc.code)
+
+    if getattr(args, 'watch', False):
+        raise ValueError("Watch mode is not supported by the conversion "
+                         "server.")
+
+    # the server process has its own working directory
+    for name in PATH_ARGS:
+        setattr(args, name, [join(cwd, path) for path in getattr(args, name)])
+
+    args.output_dir = join(cwd, args.output_dir) if args.output_dir else cwd
+
+    if args.profile:
+        args.profile = join(cwd, args.profile)
+
+    return _exit_status(module.run_command(argparser, args))
+
+
+def convert_data(data, source, fx_version=None):
+    """Convert preset data and send results to the client of the request."""
+    send = _output.get()
+
+    def result(data, **kwargs):
+        kwargs['data'] = b2a_base64(data, newline=False).decode('ascii')
+        send({'result': kwargs})
+
+    if source == 'ardour':
+        for preset in iter_ardourpresets(io.BytesIO(data)):
+            result(pack_fxp(preset, fx_version), plugin_id=preset.plugin_id,
+                   label=preset.label)
+    elif source == 'fxp':
+        presets = {}
+        for preset in parse_buffer(data):
+            presets.setdefault(preset.plugin_id, []).append(preset)
+
+        for plugin, plugin_presets in presets.items():
+            fp = io.BytesIO()
+            write_ardour_presets(fp, plugin, plugin_presets)
+            result(fp.getvalue(), plugin_id=plugin)
+    else:
+        raise ValueError("Unknown source format: {}".format(source))
+
+    return 0
+
+
+class ConversionServer:
+    """Server running conversion requests received on a Unix domain socket.
+
+    ``threads`` is the maximum number of requests handled concurrently.
+
+    """
+
+    def __init__(self, path=None, threads=None):
+        self.path = path or socket_path()
+        self.executor = ThreadPoolExecutor(threads)
+        self._server = None
+        self._streams = None
+
+    async def start(self):
+        """Start listening on the socket.
+
+        Raises ``RuntimeError`` if another server is already listening on it.
+
+        """
+        if exists(self.path):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(self.path)
+            except OSError:
+                # stale socket of a server which did not exit cleanly
+                os.unlink(self.path)
+            else:
+                raise RuntimeError("Conversion server is already running on "
+                                   "'{}'.".format(self.path))
+            finally:
+                sock.close()
+
+        # import the scripts and the modules they need before any request
+        for name in SCRIPTS + WARM_UP_MODULES:
+            importlib.import_module(name)
+
+        self._streams = sys.stdout, sys.stderr
+        sys.stdout = _OutputProxy('stdout', sys.stdout)
+        sys.stderr = _OutputProxy('stderr', sys.stderr)
+
+        umask = os.umask(0o077)
+        try:
+            self._server = await asyncio.start_unix_server(
+                self.handle_client, path=self.path, limit=MAX_REQUEST_SIZE)
+        finally:
+            os.umask(umask)
+
+    async def close(self):
+        """Stop listening, remove the socket and wait for running requests."""
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+        await asyncio.get_running_loop().run_in_executor(
+            None, self.executor.shutdown)
+
+        if self._streams is not None:
+            sys.stdout, sys.stderr = self._streams
+            self._streams = None
+
+    async def serve_forever(self):
+        await self._server.serve_forever()
+
+    async def handle_client(self, reader, writer):
+        """Handle requests of one client connection, one after another."""
+        connected = True
+
+        async def send(msg):
+            nonlocal connected
+            if connected:
+                try:
+                    writer.write(json.dumps(msg).encode('utf-8') + b'\n')
+                    await writer.drain()
+                except ConnectionError:
+                    connected = False
+
+        try:
+            while connected:
+                try:
+                    line = await reader.readline()
+                    if not line:
+                        break
+
+                    req = json.loads(line.decode('utf-8'))
+
+                    if req['op'] == 'run':
+                        func = (run_script, req['script'], req['args'],
+                                req['cwd'])
+                    elif req['op'] == 'convert':
+                        func = (convert_data, a2b_base64(req['data']),
+                                req['source'], req.get('fx_version'))
+                    else:
+                        raise ValueError("Unknown op: {}".format(req['op']))
+                except (ValueError, KeyError, TypeError) as exc:
+                    await send({'error': "Invalid request: {}".format(exc)})
+                    await send({'status': 1})
+                    break
+
+                status = await self.call(send, *func)
+                await send({'status': status})
+        finally:
+            writer.close()
+
+    async def call(self, send, func, *args):
+        """Call function in the thread pool, sending its output to client.
+
+        Returns exit status.
+
+        """
+        loop = asyncio.get_running_loop()
+        messages = asyncio.Queue()
+        done = object()
+
+        def put(msg):
+            loop.call_soon_threadsafe(messages.put_nowait, msg)
+
+        def call():
+            _output.set(put)
+            try:
+                return func(*args)
+            except Exception as exc:
+                put({'error': str(exc)})
+                return 1
+            finally:
+                put(done)
+
+        future = loop.run_in_executor(self.executor,
+                                      contextvars.copy_context().run, call)
+
+        while True:
+            msg = await messages.get()
+            if msg is done:
+                break
+            await send(msg)
+
+        return await future
+
+
+async def serve(path=None, threads=None):
+    """Run conversion server until cancelled."""
+    server = ConversionServer(path, threads)
+    await server.start()
+    asyncio.get_running_loop().add_signal_handler(
+        signal.SIGTERM, asyncio.current_task().cancel)
+    print("Conversion server listening on '{}'.".format(server.path),
+          file=sys.stderr)
+
+    try:
+        await server.serve_forever()
+    finally:
+        await server.close()
+
+
+def main(args=None):
+    argparser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    argparser.add_argument('-s', '--socket', metavar='PATH',
+                           help="Socket path (default: {})".format(
+                               socket_path()))
+    argparser.add_argument('-t', '--threads', type=int, metavar='N',
+                           help="Maximum number of requests handled "
+                                "concurrently")
+
+    args = argparser.parse_args(args)
+
+    try:
+        asyncio.run(serve(args.socket, args.threads))
+    except RuntimeError as exc:
+        return str(exc)
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        pass
+
+
+if __name__ == '__main__':
+    sys.exit(main() or 0)
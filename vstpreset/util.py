@@ -0,0 +1,574 @@
+# -*- coding: utf-8 -*-
+#
+# vstpreset/util.py
+#
+"""Helpers for the conversion scripts: statistics, file discovery, pipelines,
+output file naming and writing.
+"""
+
+import contextvars
+import os
+import queue
+import sys
+import threading
+
+from time import perf_counter
+
+
+PIPELINE_QUEUE_SIZE = 64
+# queue size between pipeline stages passing preset or file data, which can
+# be several MB per item, so only a few of them are held in memory
+PIPELINE_DATA_QUEUE_SIZE = 4
+FILENAME_MAX_BYTES = 200
+# characters not allowed in file names on common file systems and spaces
+_FILENAME_TRANS = dict.fromkeys(
+    list(range(32)) + [127] + [ord(c) for c in '<>:"/\\|?* '], '_')
+_WINDOWS_RESERVED_NAMES = frozenset(
+    ['CON', 'PRN', 'AUX', 'NUL'] +
+    ['{}{:d}'.format(dev, i) for dev in ('COM', 'LPT') for i in range(1, 10)])
+
+
+class ConversionError(Exception):
+    """Raised when an input file could not be read or converted."""
+
+
+class Stats:
+    """Timing and throughput statistics for the stages of a conversion run.
+
+    For each stage, the total time spent in it, the number of calls and the
+    number of bytes and presets processed are accumulated. Stages running
+    concurrently (in pipeline threads or worker processes) are timed
+    separately, so their times can add up to more than the wall time.
+
+    Instances can be updated from several threads.
+
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.start = perf_counter()
+        self._lock = threading.Lock()
+
+    def add(self, stage, seconds=0.0, bytes=0, presets=0):
+        """Add time and counts for one call of given stage."""
+        with self._lock:
+            counts = self.stages.setdefault(stage, [0.0, 0, 0, 0])
+            counts[0] += seconds
+            counts[1] += 1
+            counts[2] += bytes
+            counts[3] += presets
+
+    def update(self, stages):
+        """Add statistics from ``stages`` dict of another Stats instance."""
+        with self._lock:
+            for stage, other in stages.items():
+                counts = self.stages.setdefault(stage, [0.0, 0, 0, 0])
+                for i, value in enumerate(other):
+                    counts[i] += value
+
+    def as_dict(self):
+        """Return statistics as a dict suitable for JSON serialization."""
+        return {
+            'wall_seconds': perf_counter() - self.start,
+            'stages': {
+                stage: dict(zip(('seconds', 'calls', 'bytes', 'presets'),
+                                counts))
+                for stage, counts in self.stages.items()
+            },
+        }
+
+    def report(self, format='text'):
+        """Return statistics summary as text table or JSON string."""
+        data = self.as_dict()
+
+        if format == 'json':
+            import json
+            return json.dumps(data, indent=2)
+
+        lines = ["{:<16} {:>9} {:>7} {:>8} {:>10} {:>10} {:>8}".format(
+            "Stage", "Time (s)", "Calls", "Presets", "MB", "Presets/s",
+            "MB/s")]
+        for stage, counts in data['stages'].items():
+            seconds = counts['seconds'] or float('nan')
+            lines.append(
+                "{:<16} {:>9.3f} {:>7d} {:>8d} {:>10.3f} {:>10.1f} "
+                "{:>8.2f}".format(
+                    stage, counts['seconds'], counts['calls'],
+                    counts['presets'], counts['bytes'] / 1e6,
+                    counts['presets'] / seconds,
+                    counts['bytes'] / 1e6 / seconds))
+        lines.append("Wall time: {:.3f} s".format(data['wall_seconds']))
+        return "\n".join(lines)
+
+
+def find_files(path, patterns):
+    """Find files below directory matching any of the given name patterns.
+
+    Patterns are matched case-insensitively against file names with
+    ``fnmatch``. Directories are walked recursively with ``os.scandir`` and
+    matching file paths are yielded as they are found, in sorted order per
+    directory. Symbolic links to directories are not followed, so link loops
+    can not cause endless recursion.
+
+    """
+    import fnmatch
+
+    try:
+        entries = sorted(os.scandir(path), key=lambda entry: entry.name)
+    except OSError as exc:
+        print("Could not read directory '{}': {}".format(path, exc))
+        return
+
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            yield from find_files(entry.path, patterns)
+        elif entry.is_file() and any(fnmatch.fnmatch(entry.name.lower(), pat)
+                                     for pat in patterns):
+            yield entry.path
+
+
+def parse_plugin_id(value):
+    """Return plugin ID given as four characters or an integer as integer.
+
+    Raises ``ValueError`` if ``value`` is neither.
+
+    """
+    if len(value) == 4 and not value.isdigit():
+        return int.from_bytes(value.encode('latin1'), 'big')
+
+    return int(value)
+
+
+def sanitize_filename(name, default='Untitled'):
+    """Return name with characters unsuitable for file names replaced.
+
+    Surrounding whitespace is removed. Spaces, control characters and
+    characters not allowed in file names on Windows or POSIX systems are
+    replaced with underscores. Names are shortened to at most
+    ``FILENAME_MAX_BYTES`` bytes in UTF-8 encoding. Trailing dots are
+    removed and a leading dot (which would make the file hidden) is replaced
+    with an underscore. Names reserved for devices on Windows get an
+    underscore appended. An empty name is replaced with ``default``.
+
+    """
+    name = name.strip().translate(_FILENAME_TRANS)
+
+    encoded = name.encode('utf-8')
+    if len(encoded) > FILENAME_MAX_BYTES:
+        name = encoded[:FILENAME_MAX_BYTES].decode('utf-8', 'ignore')
+
+    name = name.rstrip('.')
+
+    if name.startswith('.'):
+        name = '_' + name[1:]
+
+    if not name:
+        name = default
+
+    head, dot, tail = name.partition('.')
+    if head.upper() in _WINDOWS_RESERVED_NAMES:
+        name = head + '_' + dot + tail
+
+    return name
+
+
+class FilenameAllocator:
+    """Assign unique output file names within directories during a run.
+
+    Names are sanitized with ``sanitize_filename`` and compared
+    case-insensitively, so they are unique on case-insensitive file systems
+    too. When a name was already assigned in the same directory, the suffix
+    ``_2``, ``_3``, etc. is appended, so file names only depend on the order
+    of the presets. No file system access is needed.
+
+    """
+
+    def __init__(self):
+        # directory -> set of assigned names in lower case
+        self._assigned = {}
+        # (directory, name in lower case) -> next suffix number to try
+        self._counters = {}
+        # key -> assigned path
+        self._keys = {}
+
+    def allocate(self, dirpath, name, ext='', key=None):
+        """Return unique path in ``dirpath`` for file name ``name + ext``.
+
+        If a hashable ``key`` is given and a path was assigned for it before,
+        that path is returned again, so the same preset keeps its file name
+        when it is converted again by the same allocator.
+
+        """
+        if key is not None and key in self._keys:
+            return self._keys[key]
+
+        assigned = self._assigned.setdefault(dirpath, set())
+        name = sanitize_filename(name)
+        fn = name + ext
+
+        if fn.lower() in assigned:
+            counter = (dirpath, name.lower())
+            num = self._counters.get(counter, 2)
+
+            while True:
+                fn = '{}_{:d}{}'.format(name, num, ext)
+                num += 1
+
+                if fn.lower() not in assigned:
+                    break
+
+            self._counters[counter] = num
+
+        assigned.add(fn.lower())
+        path = os.path.join(dirpath, fn)
+
+        if key is not None:
+            self._keys[key] = path
+
+        return path
+
+
+class DedupIndex:
+    """Index of preset payload digests for finding duplicate presets.
+
+    Each preset is registered with ``add`` under a digest of its payload, as
+    returned by ``vstpreset.core.preset_digest`` or
+    ``vstpreset.fxp.program_digest``.
+
+    """
+
+    def __init__(self):
+        self.entries = {}
+        self.num_duplicates = 0
+
+    def add(self, digest, infile, label, *info):
+        """Register preset from ``infile`` with given label and digest.
+
+        If a preset with the same digest was registered before, a message
+        about the duplicate is printed and the ``(infile, label, *info)``
+        tuple of the first preset is returned, otherwise None.
+
+        """
+        entry = (infile, label) + info
+        first = self.entries.setdefault(digest, entry)
+
+        if first is entry:
+            return None
+
+        self.num_duplicates += 1
+        print("Preset '{}' in '{}' is a duplicate of preset '{}' in '{}'."
+              .format(label, infile, first[1], first[0]))
+        return first
+
+
+class PresetFilter:
+    """Select presets by plugin ID, label and preset type.
+
+    ``plugin_ids`` is a collection of integer plugin IDs, ``label`` a
+    shell-style pattern matched against the whole label case-insensitively,
+    ``label_regex`` a regular expression (string or compiled) searched for in
+    the label and ``preset_type`` the name of the preset type, 'Preset' or
+    'ChunkPreset'. Criteria which are None are not checked.
+
+    Instances are called with the type name, plugin ID and label of a preset
+    and return True if the preset matches all criteria. They only need the
+    preset metadata, so the parsers can check them before converting any
+    parameter values or chunk data.
+
+    """
+
+    # name of Ardour preset files, which contain presets for one plugin only
+    _ARDOUR_FILENAME = r'vst-(-?\d+)'
+
+    def __init__(self, plugin_ids=None, label=None, label_regex=None,
+                 preset_type=None):
+        import re
+
+        self.plugin_ids = None
+        self.label = None
+        self.label_regex = None
+        self.preset_type = preset_type
+
+        if plugin_ids is not None:
+            self.plugin_ids = frozenset(plugin_id & 0xFFFFFFFF
+                                        for plugin_id in plugin_ids)
+
+        if label is not None:
+            import fnmatch
+            self.label = re.compile(fnmatch.translate(label), re.IGNORECASE)
+
+        if label_regex is not None:
+            self.label_regex = re.compile(label_regex)
+
+    @classmethod
+    def from_args(cls, args):
+        """Return filter for parsed command line arguments or None.
+
+        Uses the ``plugin_id``, ``label``, ``label_regex`` and ``type``
+        attributes of ``args``. Returns None if none of them is set.
+
+        """
+        if (args.plugin_id is None and args.label is None and
+                args.label_regex is None and args.type is None):
+            return None
+
+        return cls(args.plugin_id, args.label, args.label_regex, args.type)
+
+    def __call__(self, preset_type, plugin_id, label):
+        return ((self.preset_type is None or
+                 preset_type == self.preset_type) and
+                (self.plugin_ids is None or
+                 plugin_id & 0xFFFFFFFF in self.plugin_ids) and
+                (self.label is None or self.label.match(label)) and
+                (self.label_regex is None or
+                 self.label_regex.search(label) is not None))
+
+    def accepts_file(self, fn):
+        """Return False if Ardour presets file can not contain matching presets.
+
+        Ardour stores the presets for each plugin in a file named after the
+        plugin ID (e.g. ``vst-1094861636``), so files for other plugins can be
+        skipped without reading them. Returns True for all other file names.
+
+        """
+        import re
+
+        if self.plugin_ids is None:
+            return True
+
+        match = re.fullmatch(self._ARDOUR_FILENAME, os.path.basename(fn))
+        return (match is None or
+                int(match.group(1)) & 0xFFFFFFFF in self.plugin_ids)
+
+
+class OutputDir:
+    """Write output files below a directory atomically and with few syscalls.
+
+    Directories are created when the first file is written to them. The names
+    of the existing files in each directory are read with a single
+    ``os.scandir`` call and remembered, so checking whether an output file
+    exists needs no further syscalls.
+
+    Each file is written to a temporary file in the same directory first,
+    which is then renamed to the output file name, so an interrupted
+    conversion never leaves incomplete output files behind.
+
+    If ``sync`` is true, the renaming is deferred until ``close`` is called.
+    Then all temporary files are flushed to disk in one batch, renamed and
+    the directory entries flushed too, which is much faster than flushing
+    each file as it is written.
+
+    """
+
+    def __init__(self, path, sync=False):
+        self.path = path
+        self.sync = sync
+        self._listings = {}
+        # output file name -> temporary file name
+        self._pending = {}
+
+    def _listing(self, dirpath):
+        names = self._listings.get(dirpath)
+
+        if names is None:
+            try:
+                names = {entry.name for entry in os.scandir(dirpath)}
+            except FileNotFoundError:
+                os.makedirs(dirpath, exist_ok=True)
+                names = set()
+
+            self._listings[dirpath] = names
+
+        return names
+
+    def exists(self, fn):
+        """Return True if output file exists or was written already."""
+        dirpath, name = os.path.split(fn)
+        return name in self._listing(dirpath)
+
+    def write(self, fn, data):
+        """Write data to output file, creating its directory if necessary.
+
+        Returns the ``os.stat_result`` of the written file.
+
+        """
+        dirpath, name = os.path.split(fn)
+        names = self._listing(dirpath)
+        tmp_fn = os.path.join(dirpath, '.{}.tmp'.format(name))
+
+        try:
+            try:
+                fp = open(tmp_fn, 'xb')
+            except FileExistsError:
+                # left over from an interrupted run, possibly a hard link
+                os.unlink(tmp_fn)
+                fp = open(tmp_fn, 'xb')
+
+            with fp:
+                fp.write(data)
+                fp.flush()
+                st = os.fstat(fp.fileno())
+
+            self._commit(tmp_fn, fn)
+        except BaseException:
+            self._discard(tmp_fn, fn)
+            raise
+
+        names.add(name)
+        return st
+
+    def link(self, src_fn, fn):
+        """Create output file as a hard link to an output file written before.
+
+        Returns the ``os.stat_result`` of the linked file.
+
+        """
+        dirpath, name = os.path.split(fn)
+        names = self._listing(dirpath)
+        tmp_fn = os.path.join(dirpath, '.{}.tmp'.format(name))
+
+        try:
+            try:
+                os.unlink(tmp_fn)
+            except FileNotFoundError:
+                pass
+
+            os.link(self._pending.get(src_fn, src_fn), tmp_fn)
+            st = os.stat(tmp_fn)
+            self._commit(tmp_fn, fn)
+        except BaseException:
+            self._discard(tmp_fn, fn)
+            raise
+
+        names.add(name)
+        return st
+
+    def _commit(self, tmp_fn, fn):
+        if self.sync:
+            self._pending[fn] = tmp_fn
+        else:
+            os.replace(tmp_fn, fn)
+
+    def _discard(self, tmp_fn, fn):
+        self._pending.pop(fn, None)
+        try:
+            os.unlink(tmp_fn)
+        except OSError:
+            pass
+
+    def close(self):
+        """Flush and rename output files, which were written with sync."""
+        pending, self._pending = self._pending, {}
+
+        for tmp_fn in pending.values():
+            fd = os.open(tmp_fn, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+        for fn, tmp_fn in pending.items():
+            os.replace(tmp_fn, fn)
+
+        if pending and hasattr(os, 'O_DIRECTORY'):
+            for dirpath in {os.path.dirname(fn) for fn in pending}:
+                fd = os.open(dirpath or os.curdir, os.O_RDONLY | os.O_DIRECTORY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+
+    def abort(self):
+        """Finish writing after an error.
+
+        Each output file written so far is complete, so, unlike for
+        ``ArchiveWriter``, they are kept, like ``close`` does.
+
+        """
+        self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def iter_threaded(iterable, maxsize=PIPELINE_QUEUE_SIZE):
+    """Iterate over iterable in a background thread.
+
+    Items are passed through a bounded queue with room for ``maxsize`` items,
+    so the producer can run ahead of the consumer only so far. Use
+    ``PIPELINE_DATA_QUEUE_SIZE`` for stages passing preset data. Exceptions
+    raised by the producer are re-raised in the consumer. Closing the returned
+    generator stops the producer.
+
+    This allows to chain iterators into a pipeline of concurrently running
+    stages.
+
+    """
+    items = queue.Queue(maxsize)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        it = iter(iterable)
+        try:
+            for item in it:
+                if not put((item, None)):
+                    break
+            else:
+                put((done, None))
+        except BaseException as exc:
+            put((done, exc))
+        finally:
+            if hasattr(it, 'close'):
+                it.close()
+
+    # run producer in a copy of the current context, so context variables,
+    # e.g. the output redirection of the conversion server, apply to it too
+    thread = threading.Thread(target=contextvars.copy_context().run,
+                              args=(produce,), daemon=True)
+    thread.start()
+
+    try:
+        while True:
+            item, exc = items.get()
+            if exc is not None:
+                raise exc
+            elif item is done:
+                break
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+def profile(func, *args, filename=None):
+    """Call function with cProfile enabled and dump profile data to file.
+
+    Only code running in the main thread of the current process is profiled.
+    The profile data can be analysed with the ``pstats`` module.
+
+    """
+    import cProfile
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+
+    try:
+        return func(*args)
+    finally:
+        profiler.disable()
+        profiler.dump_stats(filename)
+        print("Profile data written to '{}'.".format(filename),
+              file=sys.stderr)
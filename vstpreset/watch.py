@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+#
+# vstpreset/watch.py
+#
+"""Watch preset files for changes.
+
+On Linux, changes are detected with inotify (via ``ctypes``), elsewhere or if
+inotify is not available, by polling the modification time and size of the
+files.
+
+"""
+
+import ctypes
+import ctypes.util
+import fnmatch
+import os
+import select
+import sys
+import time
+
+from os.path import basename, dirname, join, normpath
+from struct import Struct
+
+from .util import find_files
+
+
+WATCH_DEBOUNCE = 0.5
+POLL_INTERVAL = 1.0
+
+IN_CLOEXEC = 0o2000000
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+INOTIFY_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+INOTIFY_EVENT = Struct('iIII')
+
+
+def _matches(fn, patterns):
+    name = basename(fn).lower()
+    return any(fnmatch.fnmatch(name, pat) for pat in patterns)
+
+
+class PollingWatcher:
+    """Detect changed files by comparing their modification time and size.
+
+    ``files`` is a list of file names to watch, ``dirs`` a list of
+    directories, in which all files matching any of ``patterns`` are watched
+    recursively. New files are reported as changed too.
+
+    """
+
+    def __init__(self, files=(), dirs=(), patterns=(), interval=POLL_INTERVAL):
+        self.files = [normpath(fn) for fn in files]
+        self.dirs = list(dirs)
+        self.patterns = patterns
+        self.interval = interval
+        self._state = self._scan()
+
+    def _scan(self):
+        state = {}
+
+        for fn in self.files + [normpath(fn) for path in self.dirs
+                                for fn in find_files(path, self.patterns)]:
+            try:
+                st = os.stat(fn)
+            except OSError:
+                continue
+
+            state[fn] = (st.st_mtime_ns, st.st_size)
+
+        return state
+
+    def wait(self, timeout=None):
+        """Wait for changes for at most ``timeout`` seconds.
+
+        Returns set of names of changed files, which may be empty.
+
+        """
+        time.sleep(self.interval if timeout is None
+                   else min(timeout, self.interval))
+        state = self._scan()
+        changed = {fn for fn, st in state.items() if self._state.get(fn) != st}
+        self._state = state
+        return changed
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher:
+    """Detect changed files with the Linux inotify API.
+
+    Takes the same arguments as ``PollingWatcher``. Files are reported as
+    changed, when they are closed after writing or moved into a watched
+    directory. Sub-directories created in watched directories are watched
+    too.
+
+    Raises ``OSError`` if inotify is not available.
+
+    """
+
+    def __init__(self, files=(), dirs=(), patterns=()):
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'),
+                                 use_errno=True)
+        self._fd = self._libc.inotify_init1(IN_CLOEXEC)
+        if self._fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+
+        self.files = {normpath(fn) for fn in files}
+        self.dirs = list(dirs)
+        self.patterns = patterns
+        # watch descriptor -> (directory, watched recursively)
+        self._watches = {}
+
+        for fn in self.files:
+            self._add_watch(dirname(fn) or os.curdir, False)
+
+        for path in self.dirs:
+            self._add_tree(path)
+
+    def _add_watch(self, path, recursive):
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path),
+                                          INOTIFY_MASK)
+        if wd < 0:
+            print("Could not watch directory '{}': {}".format(
+                path, os.strerror(ctypes.get_errno())))
+            return
+
+        if wd in self._watches:
+            recursive = recursive or self._watches[wd][1]
+
+        self._watches[wd] = (path, recursive)
+
+    def _add_tree(self, path):
+        self._add_watch(path, True)
+
+        try:
+            entries = list(os.scandir(path))
+        except OSError:
+            return
+
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                self._add_tree(entry.path)
+
+    def _all_files(self):
+        return self.files.union(normpath(fn) for path in self.dirs
+                                for fn in find_files(path, self.patterns))
+
+    def wait(self, timeout=None):
+        """Wait for changes for at most ``timeout`` seconds.
+
+        Returns set of names of changed files, which may be empty.
+
+        """
+        ready, _, _ = select.select([self._fd], [], [], timeout)
+        if not ready:
+            return set()
+
+        data = os.read(self._fd, 64 * 1024)
+        changed = set()
+        offset = 0
+
+        while offset < len(data):
+            wd, mask, _, size = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = os.fsdecode(data[offset:offset + size].rstrip(b'\0'))
+            offset += size
+
+            if mask & IN_Q_OVERFLOW:
+                # events were lost, so consider all files as changed
+                changed.update(self._all_files())
+                continue
+            elif wd not in self._watches:
+                continue
+
+            path, recursive = self._watches[wd]
+            fn = normpath(join(path, name))
+
+            if mask & IN_ISDIR:
+                if recursive:
+                    self._add_tree(fn)
+                    changed.update(normpath(new) for new in
+                                   find_files(fn, self.patterns))
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                if fn in self.files or (recursive and
+                                        _matches(fn, self.patterns)):
+                    changed.add(fn)
+
+        return changed
+
+    def close(self):
+        os.close(self._fd)
+
+
+def make_watcher(files=(), dirs=(), patterns=(), polling=False):
+    """Return an InotifyWatcher or, if not available, a PollingWatcher."""
+    if not polling and sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(files, dirs, patterns)
+        except (OSError, AttributeError, TypeError):
+            pass
+
+    return PollingWatcher(files, dirs, patterns)
+
+
+def iter_changes(watcher, debounce=WATCH_DEBOUNCE):
+    """Yield sorted lists of changed files reported by watcher.
+
+    Changes are collected until no further changes were reported for
+    ``debounce`` seconds, so a burst of saves results in a single list, in
+    which each file is included only once.
+
+    """
+    pending = set()
+    deadline = None
+
+    while True:
+        timeout = (None if not pending
+                   else max(0.0, deadline - time.monotonic()))
+        changed = watcher.wait(timeout)
+
+        if changed:
+            pending.update(changed)
+            deadline = time.monotonic() + debounce
+        elif pending and time.monotonic() >= deadline:
+            yield sorted(pending)
+            pending = set()